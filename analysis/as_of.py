@@ -0,0 +1,38 @@
+"""
+Latest event on or before a per-patient date ("as of" lookups)
+
+hba1c_mmol_per_mol, hba1c_percentage, creatinine, bmi and most_recent_smoking_code are each the
+value of the patient's latest coded event of a codelist on or before gout_code_date (bmi within
+10 years of it, from age 16). The events of all of them are fetched from CodedEvent at once and
+sorted by (patient, day) (local_backend.LocalBackend.as_of_values); the latest event of each
+patient within a window is then found for every patient with one binary search for the end of
+the window, using the same keys as window_counts.py.
+"""
+import numpy as np
+
+from window_counts import patient_keys
+
+
+def last_on_or_before(positions, days, low, high, size):
+    """Index of each patient's latest event within [low, high], or -1 if there is none
+
+    positions (0 to size - 1) and days must be sorted by position, then day, and then the order
+    in which ties are broken: of several events on the latest day, the first is chosen, as
+    tpp_backend.py does. low and high are None (unbounded), a single day or one day per patient;
+    a patient whose bound is missing (NaN) has no event. Events without a day are ignored.
+    """
+    positions, days = np.asarray(positions), np.asarray(days, dtype=float)
+    dated = np.flatnonzero(~np.isnan(days))
+    positions, days = positions[dated], days[dated]
+    if len(days) == 0:
+        return np.full(size, -1)
+    low = np.broadcast_to(-np.inf if low is None else low, (size,))
+    high = np.broadcast_to(np.inf if high is None else high, (size,))
+    keys, bound_keys = patient_keys(positions, days, size)
+    last = np.searchsorted(keys, bound_keys(high), side="right") - 1
+    candidate = np.maximum(last, 0)
+    with np.errstate(invalid="ignore"):
+        found = (last >= 0) & (positions[candidate] == np.arange(size)) & (days[candidate] >= low) & ~np.isnan(high)
+    # The first event of the patient's latest day
+    first = np.searchsorted(keys, keys[candidate], side="left")
+    return np.where(found, dated[first], -1)
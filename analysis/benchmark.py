@@ -0,0 +1,212 @@
+"""
+Per-variable benchmarks of the study definitions on the local synthetic backend
+
+Runs every variable of study_definition, study_definition_consults_year (index date 2019-03-01)
+and study_definition_year against synthetic databases of several sizes (analysis/synthetic_ehr.py
+with a fixed seed, built in output/benchmarks/ the first time they are needed). Each study is run
+as an extraction is (LocalBackend.run, with its shared event buffers) on one thread, and for each
+variable the wall time, the rows fetched from the database and the peak memory allocated while
+it ran (tracemalloc) are recorded. Variables evaluated together (window_count_groups and
+as_of_groups of local_backend.py) fetch their events when the first of them is evaluated; that
+fetch is recorded as its own entry, e.g. "group: ult_count_6m, ult_count_12m", and the members
+only with the time and rows of their own evaluation (the peak memory of the fetch is the group's,
+and the member that ran it has none of its own). Results are written as JSON
+with totals per group of variables (a chain such as urate_test_1..7 and its dates is one group),
+so that runs can be compared:
+
+    python analysis/benchmark.py run --scales 10000 100000 --output output/benchmarks/baseline.json
+    python analysis/benchmark.py compare output/benchmarks/baseline.json output/benchmarks/new.json
+
+compare lists the variables that got slower by more than --threshold (default 25%), ignoring
+variables that took less than --min-seconds in both runs, and exits with status 1 if there are any.
+"""
+import argparse
+import functools
+import json
+import re
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+from local_backend import LocalBackend
+from study_plan import dependency_graph, levels, load_study
+from synthetic_ehr import generate
+
+STUDIES = [
+    ("study_definition", None),
+    ("study_definition_consults_year", "2019-03-01"),
+    ("study_definition_year", None),
+]
+SCALES = [10_000, 100_000]
+BENCHMARK_DIR = Path("output/benchmarks")
+THRESHOLD = 1.25
+MIN_SECONDS = 0.1
+
+
+def variable_group(name):
+    # urate_test_3_date -> urate_test, gout_admission_2 -> gout_admission
+    return re.sub(r"(_\d+)?(_date)?$", "", name) or name
+
+
+def database(patients):
+    path = BENCHMARK_DIR / f"synthetic_ehr_{patients}.sqlite"
+    if not path.exists():
+        print(f"generating {path}", file=sys.stderr)
+        generate(path, patients)
+    return path
+
+
+class Measurements:
+    """Wrap the evaluate function of a backend and measure each variable (a monitor of LocalBackend.run)"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.variables = {}
+        # Group fetches, and the variable whose evaluation ran each
+        self.groups = {}
+
+    def wrap(self, evaluate):
+        return functools.partial(self.measure, evaluate)
+
+    def measure(self, evaluate, name, definition, inputs):
+        # Evaluate one variable, recording its wall time, rows fetched and peak traced memory,
+        # and those of a group fetched while it was evaluated separately
+        stats = self.backend.thread_stats()
+        rows_before, fetches = stats["rows_read"], len(stats["group_fetches"])
+        tracemalloc.reset_peak()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        result = evaluate(name, definition, inputs)
+        seconds = time.perf_counter() - start
+        peak_bytes = tracemalloc.get_traced_memory()[1] - memory_before
+        rows_read = stats["rows_read"] - rows_before
+        for fetch in stats["group_fetches"][fetches:]:
+            self.groups[fetch["name"]] = name
+            self.variables[fetch["name"]] = {
+                "seconds": round(fetch["seconds"], 4),
+                "rows_read": fetch["rows_read"],
+                "peak_bytes": peak_bytes,
+            }
+            seconds -= fetch["seconds"]
+            rows_read -= fetch["rows_read"]
+            peak_bytes = None
+        self.variables[name] = {"seconds": round(seconds, 4), "rows_read": rows_read, "peak_bytes": peak_bytes}
+        return result
+
+
+def benchmark(study_definition, index_date, patients):
+    study = load_study(study_definition, index_date)
+    definitions = study.covariate_definitions
+    level_of = {
+        name: i for i, level in enumerate(levels(dependency_graph(definitions)), start=1) for name in level
+    }
+    backend = LocalBackend(database(patients), definitions)
+    measurements = Measurements(backend)
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        backend.run(jobs=1, report=lambda message: None, monitors=[measurements])
+    finally:
+        tracemalloc.stop()
+    level_of.update({fetch: level_of[name] for fetch, name in measurements.groups.items()})
+    variables = {name: {"level": level_of[name], **measurement} for name, measurement in measurements.variables.items()}
+    groups = {}
+    for name, measurement in variables.items():
+        groups[variable_group(name)] = groups.get(variable_group(name), 0) + measurement["seconds"]
+    return {
+        "study_definition": study_definition,
+        "index_date": index_date,
+        "patients": patients,
+        "seconds": round(time.perf_counter() - start, 3),
+        "rows_read": sum(measurement["rows_read"] for measurement in variables.values()),
+        "variables": variables,
+        "groups": {group: round(seconds, 4) for group, seconds in sorted(groups.items(), key=lambda item: -item[1])},
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(scales, studies, output):
+    results = {"created": datetime.now().isoformat(timespec="seconds"), "commit": git_commit(), "runs": []}
+    for patients in scales:
+        for study_definition, index_date in studies:
+            result = benchmark(study_definition, index_date, patients)
+            results["runs"].append(result)
+            print(
+                f"{study_definition} ({patients} patients): {result['seconds']:.2f}s, "
+                f"{result['rows_read']} rows read"
+            )
+            for group, seconds in list(result["groups"].items())[:5]:
+                print(f"    {group}: {seconds:.2f}s")
+    output = Path(output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=1))
+
+
+def measurements(results):
+    # {(study_definition, index_date, patients, variable): measurement}
+    return {
+        (run["study_definition"], run["index_date"], run["patients"], name): measurement
+        for run in results["runs"]
+        for name, measurement in run["variables"].items()
+    }
+
+
+def regressions(baseline, current, threshold=THRESHOLD, min_seconds=MIN_SECONDS):
+    # Variables that take more than threshold times as long as in the baseline
+    before, after = measurements(baseline), measurements(current)
+    slower = []
+    for key in sorted(set(before) & set(after), key=str):
+        old, new = before[key]["seconds"], after[key]["seconds"]
+        if max(old, new) >= min_seconds and new > old * threshold:
+            slower.append((key, old, new))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="benchmark the study definitions")
+    run_parser.add_argument("--scales", type=int, nargs="+", default=SCALES, help="numbers of patients")
+    run_parser.add_argument(
+        "--study-definitions", nargs="+", help="study definitions to run (default: all three)"
+    )
+    run_parser.add_argument(
+        "--output", default=BENCHMARK_DIR / f"benchmark_{datetime.now():%Y-%m-%d_%H%M%S}.json"
+    )
+    compare_parser = commands.add_parser("compare", help="flag variables that got slower")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    compare_parser.add_argument("--min-seconds", type=float, default=MIN_SECONDS)
+    args = parser.parse_args()
+
+    if args.command == "run":
+        studies = [
+            (study_definition, index_date)
+            for study_definition, index_date in STUDIES
+            if not args.study_definitions or study_definition in args.study_definitions
+        ]
+        run(args.scales, studies, args.output)
+    else:
+        baseline, current = (json.loads(Path(path).read_text()) for path in (args.baseline, args.current))
+        slower = regressions(baseline, current, args.threshold, args.min_seconds)
+        for (study_definition, index_date, patients, name), old, new in slower:
+            print(f"{study_definition} ({patients} patients) {name}: {old:.3f}s -> {new:.3f}s")
+        if slower:
+            sys.exit(1)
+        print("No regressions")
+
+
+if __name__ == "__main__":
+    main()
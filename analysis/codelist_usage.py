@@ -0,0 +1,61 @@
+"""
+Report the codelists each study definition loads
+
+Each study definition is imported afresh (every module of analysis/ is imported again, so helper
+modules shared between study definitions load their codelists each time), and the codelists it
+caused to be parsed are listed with their source CSVs. By default every study definition (a
+study_definition*.py that defines study = StudyDefinition(...)) is reported. Run from the
+repository root:
+
+    python analysis/codelist_usage.py [study_definition ...]
+"""
+import argparse
+import importlib
+import re
+import sys
+from pathlib import Path
+
+STUDY = re.compile(r"^study = StudyDefinition\(", re.MULTILINE)
+ANALYSIS_DIR = Path("analysis").resolve()
+
+
+def study_definitions():
+    return sorted(
+        path.stem for path in Path("analysis").glob("study_definition*.py") if STUDY.search(path.read_text())
+    )
+
+
+def forget_analysis_modules():
+    # Modules imported from analysis/, so that importing a study definition runs all of them again
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, "__file__", None)
+        if path and Path(path).resolve().parent == ANALYSIS_DIR:
+            del sys.modules[name]
+
+
+def codelists_loaded_by(study_definition):
+    forget_analysis_modules()
+    importlib.import_module(study_definition)
+    codelists = sys.modules["codelists"]
+    # Source CSVs (or combined codelists) of each loaded codelist
+    return {name: codelists.codelist_sources(name) for name in codelists.loaded_codelists()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "study_definitions",
+        nargs="*",
+        default=study_definitions(),
+    )
+    args = parser.parse_args()
+
+    for study_definition in args.study_definitions:
+        loaded = codelists_loaded_by(study_definition)
+        print(f"{study_definition}: {len(loaded)} codelists")
+        for name, sources in loaded.items():
+            print(f"    {name}: {', '.join(sources) or '(inline codes)'}")
+
+
+if __name__ == "__main__":
+    main()
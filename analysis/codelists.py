@@ -4,171 +4,95 @@ from cohortextractor import (
     codelist,
 )
 
-# Demographics
-ethnicity_codes = codelist_from_csv(
-    "codelists/opensafely-ethnicity.csv",
-    system="ctv3",
-    column="Code",
-    category_column="Grouping_6",
-)
-
-# Smoking
-clear_smoking_codes = codelist_from_csv(
-    "codelists/opensafely-smoking-clear.csv",
-    system="ctv3",
-    column="CTV3Code",
-    category_column="Category",
-)
-
-# Clinical conditions
-gout_codes = codelist_from_csv(
-    "codelists/user-markdrussell-gout.csv", system="snomed", column="code",
-)
-
-prevalent_gout_codes = codelist_from_csv(
-    "codelists/user-markdrussell-gout-prevalent.csv", system="snomed", column="code",
-)
-
-urate_codes = codelist_from_csv(
-    "codelists/user-markdrussell-serum-urateuric-acid-ctv3.csv", system="ctv3", column="code",
-)
-
-urate_codes_snomed = codelist_from_csv(
-    "codelists/user-markdrussell-serum-urate.csv", system="snomed", column="code",
-)
-
-chronic_cardiac_disease_codes = codelist_from_csv(
-    "codelists/opensafely-chronic-cardiac-disease.csv", system="ctv3", column="CTV3ID",
-)
-
-diabetes_codes = codelist_from_csv(
-    "codelists/opensafely-diabetes.csv", system="ctv3", column="CTV3ID",
-)
-
-hba1c_new_codes = codelist(["XaPbt", "Xaeze", "Xaezd"], system="ctv3")
-hba1c_old_codes = codelist(["X772q", "XaERo", "XaERp"], system="ctv3")
-
-hypertension_codes = codelist_from_csv(
-    "codelists/opensafely-hypertension.csv", system="ctv3", column="CTV3ID",
-)
-
-chronic_respiratory_disease_codes = codelist_from_csv(
-    "codelists/opensafely-chronic-respiratory-disease.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-copd_codes = codelist_from_csv(
-    "codelists/opensafely-current-copd.csv", system="ctv3", column="CTV3ID",
-)
-
-chronic_liver_disease_codes = codelist_from_csv(
-    "codelists/opensafely-chronic-liver-disease.csv", system="ctv3", column="CTV3ID",
-)
-
-stroke_codes = codelist_from_csv(
-    "codelists/opensafely-stroke-updated.csv", system="ctv3", column="CTV3ID",
-)
-
-lung_cancer_codes = codelist_from_csv(
-    "codelists/opensafely-lung-cancer.csv", system="ctv3", column="CTV3ID",
-)
-
-haem_cancer_codes = codelist_from_csv(
-    "codelists/opensafely-haematological-cancer.csv", system="ctv3", column="CTV3ID",
-)
-
-other_cancer_codes = codelist_from_csv(
-    "codelists/opensafely-cancer-excluding-lung-and-haematological.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-creatinine_codes = codelist(["XE2q5"], system="ctv3")
-
-ckd_codes = codelist_from_csv(
-    "codelists/opensafely-chronic-kidney-disease.csv", system="ctv3", column="CTV3ID",
-)
-
-organ_transplant_codes = codelist_from_csv(
-    "codelists/opensafely-solid-organ-transplantation.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-# Medications
-allopurinol_codes = codelist_from_csv(
-    "codelists/user-markdrussell-allopurinol-dmd.csv",
-    system="snomed",
-    column="dmd_id",
-)
-
-febuxostat_codes = codelist_from_csv(
-    "codelists/user-markdrussell-febuxostat-dmd.csv",
-    system="snomed",
-    column="dmd_id",
-)
-
-ult_codes = combine_codelists(
-allopurinol_codes,
-febuxostat_codes
-)
-
-loop_diuretics_codes = codelist_from_csv(
-    "codelists/pincer-diur.csv",
-    system="snomed",
-    column="id",
-)
-
-thiazide_diuretics_codes = codelist_from_csv(
-    "codelists/opensafely-thiazide-type-diuretic-medication.csv",
-    system="snomed",
-    column="id",
-)
-
-diuretic_codes = combine_codelists(
-loop_diuretics_codes,
-thiazide_diuretics_codes
-)
-
-oral_steroids = codelist_from_csv(
-    "codelists/nhsd-oral-steroid-drugs-pra-dmd.csv",
-    system="snomed",
-    column="dmd_id",
-)
-
-nsaids = codelist_from_csv(
-    "codelists/pincer-nsaid.csv",
-    system="snomed",
-    column="id",
-)
-
-colchicine = codelist_from_csv(
-    "codelists/user-markdrussell-colchicine-dmd.csv",
-    system="snomed",
-    column="dmd_id",
-)
-
-flare_treatment = combine_codelists(
-oral_steroids,
-nsaids,
-colchicine
-)
-
-tophi_codes = codelist_from_csv(
-    "codelists/user-markdrussell-gouty-tophi.csv", system="snomed", column="code",
-)
-
-# Admissions
-gout_admission = codelist_from_csv(
-    "codelists/user-markdrussell-gout-admissions.csv",
-    system="icd10",
-    column="code",
-)  
-
-# Flare codes
-gout_flare = codelist_from_csv(
-    "codelists/user-markdrussell-gout-flaresattacks.csv",
-    system="snomed",
-    column="code",
-)
\ No newline at end of file
+# Codelists are loaded lazily: each one is built the first time it is imported or accessed
+# (through the module __getattr__ below), so a study definition that imports only the codelists
+# it uses does not parse the others. loaded_codelists() lists the ones loaded so far, and
+# analysis/codelist_usage.py reports them for each study definition.
+
+# name: (csv, system, column, category_column)
+CSV_CODELISTS = {
+    # Demographics
+    "ethnicity_codes": ("codelists/opensafely-ethnicity.csv", "ctv3", "Code", "Grouping_6"),
+    # Smoking
+    "clear_smoking_codes": ("codelists/opensafely-smoking-clear.csv", "ctv3", "CTV3Code", "Category"),
+    # Clinical conditions
+    "gout_codes": ("codelists/user-markdrussell-gout.csv", "snomed", "code", None),
+    "prevalent_gout_codes": ("codelists/user-markdrussell-gout-prevalent.csv", "snomed", "code", None),
+    "urate_codes": ("codelists/user-markdrussell-serum-urateuric-acid-ctv3.csv", "ctv3", "code", None),
+    "urate_codes_snomed": ("codelists/user-markdrussell-serum-urate.csv", "snomed", "code", None),
+    "chronic_cardiac_disease_codes": ("codelists/opensafely-chronic-cardiac-disease.csv", "ctv3", "CTV3ID", None),
+    "diabetes_codes": ("codelists/opensafely-diabetes.csv", "ctv3", "CTV3ID", None),
+    "hypertension_codes": ("codelists/opensafely-hypertension.csv", "ctv3", "CTV3ID", None),
+    "chronic_respiratory_disease_codes": (
+        "codelists/opensafely-chronic-respiratory-disease.csv", "ctv3", "CTV3ID", None,
+    ),
+    "copd_codes": ("codelists/opensafely-current-copd.csv", "ctv3", "CTV3ID", None),
+    "chronic_liver_disease_codes": ("codelists/opensafely-chronic-liver-disease.csv", "ctv3", "CTV3ID", None),
+    "stroke_codes": ("codelists/opensafely-stroke-updated.csv", "ctv3", "CTV3ID", None),
+    "lung_cancer_codes": ("codelists/opensafely-lung-cancer.csv", "ctv3", "CTV3ID", None),
+    "haem_cancer_codes": ("codelists/opensafely-haematological-cancer.csv", "ctv3", "CTV3ID", None),
+    "other_cancer_codes": (
+        "codelists/opensafely-cancer-excluding-lung-and-haematological.csv", "ctv3", "CTV3ID", None,
+    ),
+    "ckd_codes": ("codelists/opensafely-chronic-kidney-disease.csv", "ctv3", "CTV3ID", None),
+    "organ_transplant_codes": ("codelists/opensafely-solid-organ-transplantation.csv", "ctv3", "CTV3ID", None),
+    # Medications
+    "allopurinol_codes": ("codelists/user-markdrussell-allopurinol-dmd.csv", "snomed", "dmd_id", None),
+    "febuxostat_codes": ("codelists/user-markdrussell-febuxostat-dmd.csv", "snomed", "dmd_id", None),
+    "loop_diuretics_codes": ("codelists/pincer-diur.csv", "snomed", "id", None),
+    "thiazide_diuretics_codes": ("codelists/opensafely-thiazide-type-diuretic-medication.csv", "snomed", "id", None),
+    "oral_steroids": ("codelists/nhsd-oral-steroid-drugs-pra-dmd.csv", "snomed", "dmd_id", None),
+    "nsaids": ("codelists/pincer-nsaid.csv", "snomed", "id", None),
+    "colchicine": ("codelists/user-markdrussell-colchicine-dmd.csv", "snomed", "dmd_id", None),
+    "tophi_codes": ("codelists/user-markdrussell-gouty-tophi.csv", "snomed", "code", None),
+    # Admissions
+    "gout_admission": ("codelists/user-markdrussell-gout-admissions.csv", "icd10", "code", None),
+    # Flare codes
+    "gout_flare": ("codelists/user-markdrussell-gout-flaresattacks.csv", "snomed", "code", None),
+}
+
+# name: (codes, system)
+INLINE_CODELISTS = {
+    "hba1c_new_codes": (["XaPbt", "Xaeze", "Xaezd"], "ctv3"),
+    "hba1c_old_codes": (["X772q", "XaERo", "XaERp"], "ctv3"),
+    "creatinine_codes": (["XE2q5"], "ctv3"),
+}
+
+# name: the codelists combined
+COMBINED_CODELISTS = {
+    "ult_codes": ["allopurinol_codes", "febuxostat_codes"],
+    "diuretic_codes": ["loop_diuretics_codes", "thiazide_diuretics_codes"],
+    "flare_treatment": ["oral_steroids", "nsaids", "colchicine"],
+}
+
+_loaded = {}
+
+
+def codelist_named(name):
+    if name not in _loaded:
+        if name in CSV_CODELISTS:
+            filename, system, column, category_column = CSV_CODELISTS[name]
+            codes = codelist_from_csv(filename, system=system, column=column, category_column=category_column)
+        elif name in INLINE_CODELISTS:
+            codes = codelist(*INLINE_CODELISTS[name])
+        elif name in COMBINED_CODELISTS:
+            codes = combine_codelists(*(codelist_named(part) for part in COMBINED_CODELISTS[name]))
+        else:
+            raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+        _loaded[name] = codes
+    return _loaded[name]
+
+
+def loaded_codelists():
+    return list(_loaded)
+
+
+def codelist_sources(name):
+    # The source CSV of a codelist, or the codelists it combines ([] for inline codes)
+    if name in CSV_CODELISTS:
+        return [CSV_CODELISTS[name][0]]
+    return list(COMBINED_CODELISTS.get(name, []))
+
+
+def __getattr__(name):
+    return codelist_named(name)
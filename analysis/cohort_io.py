@@ -0,0 +1,341 @@
+"""
+Reading and converting cohortextractor outputs
+
+Cohorts are extracted as feather (Arrow IPC), so dates are stored as dates, and sex, region,
+stp, ethnicity, imd and smoking_status are stored as dictionary-encoded categoricals. Readers
+can load only the columns they need. Stata cannot read feather, so each cohort is converted to
+.dta alongside it for the do-files. Dates become %td, numerically coded categories (ethnicity,
+imd) become numbers and the other categories become strings, as `import delimited` produced
+from the csv.gz outputs.
+
+Large cohorts (e.g. input_allpts) are read and written in batches of patients: the feather
+file is memory-mapped and read one record batch at a time, and each converted batch is
+appended to the .dta file, so peak memory depends on the batch size rather than the number
+of patients. The layout of the .dta is fixed before the first batch is written, from a first
+pass over the memory-mapped file (column_extents): each string column is as wide as its
+longest value in the whole file, and each integer column and date gets the smallest Stata
+integer type that holds it, as Stata's `compress` would. Missing strings are written as "", as
+Stata expects, and strings longer than 2045 bytes as strLs.
+
+The feather files are the compressed outputs (LZ4). A .dta file has no compression of its own,
+and Stata only opens uncompressed files, so narrowing the types is the compression there is:
+dates take 4 bytes instead of 8, and flags, counts and numeric categories 1 or 2.
+
+StataBatchWriter writes the format 118 file itself. DataFrame.to_stata writes a whole file from
+one DataFrame and cannot append, and writing each batch to a file of its own would leave the
+do-files to `append` the pieces, with string widths and types that differ between them.
+cohortextractor's --output-format=dta builds the whole cohort in memory too (and would mean
+extracting twice to also have the feather file the Python steps read).
+
+Usage: python analysis/cohort_io.py [--batch-size N] output/input.feather [output/measures/input_*.feather ...]
+"""
+import argparse
+import glob
+import shutil
+import struct
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.ipc
+
+# Patients per batch when streaming a cohort
+BATCH_SIZE = 100_000
+
+STATA_EPOCH = pd.Timestamp("1960-01-01")
+# Stata's system missing value (.) for doubles
+STATA_MISSING_DOUBLE = struct.unpack("<d", struct.pack("<Q", 0x7FE0000000000000))[0]
+STATA_BYTE, STATA_INT, STATA_LONG, STATA_DOUBLE, STATA_STRL = 65530, 65529, 65528, 65526, 32768
+# (numpy type, smallest value, largest value, missing value (.)) of Stata's integer types
+STATA_INTEGERS = {
+    STATA_BYTE: ("i1", -127, 100, 101),
+    STATA_INT: ("<i2", -32767, 32740, 32741),
+    STATA_LONG: ("<i4", -2147483647, 2147483620, 2147483621),
+}
+STATA_FORMATS = {STATA_BYTE: "%8.0g", STATA_INT: "%8.0g", STATA_LONG: "%12.0g", STATA_DOUBLE: "%10.0g"}
+STATA_MAX_STR = 2045
+# A strL cell is (variable, observation), as v + o * 2**16 in format 118; 0 is ""
+STRL_OBSERVATION = 2**16
+# Sections of a format 118 .dta file, in the order they are listed in its map
+STATA_SECTIONS = [
+    "stata_dta",
+    "map",
+    "variable_types",
+    "varnames",
+    "sortlist",
+    "formats",
+    "value_label_names",
+    "variable_labels",
+    "characteristics",
+    "data",
+    "strls",
+    "value_labels",
+    "/stata_dta",
+    "eof",
+]
+
+
+def read_cohort(path, columns=None):
+    return pd.read_feather(path, columns=columns)
+
+
+def read_cohort_batches(path, columns=None, batch_size=BATCH_SIZE):
+    # Yield the cohort as DataFrames of at most batch_size patients (one row per patient)
+    reader = pa.ipc.open_file(pa.memory_map(str(path)))
+    if reader.num_record_batches == 0:
+        yield reader.schema.empty_table().to_pandas()
+    for i in range(reader.num_record_batches):
+        batch = reader.get_batch(i)
+        if columns is not None:
+            batch = batch.select(columns)
+        for start in range(0, batch.num_rows, batch_size):
+            yield batch.slice(start, batch_size).to_pandas()
+
+
+def column_extents(path, columns=None):
+    """(widths, ranges) of the columns of a feather file, read one record batch at a time
+
+    widths is the longest value in bytes of each string column and ranges the (smallest,
+    largest) value of each integer column, None if it has no values.
+    """
+    reader = pa.ipc.open_file(pa.memory_map(str(path)))
+    fields = [reader.schema.field(name) for name in (columns or reader.schema.names)]
+    widths = {
+        field.name: 0 for field in fields if pa.types.is_string(field.type) or pa.types.is_large_string(field.type)
+    }
+    ranges = {field.name: None for field in fields if pa.types.is_integer(field.type)}
+    for i in range(reader.num_record_batches):
+        batch = reader.get_batch(i)
+        for name in widths:
+            widths[name] = max(widths[name], pc.max(pc.binary_length(batch.column(name))).as_py() or 0)
+        for name, extent in ranges.items():
+            low, high = pc.min_max(batch.column(name)).values()
+            if low.as_py() is not None:
+                ranges[name] = (
+                    (low.as_py(), high.as_py())
+                    if extent is None
+                    else (min(extent[0], low.as_py()), max(extent[1], high.as_py()))
+                )
+    return widths, ranges
+
+
+def integer_type(low, high):
+    # The smallest Stata integer type holding values from low to high, else double
+    for code, (_, smallest, largest, _) in STATA_INTEGERS.items():
+        if smallest <= low and high <= largest:
+            return code
+    return STATA_DOUBLE
+
+
+def to_stata_types(cohort):
+    # Column types as the do-files expect them from the csv.gz outputs
+    columns = {}
+    for name, column in cohort.items():
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            values = column.astype(object)
+            if pd.to_numeric(column.cat.categories, errors="coerce").notna().all():
+                columns[name] = pd.to_numeric(values)
+            else:
+                columns[name] = values.where(values.notna(), "")
+        elif pd.api.types.is_bool_dtype(column):
+            columns[name] = column.astype("int8")
+        elif column.dtype == object:
+            # Strings: missing values are "" in Stata
+            columns[name] = column.where(column.notna(), "")
+        else:
+            columns[name] = column
+    return pd.DataFrame(columns, index=cohort.index)
+
+
+def stata_layout(cohort, widths=None, ranges=None):
+    """(name, Stata type code, display format) for each column of a cohort written in batches
+
+    cohort is its first batch. widths and ranges are those of the whole cohort (column_extents):
+    string columns that are not categoricals and are not in widths are written as strLs, as a
+    later batch may hold a longer value than the first, and integer columns that are not in
+    ranges as doubles. The widths and ranges of categoricals come from their categories.
+    """
+    widths = widths or {}
+    ranges = ranges or {}
+    layout = []
+    for name, column in cohort.items():
+        converted = to_stata_types(cohort[[name]])[name]
+        categorical = isinstance(column.dtype, pd.CategoricalDtype)
+        if pd.api.types.is_datetime64_any_dtype(converted):
+            layout.append((name, STATA_LONG, "%td"))
+        elif converted.dtype == "int8":
+            layout.append((name, STATA_BYTE, STATA_FORMATS[STATA_BYTE]))
+        elif categorical and pd.api.types.is_numeric_dtype(converted):
+            codes = pd.to_numeric(column.cat.categories)
+            whole = len(codes) and (codes == np.round(codes)).all()
+            code = integer_type(codes.min(), codes.max()) if whole else STATA_DOUBLE
+            layout.append((name, code, STATA_FORMATS[code]))
+        elif name in ranges or pd.api.types.is_numeric_dtype(converted):
+            code = integer_type(*ranges[name]) if ranges.get(name) else STATA_DOUBLE
+            layout.append((name, code, STATA_FORMATS[code]))
+        elif not categorical and name not in widths:
+            layout.append((name, STATA_STRL, "%9s"))
+        else:
+            if categorical:
+                width = int(column.cat.categories.astype(str).str.encode("utf-8").str.len().max() or 0)
+            else:
+                width = widths[name]
+            # Columns of only missing values get the narrowest string type
+            width = max(1, width)
+            if width > STATA_MAX_STR:
+                layout.append((name, STATA_STRL, "%9s"))
+            else:
+                layout.append((name, width, f"%{width}s"))
+    return layout
+
+
+class StataBatchWriter:
+    """Write a format 118 .dta file one batch at a time
+
+    The layout (stata_layout) is fixed when the file is opened; the observation count and section
+    map are filled in when the file is closed. The strLs (which follow the data) are kept in a temporary
+    file until then.
+    """
+
+    def __init__(self, path, layout):
+        self.layout = layout
+        self.rows = 0
+        self.offsets = {}
+        self.file = open(path, "wb")
+        self.strls = tempfile.TemporaryFile()
+        types = {
+            **{code: numpy_type for code, (numpy_type, _, _, _) in STATA_INTEGERS.items()},
+            STATA_DOUBLE: "<f8",
+            STATA_STRL: "<u8",
+        }
+        self.record = np.dtype([(name, types.get(code, f"S{code}")) for name, code, _ in layout])
+        self._write_metadata()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _mark(self, section, tag=True):
+        self.offsets[section] = self.file.tell()
+        if tag:
+            self.file.write(f"<{section}>".encode())
+
+    def _write_metadata(self):
+        names = [name for name, _, _ in self.layout]
+        timestamp = datetime.now().strftime("%d %b %Y %H:%M").encode()
+        self._mark("stata_dta")
+        self.file.write(b"<header><release>118</release><byteorder>LSF</byteorder>")
+        self.file.write(b"<K>" + struct.pack("<H", len(names)) + b"</K><N>")
+        self.n_offset = self.file.tell()
+        self.file.write(struct.pack("<Q", 0) + b"</N>")
+        self.file.write(b"<label>" + struct.pack("<H", 0) + b"</label>")
+        self.file.write(b"<timestamp>" + struct.pack("<B", len(timestamp)) + timestamp)
+        self.file.write(b"</timestamp></header>")
+        self._mark("map")
+        self.map_offset = self.file.tell()
+        self.file.write(struct.pack("<14Q", *[0] * 14) + b"</map>")
+        self._mark("variable_types")
+        self.file.write(struct.pack(f"<{len(names)}H", *[code for _, code, _ in self.layout]))
+        self.file.write(b"</variable_types>")
+        self._write_fixed("varnames", names, 129)
+        self._mark("sortlist")
+        self.file.write(struct.pack(f"<{len(names) + 1}H", *[0] * (len(names) + 1)))
+        self.file.write(b"</sortlist>")
+        self._write_fixed("formats", [fmt for _, _, fmt in self.layout], 57)
+        self._write_fixed("value_label_names", [""] * len(names), 129)
+        self._write_fixed("variable_labels", [""] * len(names), 321)
+        self._mark("characteristics")
+        self.file.write(b"</characteristics>")
+        self._mark("data")
+
+    def _write_fixed(self, section, values, width):
+        self._mark(section)
+        for value in values:
+            self.file.write(value.encode("utf-8").ljust(width, b"\0"))
+        self.file.write(f"</{section}>".encode())
+
+    def write(self, batch):
+        batch = to_stata_types(batch)
+        records = np.empty(len(batch), dtype=self.record)
+        for variable, (name, code, _) in enumerate(self.layout, start=1):
+            column = batch[name]
+            if pd.api.types.is_datetime64_any_dtype(column):
+                column = (column - STATA_EPOCH).dt.days
+            if code in STATA_INTEGERS:
+                records[name] = column.astype(float).fillna(STATA_INTEGERS[code][3]).to_numpy()
+            elif code == STATA_DOUBLE:
+                records[name] = column.astype(float).fillna(STATA_MISSING_DOUBLE).to_numpy()
+            elif code == STATA_STRL:
+                records[name] = self._write_strls(variable, column.astype(str).str.encode("utf-8"))
+            else:
+                encoded = column.astype(str).str.encode("utf-8")
+                if len(encoded) and encoded.str.len().max() > code:
+                    raise ValueError(f"{name}: value longer than the {code} bytes of its layout")
+                records[name] = encoded.to_numpy()
+        self.file.write(records.tobytes())
+        self.rows += len(batch)
+
+    def _write_strls(self, variable, encoded):
+        # (v, o) cells of a batch of a strL column, and its non-empty strings as GSO entries
+        cells = np.zeros(len(encoded), dtype="<u8")
+        for i, value in enumerate(encoded):
+            if value:
+                observation = self.rows + i + 1
+                cells[i] = variable + observation * STRL_OBSERVATION
+                self.strls.write(b"GSO" + struct.pack("<IQBI", variable, observation, 130, len(value) + 1))
+                self.strls.write(value + b"\0")
+        return cells
+
+    def close(self):
+        self.file.write(b"</data>")
+        self._mark("strls")
+        self.strls.seek(0)
+        shutil.copyfileobj(self.strls, self.file)
+        self.strls.close()
+        self.file.write(b"</strls>")
+        self._mark("value_labels")
+        self.file.write(b"</value_labels>")
+        self._mark("/stata_dta", tag=False)
+        self.file.write(b"</stata_dta>")
+        self._mark("eof", tag=False)
+        self.file.seek(self.n_offset)
+        self.file.write(struct.pack("<Q", self.rows))
+        self.file.seek(self.map_offset)
+        self.file.write(struct.pack("<14Q", *[self.offsets[section] for section in STATA_SECTIONS]))
+        self.file.close()
+
+
+def write_stata_batches(batches, path, widths=None, ranges=None):
+    # Write an iterable of DataFrames with the same columns to one .dta file, with the widths
+    # and ranges of the whole cohort where they are known (see stata_layout)
+    batches = iter(batches)
+    first = next(batches)
+    with StataBatchWriter(path, stata_layout(first, widths, ranges)) as writer:
+        writer.write(first)
+        for batch in batches:
+            writer.write(batch)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("inputs", nargs="+", help="feather files or glob patterns")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    for pattern in args.inputs:
+        for path in sorted(glob.glob(pattern)):
+            write_stata_batches(
+                read_cohort_batches(path, batch_size=args.batch_size),
+                Path(path).with_suffix(".dta"),
+                *column_extents(path),
+            )
+
+
+if __name__ == "__main__":
+    main()
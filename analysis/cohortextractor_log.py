@@ -0,0 +1,175 @@
+"""
+Read the log of a cohortextractor run
+
+generate_cohort logs every SQL query it runs through cohortextractor's log_utils: a
+"cohortextractor-stats" line when a query starts and when it stops (timing_id, description, state,
+execution_time_secs), one with the SQL itself and, with SQL Server timing statistics on, a
+"sqlserver-stats" line with the server's CPU and elapsed time. The description is the comment
+the query starts with: "Uploading codelist for <variable>" and "Query for <variable>" for the
+queries of a variable, "Join all columns for final output" and so on for the rest. The INSERTs
+of a codelist and the index on each variable's table have no description, and belong to the
+query before them; with a temporary database the final query has none either, and belongs to the
+"Writing results into temporary table" message before it. The job runner keeps the output of an
+action in metadata/<action>.log, e.g. metadata/generate_study_population.log.
+
+QueryLog reads such a log line by line into the queries it ran, each charged to its variable, so
+that the production extraction can be traced (extraction_trace.py --log) and followed while it
+runs (extraction_progress.py) without changing the cohortextractor action.
+"""
+import ast
+import re
+
+# structlog's console output, with or without colours
+ANSI = re.compile(r"\x1b\[[0-9;]*m")
+LINE = re.compile(
+    r"^(?P<time>\d{4}-\d\d-\d\d \d\d:\d\d:\d\d) \[(?P<level>\w+)\s*\] (?P<event>.*?)\s*"
+    r"\[(?P<logger>[\w.]+)\]\s*(?P<fields>.*)$"
+)
+FIELD = re.compile(r"(\w+)=('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|\S*)")
+VARIABLE_QUERY = re.compile(r"^(?:Query|Uploading codelist) for (\w+)$")
+DOWNLOADED = re.compile(r"^Downloaded (\d+) results$")
+# Messages before the queries that write and download the output; with a temporary database the
+# final query has no description of its own
+OUTPUT_MESSAGES = ("Writing results into", "Downloading results from")
+# Timings of the whole run rather than of a query
+RUN_DESCRIPTION = "generate_cohort"
+# Variables that are expressions over other variables' tables rather than tables of their own, as in
+# TPPBackend.get_queries
+NO_TABLE_QUERIES = {"fixed_value", "categorised_as", "value_from", "aggregate_of"}
+
+
+def parse_value(value):
+    # Values are written with repr() unless they are a plain word or number
+    if value[:1] in ("'", '"') or value in ("None", "True", "False"):
+        return ast.literal_eval(value)
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    return value
+
+
+def parse_line(line):
+    # {time, level, event, logger, fields} of a line of the log, None for other output (tracebacks)
+    match = LINE.match(ANSI.sub("", line).rstrip("\n"))
+    if match is None:
+        return None
+    entry = match.groupdict()
+    entry["fields"] = {key: parse_value(value) for key, value in FIELD.findall(entry["fields"])}
+    return entry
+
+
+class QueryLog:
+    """The queries of a cohortextractor log, in the order they finished, read line by line
+
+    Each query is {timing_id, description, variable, sql, started, finished, seconds, state,
+    server_cpu_seconds, server_elapsed_seconds}; variable is None for the queries that are not
+    part of a variable (description is then that of the last query that had one).
+    """
+
+    def __init__(self):
+        self.queries = []
+        self.running = {}
+        self.by_timing_id = {}
+        self.description = None
+        self.variable = None
+        self.variable_count = None
+        self.patients_downloaded = 0
+        self.downloading_started = None
+        self.downloaded_at = None
+        self.updated = None
+        self.started = None
+        self.finished = None
+        self.state = None
+
+    def read(self, lines):
+        for line in lines:
+            self.read_line(line)
+        return self
+
+    def read_line(self, line):
+        entry = parse_line(line)
+        if entry is None:
+            return
+        fields = entry["fields"]
+        self.updated = entry["time"]
+        if entry["event"] == "cohortextractor-stats":
+            if "variable_count" in fields:
+                self.variable_count = fields["variable_count"]
+            elif fields.get("description") == RUN_DESCRIPTION:
+                if fields.get("timing") == "start":
+                    self.started = entry["time"]
+                else:
+                    self.finished, self.state = entry["time"], fields.get("state")
+            elif fields.get("timing") == "start":
+                self.start(entry["time"], fields)
+            elif fields.get("timing") == "stop":
+                self.stop(entry["time"], fields)
+            elif "sql" in fields and fields.get("timing_id") in self.running:
+                self.running[fields["timing_id"]]["sql"] = fields["sql"]
+        elif entry["event"] == "sqlserver-stats" and fields.get("timing_id") in self.by_timing_id:
+            # Logged as the server sends them, which can be after the query's stop line
+            query = self.by_timing_id[fields["timing_id"]]
+            for key, field in (
+                ("server_cpu_seconds", "cpu_time_secs"),
+                ("server_elapsed_seconds", "elapsed_time_secs"),
+            ):
+                query[key] = (query[key] or 0) + fields.get(field, 0)
+        elif entry["event"].startswith(OUTPUT_MESSAGES):
+            self.description, self.variable = entry["event"], None
+        else:
+            match = DOWNLOADED.match(entry["event"])
+            if match:
+                if self.downloading_started is None:
+                    # Downloading starts when the output query finishes
+                    self.downloading_started = self.queries[-1]["finished"] if self.queries else entry["time"]
+                self.patients_downloaded, self.downloaded_at = int(match.group(1)), entry["time"]
+
+    def start(self, time, fields):
+        description = fields.get("description")
+        if description is not None:
+            match = VARIABLE_QUERY.match(description)
+            self.description = description
+            self.variable = match.group(1) if match else None
+        query = {
+            "timing_id": fields["timing_id"],
+            "description": self.description,
+            "variable": self.variable,
+            "sql": None,
+            "started": time,
+            "finished": None,
+            "seconds": None,
+            "state": "started",
+            "server_cpu_seconds": None,
+            "server_elapsed_seconds": None,
+        }
+        self.running[query["timing_id"]] = self.by_timing_id[query["timing_id"]] = query
+
+    def stop(self, time, fields):
+        query = self.running.pop(fields["timing_id"], None)
+        if query is None:
+            return
+        query.update(finished=time, seconds=fields.get("execution_time_secs"), state=fields.get("state"))
+        self.queries.append(query)
+
+    def variables_done(self):
+        # Variables whose table has been written ("Query for <variable>" has finished)
+        return len(
+            {
+                query["variable"]
+                for query in self.queries
+                if query["variable"] and query["description"].startswith("Query for")
+            }
+        )
+
+    def variables(self):
+        # Names of the variables with a query so far, in the order they started
+        names = {query["variable"]: None for query in [*self.queries, *self.running.values()]}
+        names.pop(None, None)
+        return list(names)
+
+
+def table_variables(covariate_definitions):
+    # Names of the variables that cohortextractor runs a query for
+    return [name for name, (query_type, args) in covariate_definitions.items() if query_type not in NO_TABLE_QUERIES]
@@ -0,0 +1,451 @@
+"""
+Fast, ordered dummy data for a study definition
+
+cohortextractor generates dummy data one column at a time from return_expectations, takes
+about 90s for 300,000 patients, and ignores the windows that link variables. So
+urate_test_2_date can come before urate_test_1_date, and gout_admission_3 before
+gout_admission_1, which breaks the reshapes in the do-files. Here each column is drawn as a
+whole with NumPy, in dependency order (analysis/study_plan.py). Dates are drawn within each
+patient's window: between / on_or_before / on_or_after (e.g. ["urate_test_1_date + 1 day",
+"gout_code_date + 1 year"]) intersected with the expected earliest/latest dates. A match in a
+chain therefore always falls after the previous match, and it is missing if the previous one
+is. The population expression is evaluated, and patients outside it are dropped. Other
+categorised_as variables use their expected ratios, as in cohortextractor. Generation is
+seeded, so the same seed gives the same cohort, and runs in batches of patients, so memory
+does not grow with the population size.
+
+Usage (from the repository root):
+
+    python analysis/dummy_data.py study_definition --population-size 3000000 --output output/input.feather
+
+The output can also be passed to cohortextractor with --dummy-data-file.
+"""
+import argparse
+import functools
+import operator
+import os
+import re
+from datetime import date
+from pathlib import Path
+
+import cohortextractor
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc
+from cohortextractor.study_definition import merge
+
+from cohort_io import BATCH_SIZE
+from study_plan import dependency_graph, levels, load_study
+
+POPULATION_SIZE = 300_000
+SEED = 2023
+# Batches in a row in which the population expression may select no patient before giving up
+MAX_EMPTY_BATCHES = 10
+DATE_EXPRESSION = re.compile(
+    r"^\s*(?P<base>\d{4}-\d\d-\d\d|\w+)\s*"
+    r"(?:(?P<sign>[+-])\s*(?P<count>\d+)\s*(?P<unit>day|month|year)s?)?\s*$"
+)
+EXPRESSION_TOKEN = re.compile(r"\s*(>=|<=|!=|=|<|>|\(|\)|'[^']*'|\"[^\"]*\"|[\w.]+|[*/+-])")
+COMPARISON = {
+    ">=": operator.ge,
+    "<=": operator.le,
+    "!=": operator.ne,
+    "=": operator.eq,
+    "<": operator.lt,
+    ">": operator.gt,
+}
+ARITHMETIC = {"*": operator.mul, "/": operator.truediv, "+": operator.add, "-": operator.sub}
+# Value of a column when a patient has no match, as in cohortextractor
+EMPTY = {"bool": False, "int": 0, "float": 0.0}
+
+
+# Dates are held as float days since 1970-01-01 (NaN when missing), so bounds and offsets are
+# plain arithmetic and a missing bound makes the whole window missing
+def to_days(iso_date):
+    return float(np.datetime64(iso_date, "D").astype("int64"))
+
+
+def civil_from_days(days):
+    # (year, month, day) of int64 day numbers (proleptic Gregorian calendar)
+    z = days + 719468
+    era = z // 146097
+    day_of_era = z - era * 146097
+    year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524 - day_of_era // 146096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 - year_of_era // 100)
+    shifted_month = (5 * day_of_year + 2) // 153
+    day = day_of_year - (153 * shifted_month + 2) // 5 + 1
+    month = np.where(shifted_month < 10, shifted_month + 3, shifted_month - 9)
+    return year_of_era + era * 400 + (month <= 2), month, day
+
+
+def days_from_civil(year, month, day):
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * np.where(month > 2, month - 3, month + 9) + 2) // 5 + day - 1
+    return era * 146097 + year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year - 719468
+
+
+def add_to_days(days, count, unit):
+    # Months and years are added with the day clamped to the end of the month, as DATEADD does
+    if unit == "day":
+        return days + count
+    missing = np.isnan(days)
+    year, month, day = civil_from_days(np.nan_to_num(days).astype("int64"))
+    months = year * 12 + month - 1 + count * (12 if unit == "year" else 1)
+    year, month = months // 12, months % 12 + 1
+    month_length = days_from_civil(year + (month == 12), month % 12 + 1, 1) - days_from_civil(year, month, 1)
+    shifted = days_from_civil(year, month, np.minimum(day, month_length)).astype(float)
+    shifted[missing] = np.nan
+    return shifted
+
+
+def resolve_date(expression, columns, index_date=None):
+    # Date expression as per-patient days (a column, optionally shifted) or a single day number
+    if expression is None:
+        return None
+    match = DATE_EXPRESSION.match(expression)
+    if match is None:
+        raise ValueError(f"Unsupported date expression: {expression!r}")
+    base = match.group("base")
+    if base == "today":
+        base = date.today().isoformat()
+    elif base == "index_date":
+        base = index_date
+    days = columns[base] if base in columns else np.array([to_days(base)])
+    if match.group("count"):
+        count = int(match.group("count")) * (1 if match.group("sign") == "+" else -1)
+        days = add_to_days(days, count, match.group("unit"))
+    return days if base in columns else days[0]
+
+
+def truthy(values):
+    if values.dtype.kind == "f":
+        return ~np.isnan(values) & (values != 0)
+    if values.dtype.kind == "O":
+        return pd.notna(values) & (values != "")
+    return values != 0
+
+
+def evaluate_expression(expression, columns):
+    """Evaluate a satisfying/categorised_as expression over the columns, as a boolean array
+
+    Supports AND, OR, NOT, parentheses, comparisons (=, !=, <, <=, >, >=) between columns,
+    numbers and quoted strings, arithmetic on numbers (* / + -), and bare columns (true where
+    the value is not empty, as in SQL).
+    """
+    tokens = EXPRESSION_TOKEN.findall(expression)
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def take(expected=None):
+        nonlocal position
+        token = peek()
+        if token is None or (expected is not None and token != expected):
+            raise ValueError(f"Unsupported expression {expression!r}: expected {expected or 'a value'} at {token!r}")
+        position += 1
+        return token
+
+    def disjunction():
+        result = conjunction()
+        while peek() == "OR":
+            take()
+            result = result | conjunction()
+        return result
+
+    def conjunction():
+        result = negation()
+        while peek() == "AND":
+            take()
+            result = result & negation()
+        return result
+
+    def negation():
+        if peek() == "NOT":
+            take()
+            return ~negation()
+        if peek() == "(":
+            take()
+            result = disjunction()
+            take(")")
+            return result
+        left = arithmetic()
+        if peek() not in COMPARISON:
+            return truthy(np.asarray(left))
+        compare = COMPARISON[take()]
+        return np.asarray(compare(left, arithmetic()), dtype=bool)
+
+    def arithmetic():
+        result = product()
+        while peek() in ("+", "-"):
+            result = ARITHMETIC[take()](result, product())
+        return result
+
+    def product():
+        result = value()
+        while peek() in ("*", "/"):
+            result = ARITHMETIC[take()](result, value())
+        return result
+
+    def value():
+        token = take()
+        if token[0] in "'\"":
+            return token[1:-1]
+        if token in columns:
+            return columns[token]
+        try:
+            return float(token)
+        except ValueError:
+            raise ValueError(f"Unknown column {token!r} in expression {expression!r}") from None
+
+    with np.errstate(invalid="ignore"):
+        result = disjunction()
+    if peek() is not None:
+        raise ValueError(f"Unsupported expression {expression!r}: unexpected {peek()!r}")
+    return np.asarray(result, dtype=bool)
+
+
+def age_probabilities(max_age=110):
+    # Probability of each age from 0 to max_age - 1, from the UK population bands cohortextractor uses
+    path = Path(os.path.dirname(cohortextractor.__file__)) / "uk_population_bands_2018.csv"
+    bands = pd.read_csv(path, thousands=",")
+    band_end = bands["band"].str.split("-").str[-1].astype(int)
+    counts = bands["range"].to_numpy()[np.searchsorted(band_end.to_numpy(), np.arange(max_age))]
+    return counts / counts.sum()
+
+
+AGE_PROBABILITIES = age_probabilities()
+
+
+def category_labels(name, query_type, args, expectations):
+    # Possible values of a str column, so that every batch has the same categories
+    if query_type == "categorised_as" and (name == "population" or "category" not in expectations):
+        return [str(category) for category in args["category_definitions"]]
+    ratios = (expectations.get("category") or {}).get("ratios")
+    if ratios is None:
+        # Categories of the codelist, e.g. for most_recent_smoking_code
+        codelist = args.get("codelist") or []
+        ratios = {code[1]: 1 for code in codelist if isinstance(code, tuple)}
+    return [str(label) for label in ratios]
+
+
+class DummyCohort:
+    """Generate the columns of a study definition for size patients"""
+
+    def __init__(self, study, expectations, labels, size, rng):
+        self.study = study
+        self.expectations = expectations
+        self.labels = labels
+        self.size = size
+        self.rng = rng
+        self.columns = {}
+        # Category codes of str columns (-1 when missing)
+        self.codes = {}
+        self.match_dates = {}
+        self.resolved = {}
+
+    def resolve(self, expression):
+        # Expressions are resolved once, after the columns they refer to have been generated
+        if expression not in self.resolved:
+            self.resolved[expression] = resolve_date(expression, self.columns, self.study.index_date)
+        return self.resolved[expression]
+
+    def window(self, args, expectations):
+        # Earliest and latest possible day of a match for each patient (NaN if none is possible)
+        between = args.get("between") or (None, None)
+        expected = expectations.get("date") or {}
+        low = [
+            self.resolve(args.get("on_or_after") or args.get("start_date") or between[0]),
+            self.resolve(expected.get("earliest", "1900-01-01")),
+        ]
+        high = [
+            self.resolve(
+                args.get("on_or_before")
+                or args.get("end_date")
+                or args.get("reference_date")
+                or args.get("date")
+                or between[1]
+            ),
+            self.resolve(expected.get("latest", "today")),
+        ]
+        low = np.broadcast_to(functools.reduce(np.maximum, [bound for bound in low if bound is not None]), self.size)
+        high = np.broadcast_to(functools.reduce(np.minimum, [bound for bound in high if bound is not None]), self.size)
+        return np.where(low <= high, low, np.nan), high
+
+    def present(self, expectations):
+        # Patients who have a value, from the incidence (all of them for a universal rate)
+        if expectations.get("rate") == "universal":
+            return np.ones(self.size, dtype=bool)
+        return self.rng.random(self.size) < expectations.get("incidence", 1)
+
+    def dates(self, low, high, rate):
+        span = high - low
+        if rate == "exponential_increase":
+            offsets = span - np.minimum(self.rng.exponential(0.1, self.size) * span, span)
+        else:
+            offsets = self.rng.random(self.size) * (span + 1)
+        return low + np.floor(offsets)
+
+    def numbers(self, spec, kind):
+        distribution = spec["distribution"]
+        if distribution == "normal":
+            values = self.rng.normal(spec["mean"], spec["stddev"], self.size)
+        elif distribution == "poisson":
+            values = self.rng.poisson(spec["mean"], self.size)
+        elif distribution == "population_ages":
+            values = self.rng.choice(len(AGE_PROBABILITIES), self.size, p=AGE_PROBABILITIES)
+        else:
+            raise ValueError(f"Unsupported distribution: {distribution}")
+        return values.astype("int64") if kind == "int" else values
+
+    def set_categories(self, name, codes):
+        self.codes[name] = codes
+        labels = np.array(self.labels[name] + [None], dtype=object)
+        self.columns[name] = labels[codes]
+
+    def generate(self, name, query_type, args):
+        column_type = args["column_type"]
+        expectations = self.expectations[name]
+        if query_type == "value_from":
+            self.columns[name] = self.match_dates[args["source"]]
+            return
+        if query_type == "categorised_as" and (name == "population" or "category" not in expectations):
+            # Index of the first category whose expression is true, then the DEFAULT category
+            categories = list(args["category_definitions"].items())
+            codes = np.full(self.size, -1)
+            for i, (category, expression) in enumerate(categories):
+                if expression.strip() != "DEFAULT":
+                    codes[(codes == -1) & evaluate_expression(expression, self.columns)] = i
+            default = [i for i, (_, expression) in enumerate(categories) if expression.strip() == "DEFAULT"]
+            if default:
+                codes[codes == -1] = default[0]
+            if column_type == "bool":
+                values = np.array([bool(category) for category, _ in categories] + [False])
+                self.columns[name] = values[codes]
+            else:
+                self.set_categories(name, codes)
+            return
+
+        # Patients with a match, on a day within their window
+        low, high = self.window(args, expectations)
+        matched = self.present(expectations) & ~np.isnan(low)
+        match_date = self.dates(np.where(matched, low, np.nan), high, expectations.get("rate"))
+        if args.get("include_date_of_match") or args.get("include_measurement_date"):
+            self.match_dates[name] = match_date
+        if column_type == "date":
+            self.columns[name] = match_date
+        elif column_type == "bool":
+            self.columns[name] = matched
+        elif column_type in ("int", "float"):
+            spec = expectations.get(column_type) or {"distribution": "poisson", "mean": 1}
+            self.columns[name] = np.where(matched, self.numbers(spec, column_type), EMPTY[column_type])
+        else:
+            ratios = (expectations.get("category") or {}).get("ratios")
+            if ratios:
+                probabilities = np.array(list(ratios.values()), dtype=float)
+                codes = self.rng.choice(len(ratios), self.size, p=probabilities / probabilities.sum())
+            elif self.labels[name]:
+                codes = self.rng.integers(len(self.labels[name]), size=self.size)
+            else:
+                codes = np.full(self.size, -1)
+            self.set_categories(name, np.where(matched, codes, -1))
+
+
+def date_column(days, date_format=None):
+    # Float days as datetime64[ns], truncated to the month or year as date_format asks
+    dates = np.nan_to_num(days).astype("int64").astype("datetime64[D]")
+    if date_format == "YYYY-MM":
+        dates = dates.astype("datetime64[M]")
+    elif date_format == "YYYY":
+        dates = dates.astype("datetime64[Y]")
+    dates = dates.astype("datetime64[ns]")
+    dates[np.isnan(days)] = np.datetime64("NaT")
+    return dates
+
+
+def to_frame(cohort, covariate_definitions):
+    # Output columns in definition order, typed as cohortextractor writes them to feather
+    frame = {}
+    for name, (query_type, args) in covariate_definitions.items():
+        if name == "population" or args["hidden"]:
+            continue
+        values = cohort.columns[name]
+        if args["column_type"] == "date":
+            frame[name] = date_column(values, args.get("date_format"))
+        elif args["column_type"] == "str":
+            frame[name] = pd.Categorical.from_codes(cohort.codes[name], categories=cohort.labels[name])
+        else:
+            frame[name] = values
+    frame = pd.DataFrame(frame, index=pd.RangeIndex(cohort.size))
+    if "population" in cohort.columns:
+        frame = frame[cohort.columns["population"]]
+    return frame
+
+
+def generate_batches(study, size=POPULATION_SIZE, seed=SEED, batch_size=BATCH_SIZE):
+    # Yield the dummy cohort in batches, generating batch_size patients at a time until the
+    # population has size patients
+    definitions = study.covariate_definitions
+    order = [name for level in levels(dependency_graph(definitions)) for name in level]
+    expectations = {
+        name: merge(dict(study.default_expectations or {}), args.get("return_expectations") or {})
+        for name, (query_type, args) in definitions.items()
+    }
+    labels = {
+        name: category_labels(name, query_type, args, expectations[name])
+        for name, (query_type, args) in definitions.items()
+        if args["column_type"] == "str"
+    }
+    rng = np.random.default_rng(seed)
+    total = 0
+    empty_batches = 0
+    while total < size:
+        cohort = DummyCohort(study, expectations, labels, batch_size, rng)
+        for name in order:
+            query_type, args = definitions[name]
+            cohort.generate(name, query_type, args)
+        batch = to_frame(cohort, definitions).iloc[: size - total]
+        batch["patient_id"] = np.arange(total + 1, total + len(batch) + 1, dtype="int64")
+        empty_batches = 0 if len(batch) else empty_batches + 1
+        if empty_batches == MAX_EMPTY_BATCHES:
+            raise ValueError(
+                f"The population selected none of the last {MAX_EMPTY_BATCHES * batch_size} dummy patients: "
+                "check the population expression and the return_expectations of the variables it uses"
+            )
+        total += len(batch)
+        yield batch.reset_index(drop=True)
+
+
+def write_feather_batches(batches, path):
+    batches = iter(batches)
+    first = pa.Table.from_pandas(next(batches), preserve_index=False)
+    options = pa.ipc.IpcWriteOptions(compression="lz4")
+    with pa.ipc.new_file(str(path), first.schema, options=options) as writer:
+        writer.write_table(first)
+        for batch in batches:
+            writer.write_table(pa.Table.from_pandas(batch, schema=first.schema, preserve_index=False))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("study_definition")
+    parser.add_argument("--population-size", type=int, default=POPULATION_SIZE)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--index-date")
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    study = load_study(args.study_definition, args.index_date)
+    output = args.output or f"output/{args.study_definition.replace('study_definition', 'input')}.feather"
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    write_feather_batches(
+        generate_batches(study, args.population_size, args.seed, args.batch_size), output
+    )
+
+
+if __name__ == "__main__":
+    main()
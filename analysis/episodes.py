@@ -0,0 +1,46 @@
+"""
+Collapsing repeated events into episodes
+
+An event starts a new episode if it is at least `gap` days after the start of the patient's
+previous episode; events in between belong to that episode. This is the rule for flares
+("events within 14 days of one another are not counted as new flares"): an event 10 days after
+a flare is part of it, and one 20 days after the flare is a new flare, whatever happened in
+between, so a chain of events each less than `gap` days apart can hold several episodes.
+
+Events are given as arrays sorted by (patient, day). The start of the episode after each event
+is found for every event at once with a binary search, and the episodes are followed from each
+patient's first event one step at a time for all patients together, so the number of passes is
+the largest number of episodes of any patient rather than the number of events.
+"""
+import numpy as np
+
+
+def episode_starts(patients, days, gap):
+    """Mask of the events that start an episode
+
+    patients and days (integers) must be sorted by patient, then day.
+    """
+    patients, days = np.asarray(patients), np.asarray(days, dtype=np.int64)
+    if len(days) == 0:
+        return np.zeros(0, dtype=bool)
+    first = np.r_[True, patients[1:] != patients[:-1]]
+    # Events as one increasing key, with the patients far enough apart that adding gap to a day
+    # never reaches the next patient's events
+    span = int(days.max() - days.min()) + gap + 1
+    keys = np.cumsum(first).astype(np.int64) * span + (days - days.min())
+    # Index of the first event at least gap days after each event, if it is the same patient's
+    following = np.maximum(np.searchsorted(keys, keys + gap), np.arange(1, len(keys) + 1))
+    following[(following == len(keys)) | first[np.minimum(following, len(keys) - 1)]] = len(keys)
+    starts = first.copy()
+    current = np.flatnonzero(first)
+    while len(current):
+        current = following[current]
+        current = current[current < len(keys)]
+        starts[current] = True
+    return starts
+
+
+def count_episodes(patients, days, gap):
+    # (patients with events, their number of episodes), from arrays sorted by (patient, day)
+    starts = episode_starts(patients, days, gap)
+    return np.unique(np.asarray(patients)[starts], return_counts=True)
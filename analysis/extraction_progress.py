@@ -0,0 +1,230 @@
+"""
+Progress, throughput and ETA of a long extraction
+
+A line is printed to stderr every few seconds (--interval) with the variables completed out of the
+total, the patients written, patients per second, bytes written and an estimate of the time
+left. The same figures are kept in a JSON status file, which is rewritten atomically at every
+report, so that a scheduler can read it at any time:
+
+    {"stage": "variables", "variables_done": 41, "variables_total": 65, "patients_written": 0,
+     "patients_total": null, "bytes_written": null, "patients_per_second": null,
+     "elapsed_seconds": 62.1, "eta_seconds": 57.5, "updated": "2024-03-01T10:00:00", ...}
+
+The production extraction (the cohortextractor generate_cohort actions) is followed through its
+log (cohortextractor_log.py), as the job runner writes it or as docker streams it:
+
+    python analysis/extraction_progress.py metadata/generate_study_population.log \
+        --study-definition study_definition --status-file generate_study_population.status.json --follow
+    docker logs -f <container> 2>&1 | python analysis/extraction_progress.py - --study-definition study_definition
+
+There a variable is done when its table has been written, the total is the number of variables
+that have a table of their own, the patients written are those downloaded so far (logged every
+million) and the bytes written are unknown. "log_updated" is the time of the last line of the log
+and "running" the query being run, so a status whose "updated" moves on while "log_updated" stays
+put points at a slow query, and the query itself.
+
+Local runs (analysis/local_backend.py --progress, --progress-interval) count variables and
+written batches in the process and report the bytes written; their status file is
+<output>.status.json by default.
+
+Reports are also made when nothing has finished since the last one, so a status file whose
+counts stop changing while "updated" moves on means a stalled variable or writer, and one whose
+"updated" stops moving means a dead process. The ETA assumes the remaining variables take as long
+on average as the completed ones, and the remaining patients are written at the current rate.
+"""
+import argparse
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from cohortextractor_log import QueryLog, table_variables
+from study_plan import load_study
+
+INTERVAL = 10.0
+LOG_TIME = "%Y-%m-%d %H:%M:%S"
+
+
+def report(status, status_path=None, stream=sys.stderr):
+    eta = "?" if status["eta_seconds"] is None else f"{status['eta_seconds']:.0f}s"
+    rate = "" if status["patients_per_second"] is None else f" ({status['patients_per_second']:.0f}/s)"
+    written = "" if status["bytes_written"] is None else f", {status['bytes_written'] / 1024**2:.1f} MiB"
+    print(
+        f"[{status['elapsed_seconds']:.0f}s] {status['stage']}: "
+        f"{status['variables_done']}/{status['variables_total']} variables, "
+        f"{status['patients_written']} patients written{rate}{written}, ETA {eta}",
+        file=stream,
+    )
+    if status_path is not None:
+        status_path = Path(status_path)
+        tmp = status_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(status, indent=1))
+        os.replace(tmp, status_path)
+
+
+class Progress:
+    """Count completed variables and written patients, reporting them periodically"""
+
+    def __init__(self, variables_total, status_path=None, interval=INTERVAL, stream=sys.stderr):
+        self.variables_total = variables_total
+        self.status_path = Path(status_path) if status_path else None
+        self.interval = interval
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.stage = "variables"
+        self.variables_done = 0
+        self.writing_started = None
+        self.patients_written = 0
+        self.patients_total = None
+        self.bytes_written = 0
+        self.stopped = threading.Event()
+        self.reporter = threading.Thread(target=self._report_periodically, daemon=True)
+        self.reporter.start()
+
+    def wrap(self, evaluate):
+        return functools.partial(self._counted, evaluate)
+
+    def _counted(self, evaluate, name, definition, inputs):
+        result = evaluate(name, definition, inputs)
+        with self.lock:
+            self.variables_done += 1
+        return result
+
+    def writing(self, patients_total):
+        with self.lock:
+            self.stage = "writing"
+            self.writing_started = time.perf_counter()
+            self.patients_total = patients_total
+        self.report()
+
+    def written(self, patients, bytes_written):
+        with self.lock:
+            self.patients_written += patients
+            self.bytes_written = bytes_written
+
+    def status(self):
+        with self.lock:
+            now = time.perf_counter()
+            elapsed = now - self.started
+            patients_per_second = None
+            eta = None
+            if self.stage == "variables" and self.variables_done:
+                eta = elapsed / self.variables_done * (self.variables_total - self.variables_done)
+            elif self.stage == "writing":
+                writing_seconds = now - self.writing_started
+                if self.patients_written and writing_seconds > 0:
+                    patients_per_second = self.patients_written / writing_seconds
+                    eta = (self.patients_total - self.patients_written) / patients_per_second
+            elif self.stage == "done":
+                eta = 0.0
+            return {
+                "stage": self.stage,
+                "variables_done": self.variables_done,
+                "variables_total": self.variables_total,
+                "patients_written": self.patients_written,
+                "patients_total": self.patients_total,
+                "bytes_written": self.bytes_written,
+                "patients_per_second": round(patients_per_second, 1) if patients_per_second else None,
+                "elapsed_seconds": round(elapsed, 1),
+                "eta_seconds": round(eta, 1) if eta is not None else None,
+                "updated": datetime.now().isoformat(timespec="seconds"),
+                "pid": os.getpid(),
+            }
+
+    def report(self):
+        report(self.status(), self.status_path, self.stream)
+
+    def _report_periodically(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def done(self, stage="done"):
+        # stage is "failed" if the extraction raised an error
+        with self.lock:
+            self.stage = stage
+        self.stopped.set()
+        self.reporter.join()
+        self.report()
+
+
+def log_status(query_log, variables_total):
+    """Status of an extraction from its log so far (QueryLog), as Progress.status"""
+    def seconds(start, end):
+        if start is None or end is None:
+            return None
+        return (datetime.strptime(end, LOG_TIME) - datetime.strptime(start, LOG_TIME)).total_seconds()
+
+    variables_done = query_log.variables_done()
+    elapsed = seconds(query_log.started, query_log.updated) or 0.0
+    patients_per_second = None
+    eta = None
+    if query_log.finished is not None:
+        stage = "done" if query_log.state == "ok" else "failed"
+        eta = 0.0 if stage == "done" else None
+    elif query_log.patients_downloaded or any(query["variable"] is None for query in query_log.queries):
+        stage = "writing"
+        downloading = seconds(query_log.downloading_started, query_log.downloaded_at)
+        if downloading:
+            patients_per_second = query_log.patients_downloaded / downloading
+    else:
+        stage = "variables"
+        if variables_done:
+            eta = elapsed / variables_done * (variables_total - variables_done)
+    return {
+        "stage": stage,
+        "variables_done": variables_done,
+        "variables_total": variables_total,
+        "patients_written": query_log.patients_downloaded,
+        "patients_total": None,
+        "bytes_written": None,
+        "patients_per_second": round(patients_per_second, 1) if patients_per_second else None,
+        "elapsed_seconds": round(elapsed, 1),
+        "eta_seconds": round(eta, 1) if eta is not None else None,
+        "updated": datetime.now().isoformat(timespec="seconds"),
+        "log_updated": query_log.updated,
+        "running": [query["description"] for query in query_log.running.values()],
+    }
+
+
+def followed(f, poll):
+    # Lines of a log as they are written; "" while there is nothing new
+    while True:
+        line = f.readline()
+        if not line:
+            time.sleep(poll)
+        yield line
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("log", help="log of a cohortextractor action, or - to read it from stdin")
+    parser.add_argument("--study-definition", required=True)
+    parser.add_argument("--index-date")
+    parser.add_argument("--status-file")
+    parser.add_argument("--follow", action="store_true", help="keep reading the log until the extraction ends")
+    parser.add_argument("--interval", type=float, default=INTERVAL)
+    args = parser.parse_args()
+
+    study = load_study(args.study_definition, args.index_date)
+    variables_total = len(table_variables(study.covariate_definitions))
+    query_log = QueryLog()
+    f = sys.stdin if args.log == "-" else open(args.log, errors="replace")
+    lines = followed(f, min(args.interval, 1.0)) if args.follow and args.log != "-" else f
+    reported = time.monotonic()
+    for line in lines:
+        query_log.read_line(line)
+        if query_log.finished is not None:
+            break
+        if args.follow and time.monotonic() - reported >= args.interval:
+            report(log_status(query_log, variables_total), args.status_file)
+            reported = time.monotonic()
+    report(log_status(query_log, variables_total), args.status_file)
+
+
+if __name__ == "__main__":
+    main()
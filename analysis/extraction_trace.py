@@ -0,0 +1,202 @@
+"""
+Per-variable trace records of an extraction
+
+A JSON line is written for each variable:
+
+    variable, query_type, dependencies     what was evaluated
+    queries                                 SQL run for it (text, parameters and rows fetched)
+    seconds                                 wall time of the evaluation
+    dependency_wait_seconds                 time from its last dependency finishing (or the run
+                                            starting) to its evaluation starting
+    rows_read, rows_returned                rows fetched from the database, and patients with a
+                                            non-empty value
+    cached                                  whether the result came from the variable cache
+
+The production extraction (the cohortextractor generate_cohort actions) is traced from its log
+(cohortextractor_log.py), which has the queries of each variable, their SQL, state and time,
+and the server's CPU and elapsed time when SQL Server statistics are on. cohortextractor runs
+one query at a time and does not log rows, so dependency_wait_seconds, rows_read and
+rows_returned are null, and the queries that are not part of a variable (joining the columns,
+writing the output) get records with query_type "stage". Trace an action after it has run:
+
+    python analysis/extraction_trace.py logs/generate_study_population.trace.jsonl \
+        --log metadata/generate_study_population.log --study-definition study_definition
+
+Local runs (analysis/local_backend.py --trace) wrap every evaluation and fill in every field.
+Variables evaluated together there (window_count_groups, as_of_groups and first_n_groups of
+local_backend.py) fetch their events when the first of them is evaluated. That fetch gets a
+record of its own, written before the member's, with variable "group: <members>", query_type
+"group", the members under variables and no rows_returned; the member that ran it is only
+charged with the rest of its evaluation.
+
+Records go to logs/ next to the Stata logs, named after the action, e.g.
+logs/generate_study_population.trace.jsonl. Summarise a trace, slowest variables first:
+
+    python analysis/extraction_trace.py logs/generate_study_population.trace.jsonl
+"""
+import argparse
+import functools
+import json
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from cohortextractor_log import QueryLog
+from dummy_data import truthy
+from study_plan import dependency_graph, load_study
+
+
+class Tracer:
+    """Wrap the evaluate function of a backend and write a trace record per variable"""
+
+    def __init__(self, path, backend):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(path, "w")
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.finished = {}
+
+    def wrap(self, evaluate):
+        return functools.partial(self._traced, evaluate)
+
+    def _traced(self, evaluate, name, definition, inputs):
+        stats = self.backend.thread_stats()
+        queries, rows_read, evaluations = len(stats["queries"]), stats["rows_read"], stats["evaluations"]
+        fetches = len(stats["group_fetches"])
+        start = time.perf_counter()
+        ready = max((self.finished[dependency] for dependency in inputs), default=self.started)
+        result = evaluate(name, definition, inputs)
+        end = time.perf_counter()
+        now = datetime.now().isoformat(timespec="milliseconds")
+        records = []
+        seconds, rows_read, queries = end - start, stats["rows_read"] - rows_read, stats["queries"][queries:]
+        for fetch in stats["group_fetches"][fetches:]:
+            records.append(
+                {
+                    "time": now,
+                    "variable": fetch["name"],
+                    "query_type": "group",
+                    "variables": fetch["variables"],
+                    "dependencies": sorted(inputs),
+                    "queries": fetch["queries"],
+                    "seconds": round(fetch["seconds"], 4),
+                    "dependency_wait_seconds": round(start - ready, 4),
+                    "rows_read": fetch["rows_read"],
+                    "rows_returned": None,
+                    "cached": False,
+                }
+            )
+            seconds -= fetch["seconds"]
+            rows_read -= fetch["rows_read"]
+            fetched = {id(query) for query in fetch["queries"]}
+            queries = [query for query in queries if id(query) not in fetched]
+        records.append(
+            {
+                "time": now,
+                "variable": name,
+                "query_type": definition[0],
+                "dependencies": sorted(inputs),
+                "queries": queries,
+                "seconds": round(seconds, 4),
+                "dependency_wait_seconds": round(start - ready, 4),
+                "rows_read": rows_read,
+                "rows_returned": int(truthy(result.to_numpy()).sum()),
+                "cached": stats["evaluations"] == evaluations,
+            }
+        )
+        with self.lock:
+            self.finished[name] = end
+            for record in records:
+                self.file.write(json.dumps(record, default=str) + "\n")
+            self.file.flush()
+        return result
+
+    def close(self):
+        self.file.close()
+
+
+def records_from_log(query_log, covariate_definitions=None):
+    # Trace records of the queries of a cohortextractor log (QueryLog), with the query type and
+    # dependencies of each variable when the study's covariate_definitions are given
+    definitions = covariate_definitions or {}
+    graph = dependency_graph(definitions) if definitions else {}
+    records = {}
+    for query in query_log.queries:
+        name = query["variable"] or query["description"]
+        record = records.get(name)
+        if record is None:
+            record = records[name] = {
+                "time": query["finished"],
+                "variable": name,
+                "query_type": definitions.get(name, (None,))[0] if query["variable"] else "stage",
+                "dependencies": sorted(graph.get(name, ())),
+                "queries": [],
+                "seconds": 0.0,
+                "dependency_wait_seconds": None,
+                "rows_read": None,
+                "rows_returned": None,
+                "cached": False,
+            }
+        record["queries"].append(
+            {
+                "sql": query["sql"],
+                "state": query["state"],
+                "seconds": query["seconds"],
+                "server_cpu_seconds": query["server_cpu_seconds"],
+                "server_elapsed_seconds": query["server_elapsed_seconds"],
+            }
+        )
+        record["time"] = query["finished"]
+        record["seconds"] = round(record["seconds"] + (query["seconds"] or 0.0), 4)
+    return list(records.values())
+
+
+def read_trace(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("trace")
+    parser.add_argument("--log", help="write the trace from the log of a cohortextractor action first")
+    parser.add_argument("--study-definition", help="study definition of the action whose log is read")
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    if args.log:
+        with open(args.log, errors="replace") as f:
+            query_log = QueryLog().read(f)
+        definitions = load_study(args.study_definition).covariate_definitions if args.study_definition else None
+        Path(args.trace).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.trace, "w") as f:
+            for record in records_from_log(query_log, definitions):
+                f.write(json.dumps(record, default=str) + "\n")
+
+    records = read_trace(args.trace)
+    variables = [record for record in records if record["query_type"] not in ("group", "stage")]
+    rows_read = [record["rows_read"] for record in records if record["rows_read"] is not None]
+    print(
+        f"{len(variables)} variables and {len(records) - len(variables)} group fetches or stages, "
+        f"{sum(record['seconds'] for record in records):.2f}s evaluating"
+        + (f", {sum(rows_read)} rows read" if rows_read else "")
+    )
+    for record in sorted(records, key=lambda record: -record["seconds"])[: args.top]:
+        print(
+            f"    {record['variable']}: {record['seconds']:.3f}s"
+            + (
+                f" (waited {record['dependency_wait_seconds']:.3f}s)"
+                if record["dependency_wait_seconds"] is not None
+                else ""
+            )
+            + (f", {record['rows_read']} rows read" if record["rows_read"] is not None else "")
+            + (f", {record['rows_returned']} returned" if record["rows_returned"] is not None else "")
+            + (" [cached]" if record["cached"] else "")
+        )
+
+
+if __name__ == "__main__":
+    main()
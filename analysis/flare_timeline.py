@@ -0,0 +1,128 @@
+"""
+Flare timeline for the gout cohort (output/input.feather)
+
+Flares are defined as (adapted from https://jamanetwork.com/journals/jama/fullarticle/2794763):
+    1) non-index admission with primary gout diagnostic code;
+    2) non-index ED attendance with primary gout diagnostic code;
+    3) any non-index gout diagnostic code AND prescription for a flare treatment on the same day;
+    4) presence of a non-index diagnostic code for gout exacerbation;
+all after the first 14 days and within 6 months of the index diagnosis. Events that occur within
+14 days of a preceding flare are not counted as new flares.
+
+All four event sources are stacked into a single (patient, date) table, which is sorted once and
+collapsed into flares with episodes.episode_starts. Patients are processed in batches
+(--batch-size). Writes output/data/flare_timeline.dta (patient_id, flare_count,
+flare_date_1..12), which is merged into the cohort by 000_define_covariates.do.
+
+The flare count differs from that of the repeated "within 14 days" passes 000_define_covariates.do
+ran before in two ways (tests/test_flare_timeline.py pins both against those passes):
+    - an event 14 days or more after the last flare is a new flare, even if it is within 14 days
+      of an event that was dropped. The passes compared each event with the row before it as
+      already replaced, so events 20, 25, 30 and 35 days after diagnosis were one flare, not two
+      (20 and 35);
+    - a patient's first event is never compared with another patient's events. The passes compared
+      it with the last row of the patient before, and dropped it when that patient had all 12
+      events within the window, the last of them less than 14 days before it or later.
+The four passes were always enough for the 12 events a patient can have.
+"""
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from cohort_io import BATCH_SIZE, read_cohort_batches, write_stata_batches
+from episodes import episode_starts
+
+# Days after the index diagnosis within which flares are counted (exclusive at both ends)
+FLARE_WINDOW_START = 14
+FLARE_WINDOW_END = 180
+# Events within this many days of the preceding flare are the same flare
+FLARE_GAP = 14
+
+ADMISSION_COLUMNS = [f"gout_admission_{i}" for i in range(1, 4)]
+EMERG_COLUMNS = [f"gout_emerg_{i}" for i in range(1, 4)]
+FLARE_CODE_COLUMNS = [f"gout_flare_{i}" for i in range(1, 4)]
+GOUT_CODE_COLUMNS = [f"gout_code_any_{i}" for i in range(1, 4)]
+TREATMENT_COLUMNS = [f"flare_treatment_{i}" for i in range(1, 7)]
+DATE_COLUMNS = (
+    ["gout_code_date", "first_ult_date"]
+    + ADMISSION_COLUMNS
+    + EMERG_COLUMNS
+    + FLARE_CODE_COLUMNS
+    + GOUT_CODE_COLUMNS
+    + TREATMENT_COLUMNS
+)
+# Every event source can be a separate flare
+MAX_FLARES = len(ADMISSION_COLUMNS + EMERG_COLUMNS + FLARE_CODE_COLUMNS + GOUT_CODE_COLUMNS)
+
+
+def index_date(cohort):
+    # Index diagnosis date, recoded as in 000_define_covariates.do: first ULT prescription,
+    # then first admission, then first ED attendance if earlier than the gout code
+    index = cohort["gout_code_date"].copy()
+    has_ult = cohort["first_ult_date"].notna()
+    for column in ["first_ult_date", "gout_admission_1", "gout_emerg_1"]:
+        earlier = index.notna() & has_ult & (cohort[column] < index)
+        index = index.mask(earlier, cohort[column])
+    return index
+
+
+def stack_events(cohort):
+    # Long (patient_id, date) table of candidate flare events from all sources
+    code_and_tx = [
+        cohort[code].where(cohort[TREATMENT_COLUMNS].eq(cohort[code], axis=0).any(axis=1))
+        for code in GOUT_CODE_COLUMNS
+    ]
+    sources = (
+        [cohort[column] for column in ADMISSION_COLUMNS + EMERG_COLUMNS + FLARE_CODE_COLUMNS]
+        + code_and_tx
+    )
+    events = pd.DataFrame(
+        {
+            "patient_id": np.tile(cohort["patient_id"].to_numpy(), len(sources)),
+            "index_date": np.tile(cohort["index_date"].to_numpy(), len(sources)),
+            "date": np.concatenate([source.to_numpy() for source in sources]),
+        }
+    )
+    days = (events["date"] - events["index_date"]).dt.days
+    in_window = (days > FLARE_WINDOW_START) & (days < FLARE_WINDOW_END)
+    return events.loc[in_window, ["patient_id", "date"]]
+
+
+def drop_repeat_events(events, gap):
+    # Keep an event only if it is at least `gap` days after the last kept event for that patient
+    events = events.sort_values(["patient_id", "date"], kind="mergesort")
+    days = events["date"].to_numpy().astype("datetime64[D]").astype(np.int64)
+    return events[episode_starts(events["patient_id"].to_numpy(), days, gap)]
+
+
+def flare_timeline(cohort):
+    cohort = cohort.assign(index_date=index_date(cohort))
+    flares = drop_repeat_events(stack_events(cohort), FLARE_GAP)
+    flares = flares.assign(order=flares.groupby("patient_id").cumcount() + 1)
+    wide = flares.pivot(index="patient_id", columns="order", values="date")
+    # Same columns for every batch of patients
+    wide = wide.reindex(columns=range(1, MAX_FLARES + 1)).astype("datetime64[ns]")
+    wide.columns = [f"flare_date_{order}" for order in wide.columns]
+    flare_count = cohort["patient_id"].map(flares.groupby("patient_id").size())
+    timeline = cohort[["patient_id"]].assign(flare_count=flare_count.fillna(0).astype(int))
+    return timeline.merge(wide, on="patient_id", how="left")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--input", default="output/input.feather")
+    parser.add_argument("--output", default="output/data/flare_timeline.dta")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    batches = read_cohort_batches(
+        args.input, columns=["patient_id"] + DATE_COLUMNS, batch_size=args.batch_size
+    )
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    write_stata_batches(map(flare_timeline, batches), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+Incremental refresh of the gout cohort (output/input.feather) extracted with end_date="today"
+
+Every variable of study_definition depends only on events dated up to the extraction date, so a
+patient's row can change only if they have a new event since the last extraction (the watermark)
+in one of the codelists or tables the study uses, or their registration changed. The watermark
+and the study's variable definitions (with the extraction date masked) are recorded next to the
+cohort in <cohort>.watermark.json. A refresh re-extracts only the patients with new events, which
+gives the correct first matches, counts and population for them, and replaces their rows:
+
+    python analysis/incremental_refresh.py record output/input.feather --watermark 2024-05-01  # full extraction date
+    python analysis/incremental_refresh.py status output/input.feather  # prints the watermark
+    python analysis/incremental_refresh.py changes output/input.feather --output-dir output/refresh
+    cohortextractor generate_cohort --study-definition study_definition \\
+        --param refresh_patients=output/refresh/input_changes.csv --output-dir=output/refresh --output-format=feather
+    python analysis/incremental_refresh.py merge output/input.feather output/refresh/input.feather \\
+        output/refresh/input_changes.csv --watermark 2024-06-01
+
+changes extracts the patients with new events since the watermark (analysis/refresh_changes.py)
+from the database of DATABASE_URL, as generate_cohort does; it is run here because cohortextractor
+only extracts study definitions named study_definition_*. The watermark is the date of the
+extraction (--watermark of record and merge, by default today), and status evaluates the current
+definitions as of that date: it fails if any definition other than the extraction date has changed
+since the watermark was recorded, in which case a full extraction is needed. Records entered late with an earlier date
+(e.g. backdated codes, late death registrations) are only picked up by a full extraction, so one
+should still be run periodically.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+from datetime import date
+from pathlib import Path
+
+import pandas as pd
+
+from cohortextractor.cohortextractor import load_study_definition
+from cohortextractor.date_expressions import DateExpressionEvaluator
+from cohortextractor.study_definition import evaluate_date_expressions_in_covariate_definitions
+
+from cohort_io import read_cohort
+from study_plan import load_study
+from variable_cache import NON_KEY_ARGUMENTS, canonical
+
+STUDY_DEFINITION = "study_definition"
+CHANGES_DEFINITION = "refresh_changes"
+# Date expressions relative to the extraction date
+TODAY = re.compile(r"^today\b")
+
+
+def watermark_path(cohort):
+    return Path(cohort).with_suffix(".watermark.json")
+
+
+def as_of(value, extraction_date):
+    # An argument value with its "today" date expressions evaluated as of the extraction date
+    if isinstance(value, str) and TODAY.match(value):
+        return DateExpressionEvaluator(extraction_date)(TODAY.sub("index_date", value))
+    if type(value) is dict:
+        return {key: as_of(item, extraction_date) for key, item in value.items()}
+    if type(value) in (list, tuple):
+        return type(value)(as_of(item, extraction_date) for item in value)
+    return value
+
+
+def masked_definitions(study_definition, extraction_date):
+    # Canonical variable definitions as extracted on extraction_date (YYYY-MM-DD), with that date
+    # masked. The definitions are evaluated from the study's unevaluated ones rather than as
+    # loaded, where "today" is the day they are loaded.
+    study = load_study(study_definition)
+    covariates = {
+        name: (query_type, as_of(args, extraction_date))
+        for name, (query_type, args) in study._original_covariates.items()
+    }
+    definitions = {
+        name: [
+            query_type,
+            canonical({argument: value for argument, value in args.items() if argument not in NON_KEY_ARGUMENTS}),
+        ]
+        for name, (query_type, args) in evaluate_date_expressions_in_covariate_definitions(
+            covariates, study.index_date
+        ).items()
+    }
+    return json.loads(json.dumps(definitions).replace(extraction_date, "<end_date>"))
+
+
+def record(cohort, watermark, study_definition=STUDY_DEFINITION):
+    # watermark is the date of the extraction the cohort is from
+    recorded = {
+        "study_definition": study_definition,
+        "watermark": watermark,
+        "definitions": masked_definitions(study_definition, watermark),
+    }
+    watermark_path(cohort).write_text(json.dumps(recorded, indent=1, sort_keys=True))
+
+
+def changed_definitions(cohort):
+    # The current definitions are evaluated as of the recorded extraction, so only edits differ
+    recorded = json.loads(watermark_path(cohort).read_text())
+    current = masked_definitions(recorded["study_definition"], recorded["watermark"])
+    previous = recorded["definitions"]
+    return recorded, sorted(name for name in set(current) | set(previous) if current.get(name) != previous.get(name))
+
+
+def extract_changes(watermark, output_dir, expectations_population=0):
+    # output_dir/input_changes.csv: patient_id of the patients with new events since the watermark
+    study = load_study_definition(CHANGES_DEFINITION, params={"watermark": watermark})
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    output = Path(output_dir) / "input_changes.csv"
+    study.to_file(str(output), expectations_population=expectations_population)
+    return output
+
+
+def merge(previous, refreshed, changed_patients):
+    # Rows of the changed patients are replaced by their refreshed rows (if they are still in the population)
+    kept = previous[~previous["patient_id"].isin(changed_patients)]
+    refreshed = refreshed.loc[refreshed["patient_id"].isin(changed_patients), previous.columns]
+    merged = pd.concat([kept, refreshed], ignore_index=True)
+    for name, column in previous.items():
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            merged[name] = merged[name].astype("category")
+    return merged.sort_values("patient_id", ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    record_parser = commands.add_parser("record", help="record the watermark after a full extraction")
+    record_parser.add_argument("cohort")
+    record_parser.add_argument(
+        "--watermark", default=date.today().isoformat(), help="date of the extraction (default: today)"
+    )
+    status_parser = commands.add_parser("status", help="check that an incremental refresh is possible")
+    status_parser.add_argument("cohort")
+    changes_parser = commands.add_parser("changes", help="extract the patients with new events since the watermark")
+    changes_parser.add_argument("cohort")
+    changes_parser.add_argument("--output-dir", default="output/refresh")
+    changes_parser.add_argument(
+        "--expectations-population", type=int, default=0, help="dummy patients instead of DATABASE_URL"
+    )
+    merge_parser = commands.add_parser("merge", help="merge refreshed patients into the cohort")
+    merge_parser.add_argument("cohort")
+    merge_parser.add_argument("refreshed")
+    merge_parser.add_argument("changed_patients", help="csv of the patients that were re-extracted")
+    merge_parser.add_argument(
+        "--watermark", default=date.today().isoformat(), help="date of the refresh extraction (default: today)"
+    )
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record(args.cohort, args.watermark)
+    elif args.command == "status":
+        recorded, changed = changed_definitions(args.cohort)
+        if changed:
+            print(f"Definitions changed since {recorded['watermark']}, a full extraction is needed:")
+            print("    " + ", ".join(changed))
+            sys.exit(1)
+        print(recorded["watermark"])
+    elif args.command == "changes":
+        recorded, changed = changed_definitions(args.cohort)
+        if changed:
+            sys.exit(f"Definitions changed since {recorded['watermark']}: {', '.join(changed)}")
+        if not (args.expectations_population or os.environ.get("DATABASE_URL")):
+            sys.exit("changes needs DATABASE_URL (or --expectations-population for dummy data)")
+        print(extract_changes(recorded["watermark"], args.output_dir, args.expectations_population))
+    else:
+        recorded, changed = changed_definitions(args.cohort)
+        if changed:
+            sys.exit(f"Definitions changed since {recorded['watermark']}: {', '.join(changed)}")
+        changed_patients = pd.read_csv(args.changed_patients, usecols=["patient_id"])["patient_id"]
+        merged = merge(read_cohort(args.cohort), read_cohort(args.refreshed), changed_patients)
+        tmp = Path(args.cohort).with_suffix(".tmp")
+        merged.to_feather(tmp)
+        os.replace(tmp, args.cohort)
+        record(args.cohort, args.watermark, recorded["study_definition"])
+        print(f"{len(changed_patients)} patients refreshed, {len(merged)} patients in the cohort")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,910 @@
+"""
+Run a study definition against a local synthetic EHR database
+
+A stand-in for the TPP backend so that the study definitions can be executed and profiled
+end to end without the production database. The database is an SQLite file built by
+analysis/synthetic_ehr.py with the same tables and columns. Each variable fetches its events
+with one SQL query (codelist, source table and the date bounds shared by every patient); the
+per-patient windows, first/last matches, counts and episodes are then applied with NumPy. Counts
+of the same events in different windows (ult_count_6m and ult_count_12m, or urate_count and
+urate_count_nom) are evaluated together from one query (window_counts.py), and so are the latest
+values of different codelists on or before the same dates (hba1c, creatinine, bmi, smoking; as_of.py).
+The _1.._n chains of first matches (urate_test_*, gout_flare_*, flare_treatment_*...), where each
+member's window starts the day after the match of the one before, are evaluated from one query as
+the first event of each of the first n days with a match.
+The events of a codelist that several variables read from the same table (gout_codes for
+gout_code_date and the gout_code_any_* windows, ult_codes, urate_codes) are fetched once, without
+date bounds, into a buffer sorted by patient and date, and each variable takes its own window from
+the buffer; the buffer is released when the last of them has been evaluated.
+Variables are evaluated level by level with study_plan.run_by_level, optionally through the
+variable cache, and the cohort is written like cohortextractor's output. With --repeated-events
+DIR, the long tables of repeated_events.py, which production extractions cannot produce, are
+written to DIR as well.
+
+The queries follow tpp_backend.py: registrations and addresses are as of a date (StartDate <=
+date < EndDate), admissions match on the prefix of the primary diagnosis, ties between events
+on the same day go to the first recorded, and most_recent_bmi uses recorded BMI values only
+(not weight and height).
+
+Usage (from the repository root):
+
+    python analysis/synthetic_ehr.py output/synthetic_ehr.sqlite --patients 1000000
+    python analysis/local_backend.py study_definition output/synthetic_ehr.sqlite --output output/input.feather
+"""
+import argparse
+import functools
+import hashlib
+import itertools
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc
+
+from cohort_io import BATCH_SIZE
+from dummy_data import EMPTY, civil_from_days, date_column, evaluate_expression, resolve_date
+from extraction_progress import INTERVAL, Progress
+from extraction_trace import Tracer
+from as_of import last_on_or_before
+from study_plan import definition_references, dependency_graph, load_repeated_events, load_study, run_by_level
+from variable_cache import VariableCache, canonical, definition_keys
+from window_counts import count_in_windows
+
+# Arguments that only change how a column is output
+NON_QUERY_ARGUMENTS = {"return_expectations", "hidden", "column_type", "date_format", "include_date_of_match"}
+EPISODE_DEFINITION = re.compile(r"^series of events each <= (\d+) days apart$")
+# Days since 1970-01-01 of an ISO date column
+DAYS = "julianday({}) - 2440587.5"
+BMI_CODE = "22K.."
+CLINICAL_EVENT_TABLES = {"ctv3": ("CodedEvent", "CTV3Code"), "snomed": ("CodedEvent_SNOMED", "ConceptID")}
+PERIOD_QUERIES = {
+    "registrations": f"""
+        SELECT r.rowid AS row, r.Patient_ID AS patient_id, {DAYS.format("r.StartDate")} AS start,
+          {DAYS.format("r.EndDate")} AS end, r.Organisation_ID AS pseudo_id, o.STPCode AS stp_code,
+          o.Region AS nuts1_region_name
+        FROM RegistrationHistory r
+        LEFT JOIN Organisation o ON o.Organisation_ID = r.Organisation_ID
+    """,
+    "addresses": f"""
+        SELECT rowid AS row, Patient_ID AS patient_id, {DAYS.format("StartDate")} AS start,
+          {DAYS.format("EndDate")} AS end, ImdRankRounded AS index_of_multiple_deprivation
+        FROM PatientAddress
+    """,
+}
+# Value of a column when a patient has no match, as in tpp_backend.py
+EMPTY_VALUES = {**EMPTY, "str": "", "date": np.nan}
+IGNORE_MISSING_VALUES = "NumericValue != 0"
+# Counts that are evaluated together when they differ only in these arguments
+WINDOW_COUNT_QUERIES = {"with_these_clinical_events", "with_these_medications"}
+WINDOW_ARGUMENTS = {"between", "ignore_missing_values"}
+# Latest values that are evaluated together when they read the same table
+AS_OF_RETURNING = {"numeric_value", "category", "code"}
+# Chains of first matches (_1.._n), each on or after the day after the one before
+NEXT_MATCH = re.compile(r"^(\w+) \+ 1 day$")
+DATE_RETURNING = {"date", "date_admitted", "date_arrived"}
+
+
+def unsupported(**arguments):
+    used = sorted(name for name, value in arguments.items() if value)
+    if used:
+        raise ValueError(f"Unsupported arguments in the local backend: {', '.join(used)}")
+
+
+def first_in_group(groups):
+    # Mask of the first row of each run of equal values in a sorted array
+    return np.r_[True, groups[1:] != groups[:-1]] if len(groups) else np.zeros(0, bool)
+
+
+def order_in_group(groups):
+    # Position of each row within its run of equal values in a sorted array (0, 1, ...)
+    starts = np.flatnonzero(first_in_group(groups))
+    return np.arange(len(groups)) - np.repeat(starts, np.diff(np.r_[starts, len(groups)]))
+
+
+def event_source(query_type, args):
+    # (table, codes, condition) of the events of a query that reads a codelist, else None
+    if query_type == "with_these_clinical_events":
+        condition = IGNORE_MISSING_VALUES if args.get("ignore_missing_values") else "1 = 1"
+        return CLINICAL_EVENT_TABLES[args["codelist"].system][0], args["codelist"], condition
+    if query_type == "with_these_medications":
+        return "MedicationIssue", args["codelist"], "1 = 1"
+    if query_type == "admitted_to_hospital" and args.get("with_these_primary_diagnoses"):
+        return "APCS", args["with_these_primary_diagnoses"], "1 = 1"
+    if query_type == "attended_emergency_care" and args.get("with_these_diagnoses"):
+        return "EC", args["with_these_diagnoses"], "1 = 1"
+    if query_type == "most_recent_bmi":
+        return "CodedEvent", [BMI_CODE], "1 = 1"
+    return None
+
+
+def source_key(table, codes, condition):
+    return json.dumps([table, condition, canonical(codes)])
+
+
+def union_between(windows):
+    # Bounds of the union of (low, high) windows of days, None where any of them is unbounded
+    lows, highs = zip(*windows)
+    return [
+        None if any(bound is None for bound in lows) else functools.reduce(np.fmin, lows),
+        None if any(bound is None for bound in highs) else functools.reduce(np.fmax, highs),
+    ]
+
+
+def window_count_groups(covariate_definitions, graph):
+    # {name: names of its group} of the number_of_matches_in_period variables that count the same
+    # events in different windows. Members have the same dependencies, so they are evaluated at the
+    # same level and any one of them has the columns of every window.
+    groups = {}
+    for name, (query_type, args) in covariate_definitions.items():
+        if query_type not in WINDOW_COUNT_QUERIES or args.get("returning") != "number_of_matches_in_period":
+            continue
+        shared = {
+            argument: value
+            for argument, value in args.items()
+            if argument not in NON_QUERY_ARGUMENTS | WINDOW_ARGUMENTS
+        }
+        key = json.dumps([query_type, canonical(shared), sorted(graph[name])], sort_keys=True)
+        groups.setdefault(key, []).append(name)
+    return {name: names for names in groups.values() if len(names) > 1 for name in names}
+
+
+def as_of_table(query_type, args):
+    # (table, code column) of a variable that is the latest value of a coded event, else None
+    if query_type == "most_recent_bmi":
+        return CLINICAL_EVENT_TABLES["ctv3"]
+    if (
+        query_type == "with_these_clinical_events"
+        and args.get("returning") in AS_OF_RETURNING
+        and not args.get("find_first_match_in_period")
+        and not args.get("ignore_missing_values")
+        and not args.get("ignore_days_where_these_codes_occur")
+    ):
+        return CLINICAL_EVENT_TABLES[args["codelist"].system]
+    return None
+
+
+def as_of_groups(covariate_definitions, graph):
+    # {name: names of its group} of the variables that are the latest value of the same coded
+    # event table on or before per-patient dates, with the same dependencies (see
+    # window_count_groups)
+    groups = {}
+    for name, (query_type, args) in covariate_definitions.items():
+        table = as_of_table(query_type, args)
+        if table is not None:
+            groups.setdefault((table, tuple(sorted(graph[name]))), []).append(name)
+    return {name: names for names in groups.values() if len(names) > 1 for name in names}
+
+
+def first_n_groups(covariate_definitions, graph):
+    # {name: names of its chain} of the first matches whose window starts the day after the match
+    # of the one before ("{name}_{i-1} + 1 day" or "{name}_{i-1}_date + 1 day") and that differ
+    # from it only in that bound. The first of a chain is evaluated first; the others are kept
+    # only while they depend on every column it does, so that any of them can evaluate the chain.
+    def shared(args):
+        return canonical(
+            {
+                argument: value if argument != "between" else value[1]
+                for argument, value in args.items()
+                if argument not in NON_QUERY_ARGUMENTS
+            }
+        )
+
+    previous = {}
+    for name, (query_type, args) in covariate_definitions.items():
+        between = args.get("between")
+        if (
+            event_source(query_type, args) is None
+            or not args.get("find_first_match_in_period")
+            or str(args.get("returning")).startswith("number_of_")
+            or not between
+        ):
+            continue
+        match = NEXT_MATCH.match(str(between[0]))
+        reference = covariate_definitions.get(match.group(1)) if match else None
+        if reference is None:
+            continue
+        if reference[0] == "value_from" and reference[1]["returning"] == "date":
+            before = reference[1]["source"]
+            dated = covariate_definitions[before][1].get("include_date_of_match")
+        else:
+            before = match.group(1)
+            dated = reference[1].get("returning") in DATE_RETURNING
+        before_type, before_args = covariate_definitions[before]
+        if dated and before_type == query_type and shared(before_args) == shared(args):
+            previous[name] = before
+
+    following = {before: after for after, before in previous.items()}
+    groups = {}
+    for name in covariate_definitions:
+        if name in previous or name not in following:
+            continue
+        chain = [name]
+        while chain[-1] in following and set(graph[name]) <= set(graph[following[chain[-1]]]):
+            chain.append(following[chain[-1]])
+        if len(chain) > 1:
+            groups.update((member, chain) for member in chain)
+    return groups
+
+
+class LocalBackend:
+    """Evaluate the variables of a study definition against an SQLite database"""
+
+    _temp_tables = itertools.count()
+
+    def __init__(self, database, covariate_definitions):
+        self.database = str(database)
+        self.covariate_definitions = covariate_definitions
+        self.graph = dependency_graph(covariate_definitions)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        patients = self.read_sql(f"SELECT Patient_ID, {DAYS.format('DateOfBirth')} AS dob, Sex FROM Patient")
+        order = np.argsort(patients["Patient_ID"].to_numpy(), kind="stable")
+        self.patient_ids = patients["Patient_ID"].to_numpy()[order]
+        self.date_of_birth = patients["dob"].to_numpy()[order]
+        self.sex = patients["Sex"].to_numpy(object)[order]
+        self.size = len(self.patient_ids)
+        # Results of the variables evaluated so far, and dates of the matches of the variables
+        # with include_date_of_match (read by their value_from columns)
+        self.results = {}
+        self.match_dates = {}
+        self.periods = {}
+        # Variables of a group are evaluated together when the first of them is, and their results
+        # kept until the others are
+        self.window_count_groups = window_count_groups(covariate_definitions, self.graph)
+        self.as_of_groups = as_of_groups(covariate_definitions, self.graph)
+        self.first_n_groups = first_n_groups(covariate_definitions, self.graph)
+        self.group_locks = {
+            names[0]: threading.Lock()
+            for groups in (self.window_count_groups, self.as_of_groups, self.first_n_groups)
+            for names in groups.values()
+        }
+        self.group_results = {}
+        # Number of evaluations that read the events of each (table, codes, condition) read by more
+        # than one (a group evaluated together reads its events once); run() counts them down
+        sources = []
+        for name, (query_type, args) in covariate_definitions.items():
+            group = self.window_count_groups.get(name) or self.first_n_groups.get(name)
+            if name in self.as_of_groups or (group is not None and name != group[0]):
+                continue
+            source = event_source(query_type, args)
+            if source is not None:
+                sources.append(source_key(*source))
+        self.buffer_sources = {key: users for key, users in Counter(sources).items() if users > 1}
+        self.buffer_locks = {key: threading.Lock() for key in self.buffer_sources}
+        self.buffer_users = {}
+        self.buffers = {}
+
+    def connection(self):
+        # SQLite connections cannot be shared between threads, so each thread opens its own
+        if not hasattr(self.local, "connection"):
+            self.local.connection = sqlite3.connect(f"file:{self.database}?mode=ro", uri=True)
+        return self.local.connection
+
+    def read_sql(self, sql, params=()):
+        rows = pd.read_sql_query(sql, self.connection(), params=params)
+        stats = self.thread_stats()
+        stats["rows_read"] += len(rows)
+        stats["queries"].append({"sql": " ".join(sql.split()), "params": list(params), "rows": len(rows)})
+        return rows
+
+    def thread_stats(self):
+        # Rows fetched, queries run, variables evaluated and groups fetched (see grouped) so far
+        # by the current thread
+        if not hasattr(self.local, "stats"):
+            self.local.stats = {"rows_read": 0, "queries": [], "evaluations": 0, "group_fetches": []}
+        return self.local.stats
+
+    def rows_read(self):
+        return self.thread_stats()["rows_read"]
+
+    def fingerprint(self):
+        stat = os.stat(self.database)
+        return f"{os.path.abspath(self.database)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    def cache_keys(self):
+        # Variable cache keys that also identify the database, so that results of different
+        # synthetic databases are not mixed up
+        fingerprint = self.fingerprint()
+        return {
+            name: hashlib.sha256(f"{key}:{fingerprint}".encode()).hexdigest()
+            for name, key in definition_keys(self.covariate_definitions).items()
+        }
+
+    def run(self, jobs=None, cache=None, report=print, monitors=()):
+        # monitors (extraction_trace.Tracer, extraction_progress.Progress) wrap every evaluation
+        evaluate = self.evaluate
+        if cache is not None:
+            evaluate = cache.wrap(evaluate, self.cache_keys())
+        for monitor in monitors:
+            evaluate = monitor.wrap(evaluate)
+        self.buffer_users = dict(self.buffer_sources)
+        try:
+            return run_by_level(
+                self.covariate_definitions, functools.partial(self._recorded, evaluate), jobs=jobs, report=report
+            )
+        finally:
+            # Buffers of variables that came from the cache were not released
+            self.buffers.clear()
+            self.buffer_users = {}
+
+    def _recorded(self, evaluate, name, definition, inputs):
+        result = evaluate(name, definition, inputs)
+        self.results[name] = result.to_numpy()
+        return result
+
+    def evaluate(self, name, definition, inputs):
+        # Result of one variable as a Series indexed by patient_id
+        query_type, args = definition
+        self.thread_stats()["evaluations"] += 1
+        columns = {dependency: result.to_numpy() for dependency, result in inputs.items()}
+        if query_type == "value_from":
+            values = self.value_from(**args)
+        elif name in self.window_count_groups:
+            values = self.grouped(name, self.window_count_groups, self.window_counts, columns)
+        else:
+            if name in self.as_of_groups:
+                values, dates = self.grouped(name, self.as_of_groups, self.as_of_values, columns)
+            elif name in self.first_n_groups:
+                values, dates = self.grouped(name, self.first_n_groups, self.first_n_matches, columns)
+            else:
+                values, dates = self.query(query_type, args, columns)
+            if args.get("include_date_of_match"):
+                self.match_dates[name] = dates
+        return pd.Series(values, index=pd.Index(self.patient_ids, name="patient_id"), name=name)
+
+    def query(self, query_type, args, columns):
+        # (values, dates of the matches) of a variable; dates is None for queries without matches
+        method = getattr(self, f"patients_{query_type}", None)
+        if method is None:
+            raise ValueError(f"Unsupported query type in the local backend: {query_type}")
+        result = method(columns, **{key: value for key, value in args.items() if key not in NON_QUERY_ARGUMENTS})
+        return result if isinstance(result, tuple) else (result, None)
+
+    def value_from(self, source, returning, **ignored):
+        if returning != "date":
+            raise ValueError(f"Unsupported value_from returning: {returning}")
+        dates = self.match_dates.get(source)
+        if dates is None:
+            # The source came from the cache, so its matches are found again
+            query_type, args = self.covariate_definitions[source]
+            columns = {dependency: self.results[dependency] for dependency in self.graph[source]}
+            dates = self.query(query_type, args, columns)[1]
+        return dates
+
+    def repeated_events(self, definitions):
+        """Long tables of every matching event, for the population of the last run()
+
+        definitions are the repeated events of a study (repeated_events.py, through
+        study_plan.load_repeated_events). Returns {name: DataFrame of patient_id, order (1, 2, ...
+        per patient), date, value, code}.
+        """
+        tables = {}
+        population = self.results["population"].astype(bool)
+        for name, (query_type, args) in definitions.items():
+            columns = {
+                column: self.results[column]
+                for column in definition_references(args, set(self.covariate_definitions))
+            }
+            rows, _ = self.query(query_type, {**args, "all_matches": True}, columns)
+            rows = rows[population[rows["position"].to_numpy()]]
+            positions = rows["position"].to_numpy()
+            order = order_in_group(positions) + 1
+            tables[name] = pd.DataFrame(
+                {
+                    "patient_id": self.patient_ids[positions],
+                    "order": order,
+                    "date": date_column(rows["date"].to_numpy(float), args.get("date_format")),
+                    "value": rows["value"].to_numpy(float),
+                    "code": pd.Categorical(rows["code"].to_numpy(object) if "code" in rows else [""] * len(rows)),
+                }
+            )
+        return tables
+
+    def grouped(self, name, groups, evaluate_group, columns):
+        # Result of a variable of a group (window_count_groups, as_of_groups, first_n_groups)
+        # evaluated together.
+        # The member evaluated first fetches the whole group; that fetch is recorded in the thread
+        # stats as a group fetch, so that monitors charge it to the group rather than the member
+        names = groups[name]
+        with self.group_locks[names[0]]:
+            if name not in self.group_results:
+                stats = self.thread_stats()
+                queries, rows_read, start = len(stats["queries"]), stats["rows_read"], time.perf_counter()
+                self.group_results.update(evaluate_group(names, columns))
+                stats["group_fetches"].append(
+                    {
+                        "name": f"group: {', '.join(names)}",
+                        "variables": list(names),
+                        "queries": stats["queries"][queries:],
+                        "seconds": time.perf_counter() - start,
+                        "rows_read": stats["rows_read"] - rows_read,
+                    }
+                )
+            return self.group_results.pop(name)
+
+    def window_counts(self, names, columns):
+        """Counts of a group of variables (window_count_groups) from one fetch of their events
+
+        The events are fetched once for the union of the windows, with the rows with missing values
+        if any member counts them, and the members with the same filter are counted together.
+        """
+        definitions = {name: self.covariate_definitions[name][1] for name in names}
+        windows = {
+            name: [self.resolve(bound, columns) for bound in (args.get("between") or (None, None))]
+            for name, args in definitions.items()
+        }
+        between = union_between(windows.values())
+        ignore_missing_values = {name: bool(args.get("ignore_missing_values")) for name, args in definitions.items()}
+        query_type, args = self.covariate_definitions[names[0]]
+        args = {argument: value for argument, value in args.items() if argument not in WINDOW_ARGUMENTS}
+        if all(ignore_missing_values.values()):
+            args["ignore_missing_values"] = True
+        rows, _ = self.query(query_type, {**args, "returning": "rows", "between": between}, columns)
+        counts = {}
+        for ignore_missing in set(ignore_missing_values.values()):
+            members = [name for name in names if ignore_missing_values[name] == ignore_missing]
+            member_rows = rows
+            if ignore_missing:
+                # As NumericValue != 0 in the query
+                values = rows["value"].to_numpy(float)
+                member_rows = rows[~np.isnan(values) & (values != 0)]
+            member_counts = count_in_windows(
+                member_rows["position"].to_numpy(),
+                member_rows["date"].to_numpy(float),
+                [windows[name] for name in members],
+                self.size,
+            )
+            counts.update(zip(members, member_counts))
+        return counts
+
+    def as_of_values(self, names, columns):
+        """(values, dates) of a group of latest values (as_of_groups) from one fetch of their events
+
+        The codes of every variable are joined to the table in one query, over the union of their
+        windows; each variable's latest event in its own window is then found by last_on_or_before.
+        """
+        definitions = {name: self.covariate_definitions[name] for name in names}
+        windows = {
+            name: [self.resolve(bound, columns) for bound in (args.get("between") or (None, None))]
+            for name, (query_type, args) in definitions.items()
+        }
+        codes = []
+        for name, (query_type, args) in definitions.items():
+            codelist = [BMI_CODE] if query_type == "most_recent_bmi" else args["codelist"]
+            codes += [(*(code if isinstance(code, tuple) else (code, None)), name) for code in codelist]
+        table, code_column = as_of_table(*definitions[names[0]])
+        rows = self.events(
+            table,
+            "ConsultationDate",
+            columns,
+            union_between(windows.values()),
+            codes,
+            code_column,
+            value_column="NumericValue",
+        )
+        variables = pd.Categorical(rows["variable"], categories=names).codes
+        results = {}
+        for i, (name, (query_type, args)) in enumerate(definitions.items()):
+            member_rows = rows[variables == i]
+            if query_type == "most_recent_bmi":
+                member_rows = member_rows[self.measured_at_age(member_rows, args["minimum_age_at_measurement"])]
+            chosen = last_on_or_before(
+                member_rows["position"].to_numpy(), member_rows["date"].to_numpy(float), *windows[name], self.size
+            )
+            chosen = member_rows.iloc[chosen[chosen >= 0]]
+            if query_type == "most_recent_bmi":
+                values, dates = self.returned(chosen, "numeric_value")
+                results[name] = np.round(values, 1), dates
+            else:
+                results[name] = self.returned(chosen, args["returning"])
+        return results
+
+    def first_n_matches(self, names, columns):
+        """(values, dates) of a chain of first matches (first_n_groups) from one fetch of their events
+
+        Each member is the first match on a later day than the member before it, in the window of
+        the first, so the i-th member is the first event of the i-th day with a match in that window.
+        """
+        query_type, args = self.covariate_definitions[names[0]]
+        rows, _ = self.query(query_type, {**args, "all_matches": True}, columns)
+        order = order_in_group(rows["position"].to_numpy())
+        return {
+            name: self.returned(rows[order == i], self.covariate_definitions[name][1]["returning"])
+            for i, name in enumerate(names)
+        }
+
+    def resolve(self, expression, columns):
+        # Bounds that are already days (window_counts) are used as they are
+        if expression is None or not isinstance(expression, str):
+            return expression
+        return resolve_date(expression, columns)
+
+    def events(self, table, date_column, columns, between=None, codes=None, code_column=None,
+               match_prefix=False, value_column=None, condition="1 = 1"):
+        """Matching rows of a table within each patient's window, in (patient, date, row) order
+
+        Returns a DataFrame with the patient's position in self.patient_ids, the date (days),
+        the code, the codelist category and the numeric value of each row.
+        """
+        low, high = (self.resolve(bound, columns) for bound in (between or (None, None)))
+        fetch = functools.partial(
+            self.fetch_events, table, date_column, codes, code_column, match_prefix, value_column, condition
+        )
+        # The bounds shared by every patient go in the query (unless the events are buffered, see
+        # event_buffer), the rest are applied per patient
+        key = source_key(table, codes, condition) if codes is not None else None
+        if self.buffer_users.get(key, 0) > 0:
+            rows = self.event_buffer(key, fetch)
+        else:
+            rows = fetch(low, high)
+        in_window = np.ones(len(rows), bool)
+        dates = rows["date"].to_numpy()
+        for bound, compare in ((low, np.greater_equal), (high, np.less_equal)):
+            if bound is not None:
+                bound = bound[rows["position"].to_numpy()] if np.ndim(bound) else bound
+                with np.errstate(invalid="ignore"):
+                    in_window &= compare(dates, bound)
+        return rows[in_window].reset_index(drop=True)
+
+    def event_buffer(self, key, fetch):
+        # Every event of a (table, codes, condition) read by several variables: fetched by the first
+        # of them and released after the last
+        with self.buffer_locks[key]:
+            if key not in self.buffers:
+                self.buffers[key] = fetch(None, None)
+            rows = self.buffers[key]
+            self.buffer_users[key] -= 1
+            if self.buffer_users[key] == 0:
+                del self.buffers[key]
+        return rows
+
+    def fetch_events(self, table, date_column, codes, code_column, match_prefix, value_column, condition, low, high):
+        # Rows of the table with the codes between the lowest low and the highest high, sorted by
+        # (patient, date, row)
+        conditions = [condition]
+        params = []
+        for bound, operator in ((low, ">="), (high, "<=")):
+            if bound is None:
+                continue
+            if np.all(np.isnan(bound)):
+                conditions.append("0 = 1")
+                continue
+            day = np.nanmin(bound) if operator == ">=" else np.nanmax(bound)
+            conditions.append(f"{date_column} {operator} ?")
+            params.append(str(np.datetime64(int(day), "D")))
+        select = [
+            "t.rowid AS row",
+            "t.Patient_ID AS patient_id",
+            f"{DAYS.format('t.' + date_column)} AS date",
+            f"t.{value_column} AS value" if value_column else "NULL AS value",
+        ]
+        join = ""
+        if codes is not None:
+            codes_table = f"codes_{next(self._temp_tables)}"
+            # codes are codes, (code, category) or (code, category, variable) for as_of_values
+            self.connection().execute(
+                f"CREATE TEMP TABLE {codes_table} "
+                "(code TEXT, category TEXT, variable TEXT DEFAULT '', PRIMARY KEY (code, variable))"
+            )
+            self.connection().executemany(
+                f"INSERT OR IGNORE INTO {codes_table} VALUES (?, ?, ?)",
+                [(*(code if isinstance(code, tuple) else (code, None)), "")[:3] for code in codes],
+            )
+            match = f"LIKE c.code || '%'" if match_prefix else "= c.code"
+            join = f"JOIN temp.{codes_table} c ON t.{code_column} {match}"
+            select += [f"t.{code_column} AS code", "c.category AS category", "c.variable AS variable"]
+        try:
+            rows = self.read_sql(
+                f"SELECT {', '.join(select)} FROM {table} t {join} WHERE {' AND '.join(conditions)}", params
+            )
+        finally:
+            if codes is not None:
+                self.connection().execute(f"DROP TABLE temp.{codes_table}")
+        rows["position"] = np.searchsorted(self.patient_ids, rows["patient_id"].to_numpy())
+        order = np.lexsort((rows["row"].to_numpy(), rows["date"].to_numpy(), rows["position"].to_numpy()))
+        return rows.iloc[order].reset_index(drop=True)
+
+    def per_patient(self, positions, values, column_type):
+        result = np.full(self.size, EMPTY_VALUES[column_type], dtype=object if column_type == "str" else None)
+        result[positions] = values
+        return result
+
+    def matches(self, rows, returning, find_first_match_in_period=None, find_last_match_in_period=None,
+                episode_defined_as=None, all_matches=False):
+        # (values, dates) from the rows of events() for each returning type
+        if returning == "rows":
+            # The rows themselves, counted per window by window_counts
+            return rows, None
+        positions = rows["position"].to_numpy()
+        if all_matches:
+            # The first row of every day with a match, as the _1.._n chains ("{name}_{i-1} + 1 day")
+            # find them, without a cap on their number
+            new_day = first_in_group(positions)
+            new_day[1:] |= np.diff(rows["date"].to_numpy()) != 0
+            return rows[new_day]
+        if returning == "number_of_matches_in_period":
+            return np.bincount(positions, minlength=self.size), None
+        if returning == "number_of_episodes":
+            # Without episode_defined_as, each day with a match is an episode
+            washout = 0
+            if episode_defined_as is not None:
+                match = EPISODE_DEFINITION.match(episode_defined_as)
+                if match is None:
+                    raise ValueError(f"Unsupported episode definition: {episode_defined_as}")
+                washout = int(match.group(1))
+            new_episode = first_in_group(positions)
+            new_episode[1:] |= np.diff(rows["date"].to_numpy()) > washout
+            return np.bincount(positions[new_episode], minlength=self.size), None
+        # Without find_first_match_in_period the last match is used, as in tpp_backend.py
+        if not find_first_match_in_period:
+            last = np.lexsort((rows["row"].to_numpy(), -rows["date"].to_numpy(), positions))
+            rows = rows.iloc[last]
+            positions = positions[last]
+        return self.returned(rows[first_in_group(positions)], returning)
+
+    def returned(self, chosen, returning):
+        # (values, dates) from the match chosen for each patient with one
+        patients = chosen["position"].to_numpy()
+        dates = self.per_patient(patients, chosen["date"].to_numpy(), "date")
+        if returning in ("binary_flag", "date", "date_admitted", "date_arrived", "date_of_death"):
+            if returning == "binary_flag":
+                return self.per_patient(patients, True, "bool"), dates
+            return dates, dates
+        if returning == "numeric_value":
+            return self.per_patient(patients, chosen["value"].fillna(0.0).to_numpy(float), "float"), dates
+        if returning in ("code", "category"):
+            return self.per_patient(patients, chosen[returning].fillna("").to_numpy(object), "str"), dates
+        raise ValueError(f"Unsupported returning value in the local backend: {returning}")
+
+    def patients_with_these_clinical_events(self, columns, codelist, returning="binary_flag", between=None,
+                                            ignore_days_where_these_codes_occur=None,
+                                            ignore_missing_values=False, **matching):
+        unsupported(ignore_days_where_these_codes_occur=ignore_days_where_these_codes_occur)
+        table, code_column = CLINICAL_EVENT_TABLES[codelist.system]
+        rows = self.events(
+            table,
+            "ConsultationDate",
+            columns,
+            between,
+            codelist,
+            code_column,
+            value_column="NumericValue",
+            condition=IGNORE_MISSING_VALUES if ignore_missing_values else "1 = 1",
+        )
+        return self.matches(rows, returning, **matching)
+
+    def patients_with_these_medications(self, columns, codelist, returning="binary_flag", between=None,
+                                        ignore_days_where_these_codes_occur=None, **matching):
+        unsupported(ignore_days_where_these_codes_occur=ignore_days_where_these_codes_occur)
+        rows = self.events("MedicationIssue", "ConsultationDate", columns, between, codelist, "DMD_ID")
+        return self.matches(rows, returning, **matching)
+
+    def patients_admitted_to_hospital(self, columns, with_these_primary_diagnoses=None, returning="binary_flag",
+                                      between=None, find_first_match_in_period=None,
+                                      find_last_match_in_period=None, all_matches=False, **filters):
+        unsupported(**filters)
+        rows = self.events(
+            "APCS",
+            "Admission_Date",
+            columns,
+            between,
+            with_these_primary_diagnoses,
+            "Spell_Primary_Diagnosis",
+            match_prefix=True,
+        )
+        return self.matches(
+            rows, returning, find_first_match_in_period, find_last_match_in_period, all_matches=all_matches
+        )
+
+    def patients_attended_emergency_care(self, columns, with_these_diagnoses=None, returning="binary_flag",
+                                         between=None, find_first_match_in_period=None,
+                                         find_last_match_in_period=None, discharged_to=None, all_matches=False):
+        unsupported(discharged_to=discharged_to)
+        rows = self.events("EC", "Arrival_Date", columns, between, with_these_diagnoses, "EC_Diagnosis_01")
+        return self.matches(
+            rows, returning, find_first_match_in_period, find_last_match_in_period, all_matches=all_matches
+        )
+
+    def patients_died_from_any_cause(self, columns, returning="binary_flag", between=None):
+        rows = self.events("ONS_Deaths", "dod", columns, between)
+        return self.matches(rows, returning, find_first_match_in_period=True)
+
+    def patients_most_recent_bmi(self, columns, between=None, minimum_age_at_measurement=16):
+        rows = self.events(
+            "CodedEvent",
+            "ConsultationDate",
+            columns,
+            between,
+            [BMI_CODE],
+            "CTV3Code",
+            value_column="NumericValue",
+        )
+        rows = rows[self.measured_at_age(rows, minimum_age_at_measurement)]
+        values, dates = self.matches(rows, "numeric_value", find_last_match_in_period=True)
+        return np.round(values, 1), dates
+
+    def measured_at_age(self, rows, minimum_age):
+        # Mask of the rows from the minimum age on (in calendar years, as DATEDIFF)
+        measured_year = civil_from_days(rows["date"].to_numpy().astype("int64"))[0]
+        birth_year = civil_from_days(self.date_of_birth[rows["position"].to_numpy()].astype("int64"))[0]
+        return measured_year - birth_year >= int(minimum_age)
+
+    def patients_age_as_of(self, columns, reference_date):
+        reference = np.broadcast_to(self.resolve(reference_date, columns), (self.size,))
+        missing = np.isnan(reference)
+        year, month, day = civil_from_days(np.nan_to_num(reference).astype("int64"))
+        birth_year, birth_month, birth_day = civil_from_days(self.date_of_birth.astype("int64"))
+        before_birthday = (month < birth_month) | ((month == birth_month) & (day < birth_day))
+        return np.where(missing, 0, year - birth_year - before_birthday)
+
+    def patients_date_of_birth(self, columns):
+        return self.date_of_birth
+
+    def patients_sex(self, columns):
+        return self.sex
+
+    def period_table(self, table):
+        # Registration or address periods of every patient (read once; they are small tables)
+        with self.lock:
+            if table not in self.periods:
+                rows = self.read_sql(PERIOD_QUERIES[table])
+                rows["position"] = np.searchsorted(self.patient_ids, rows["patient_id"].to_numpy())
+                self.periods[table] = rows
+        return self.periods[table]
+
+    def current_periods(self, table, columns, start_date, end_date=None):
+        # Each patient's period that started on or before start_date and ends after end_date; the
+        # most recent start, then the latest end, is used where they overlap
+        rows = self.period_table(table)
+        positions = rows["position"].to_numpy()
+        start, end = (
+            np.broadcast_to(self.resolve(day, columns), (self.size,))[positions]
+            for day in (start_date, end_date or start_date)
+        )
+        with np.errstate(invalid="ignore"):
+            rows = rows[(rows["start"].to_numpy() <= start) & (rows["end"].to_numpy() > end)]
+        order = np.lexsort(
+            (rows["row"].to_numpy(), -rows["end"].to_numpy(), -rows["start"].to_numpy(), rows["position"].to_numpy())
+        )
+        rows = rows.iloc[order]
+        return rows[first_in_group(rows["position"].to_numpy())]
+
+    def patients_registered_with_one_practice_between(self, columns, start_date, end_date):
+        rows = self.current_periods("registrations", columns, start_date, end_date)
+        return self.per_patient(rows["position"].to_numpy(), True, "bool")
+
+    def patients_registered_as_of(self, columns, reference_date):
+        return self.patients_registered_with_one_practice_between(columns, reference_date, reference_date)
+
+    def patients_registered_practice_as_of(self, columns, date, returning):
+        column_types = {"pseudo_id": "int", "stp_code": "str", "nuts1_region_name": "str"}
+        if returning not in column_types:
+            raise ValueError(f"Unsupported returning value in the local backend: {returning}")
+        rows = self.current_periods("registrations", columns, date)
+        return self.per_patient(rows["position"].to_numpy(), rows[returning].to_numpy(), column_types[returning])
+
+    def patients_address_as_of(self, columns, date, returning, round_to_nearest=None):
+        if returning != "index_of_multiple_deprivation":
+            raise ValueError(f"Unsupported returning value in the local backend: {returning}")
+        rows = self.current_periods("addresses", columns, date)
+        # Patients without an address get -1, as in tpp_backend.py
+        result = np.full(self.size, -1)
+        result[rows["position"].to_numpy()] = rows[returning].to_numpy()
+        return result
+
+    def patients_categorised_as(self, columns, category_definitions):
+        # The first category whose expression holds, else the DEFAULT category
+        categories = [category for category, expression in category_definitions.items() if expression != "DEFAULT"]
+        (default,) = [category for category, expression in category_definitions.items() if expression == "DEFAULT"]
+        str_categories = any(isinstance(category, str) for category in category_definitions)
+        result = np.full(self.size, default, dtype=object if str_categories else None)
+        assigned = np.zeros(self.size, bool)
+        for category in categories:
+            matched = evaluate_expression(category_definitions[category], columns) & ~assigned
+            result[matched] = category
+            assigned |= matched
+        return result
+
+
+def to_frame(results, covariate_definitions):
+    # Output columns in definition order, for the patients in the population
+    frame = {"patient_id": results["population"].index.to_numpy()}
+    for name, (query_type, args) in covariate_definitions.items():
+        if name == "population" or args["hidden"]:
+            continue
+        values = results[name].to_numpy()
+        if args["column_type"] == "date":
+            frame[name] = date_column(values.astype(float), args.get("date_format"))
+        elif args["column_type"] == "str":
+            frame[name] = pd.Categorical(values.astype(str))
+        else:
+            frame[name] = values.astype({"bool": bool, "int": "int64", "float": float}[args["column_type"]])
+    frame = pd.DataFrame(frame)
+    return frame[results["population"].to_numpy().astype(bool)].reset_index(drop=True)
+
+
+def write_cohort(cohort, output, monitors=(), batch_size=BATCH_SIZE):
+    # Write the cohort in batches of patients, reporting each batch to the monitors
+    # (extraction_progress.Progress)
+    output = Path(output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    for monitor in monitors:
+        monitor.writing(len(cohort))
+    batches = (cohort.iloc[start : start + batch_size] for start in range(0, max(len(cohort), 1), batch_size))
+    if output.suffix == ".csv":
+        # Flags are written as 1/0, as cohortextractor writes them
+        flags = cohort.select_dtypes(bool).columns
+        with open(output, "w", newline="") as f:
+            for i, batch in enumerate(batches):
+                batch.astype({flag: int for flag in flags}).to_csv(f, index=False, header=i == 0)
+                for monitor in monitors:
+                    monitor.written(len(batch), f.tell())
+    else:
+        schema = pa.Schema.from_pandas(cohort, preserve_index=False)
+        with pa.OSFile(str(output), "wb") as sink, pa.ipc.new_file(
+            sink, schema, options=pa.ipc.IpcWriteOptions(compression="lz4")
+        ) as writer:
+            for batch in batches:
+                writer.write_table(pa.Table.from_pandas(batch, schema=schema, preserve_index=False))
+                for monitor in monitors:
+                    monitor.written(len(batch), sink.tell())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("study_definition")
+    parser.add_argument("database")
+    parser.add_argument("--index-date")
+    parser.add_argument("--output")
+    parser.add_argument("--jobs", type=int, help="variables evaluated at once (default: one per CPU)")
+    parser.add_argument("--cache", action="store_true", help="reuse results from output/variable_cache")
+    parser.add_argument(
+        "--trace", help="write a record per variable, e.g. logs/generate_study_population.trace.jsonl"
+    )
+    parser.add_argument("--progress", action="store_true", help="report progress to stderr and a status file")
+    parser.add_argument("--progress-interval", type=float, default=INTERVAL)
+    parser.add_argument("--status-file", help="default: <output>.status.json")
+    parser.add_argument(
+        "--repeated-events", metavar="DIR", help="also write the study's repeated events (repeated_events.py) to DIR"
+    )
+    args = parser.parse_args()
+
+    study = load_study(args.study_definition, args.index_date)
+    output = Path(args.output or f"output/{args.study_definition.replace('study_definition', 'input')}.feather")
+    backend = LocalBackend(args.database, study.covariate_definitions)
+    tracer = Tracer(args.trace, backend) if args.trace else None
+    progress = None
+    if args.progress:
+        status_file = args.status_file or output.with_suffix(".status.json")
+        progress = Progress(len(study.covariate_definitions), status_file, args.progress_interval)
+    monitors = [monitor for monitor in (tracer, progress) if monitor is not None]
+    writers = [progress] if progress is not None else []
+    stage = "failed"
+    try:
+        results = backend.run(jobs=args.jobs, cache=VariableCache() if args.cache else None, monitors=monitors)
+        cohort = to_frame(results, study.covariate_definitions)
+        write_cohort(cohort, output, writers)
+        if args.repeated_events:
+            # Long tables, kept apart from the outputs of the production actions, e.g.
+            # DIR/input_urate_test.feather
+            for name, table in backend.repeated_events(load_repeated_events(args.study_definition, study)).items():
+                write_cohort(table, Path(args.repeated_events) / f"{output.stem}_{name}{output.suffix}")
+        stage = "done"
+    finally:
+        if tracer is not None:
+            tracer.close()
+        if progress is not None:
+            progress.done(stage)
+    print(f"{len(cohort)} patients written to {output}")
+
+
+if __name__ == "__main__":
+    main()
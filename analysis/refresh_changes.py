@@ -0,0 +1,80 @@
+from cohortextractor import StudyDefinition, params, patients
+
+from study_definition import study as cohort_study
+from variable_cache import canonical
+
+# Patients whose study_definition variables may have changed since the last extraction
+## Extracted by analysis/incremental_refresh.py (changes); it is not named study_definition_* so
+## that a plain generate_cohort does not extract it with the study definitions. Every result of study_definition depends only on events
+## up to the extraction date, so a patient needs to be re-extracted only if they have an event
+## since then (watermark, from --param watermark=YYYY-MM-DD) in one of the codelists or tables it
+## uses, or a change of registration. The output (patient_id) is passed back to study_definition
+## as --param refresh_patients=<csv>. Without a watermark every patient with an event is included.
+watermark = params.get("watermark", "1900-01-01")
+end_date = "today"
+
+since_watermark = {
+    "between": [watermark, end_date],
+    "return_expectations": {"incidence": 0.05},
+}
+
+
+def events_since_watermark(query_type, args):
+    if query_type == "with_these_clinical_events":
+        return patients.with_these_clinical_events(args["codelist"], **since_watermark)
+    if query_type == "with_these_medications":
+        return patients.with_these_medications(args["codelist"], **since_watermark)
+    if query_type == "admitted_to_hospital":
+        return patients.admitted_to_hospital(
+            with_these_primary_diagnoses=args["with_these_primary_diagnoses"], **since_watermark
+        )
+    if query_type == "attended_emergency_care":
+        return patients.attended_emergency_care(
+            with_these_diagnoses=args["with_these_diagnoses"], **since_watermark
+        )
+    if query_type == "died_from_any_cause":
+        return patients.died_from_any_cause(**since_watermark)
+    if query_type == "most_recent_bmi":
+        return patients.most_recent_bmi(
+            between=[watermark, end_date],
+            return_expectations={
+                "incidence": 0.05,
+                "float": {"distribution": "normal", "mean": 35, "stddev": 10},
+            },
+        )
+    return None
+
+
+# One variable per distinct (query type, codelist) used by study_definition
+event_sources = {}
+for name, (query_type, args) in cohort_study.covariate_definitions.items():
+    source = events_since_watermark(query_type, args)
+    codelists = {
+        argument: canonical(value)
+        for argument, value in args.items()
+        if argument in ["codelist", "with_these_primary_diagnoses", "with_these_diagnoses"]
+    }
+    key = repr((query_type, sorted(codelists.items())))
+    if source is not None and key not in event_sources:
+        event_sources[key] = (f"events_{name}", source)
+
+
+study = StudyDefinition(
+    default_expectations={
+        "date": {"earliest": watermark, "latest": end_date},
+        "rate": "uniform",
+        "incidence": 0.05,
+    },
+    population=patients.satisfying(
+        " OR ".join([name for name, _ in event_sources.values()] + ["registration_changed"]),
+        registration_changed=patients.satisfying(
+            "(registered_at_watermark OR registered_now) AND NOT registered_throughout",
+            registered_at_watermark=patients.registered_as_of(watermark),
+            registered_now=patients.registered_as_of(end_date),
+            registered_throughout=patients.registered_with_one_practice_between(
+                watermark, end_date
+            ),
+        ),
+    ),
+    **dict(event_sources.values()),
+)
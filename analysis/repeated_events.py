@@ -0,0 +1,61 @@
+"""
+Repeated events of the study definitions, for the local backend only
+
+Every event of a repeated-event variable, without the cap of n of its wide _1.._n columns: one
+row per day with a match (patient_id, order, date, value, code), written as a long table by
+analysis/local_backend.py --repeated-events DIR, e.g. DIR/input_urate_test.feather. They are read
+by study_plan.load_repeated_events, by the name of the study definition, and dated like its
+covariates (they may refer to its columns, e.g. gout_code_date).
+
+These cannot be part of the production extraction: cohortextractor generate_cohort writes one row
+per patient, and none of its variable types returns more than one match. The actions of
+project.yaml therefore keep the wide columns, with n chosen from the counts of
+study_definition_count.py, and no action reads these tables. They are for checking a choice of n
+on a local database: the first n orders of each table equal the wide columns.
+"""
+from cohortextractor import patients
+
+from codelists import flare_treatment, gout_admission, gout_codes, gout_flare, urate_codes
+
+# Has no effect under cohortextractor generate_cohort, which only extracts the study of a study
+# definition
+REPEATED_EVENTS = {
+    "study_definition": {
+        "urate_test": patients.with_these_clinical_events(
+            urate_codes,
+            returning="numeric_value",
+            date_format="YYYY-MM-DD",
+            between=["gout_code_date - 6 months", "gout_code_date + 1 year"],
+        ),
+        "gout_admission": patients.admitted_to_hospital(
+            with_these_primary_diagnoses=gout_admission,
+            returning="date_admitted",
+            date_format="YYYY-MM-DD",
+            between=["gout_code_date - 1 month", "gout_code_date + 1 year"],
+        ),
+        "gout_emerg": patients.attended_emergency_care(
+            with_these_diagnoses=gout_codes,
+            returning="date_arrived",
+            date_format="YYYY-MM-DD",
+            between=["gout_code_date - 1 month", "gout_code_date + 1 year"],
+        ),
+        "gout_flare": patients.with_these_clinical_events(
+            gout_flare,
+            returning="date",
+            date_format="YYYY-MM-DD",
+            between=["gout_code_date + 14 days", "gout_code_date + 1 year"],
+        ),
+        "gout_code_any": patients.with_these_clinical_events(
+            gout_codes,
+            returning="date",
+            date_format="YYYY-MM-DD",
+            between=["gout_code_date + 14 days", "gout_code_date + 1 year"],
+        ),
+        "flare_treatment": patients.with_these_medications(
+            flare_treatment,
+            returning="date",
+            date_format="YYYY-MM-DD",
+            between=["gout_code_date + 14 days", "gout_code_date + 1 year"],
+        ),
+    },
+}
@@ -0,0 +1,87 @@
+"""
+Split the multi-date year cohort (output/input_year.feather) into one file per index date
+
+study_definition_year extracts every index date in a single pass: date of birth, sex and the
+first prevalent gout code once per patient, and registration/admission variables once per date
+(suffixed _YYYYMMDD). This writes output/measures/input_year_<date>.dta for each date, with
+the same columns as a single --index-date-range run, so generate_measures and
+003_define_admissions.do read them unchanged. Patients are read and written in batches
+(--batch-size), so memory does not grow with the size of the population.
+"""
+import argparse
+import re
+from pathlib import Path
+
+import pandas as pd
+
+from cohort_io import BATCH_SIZE, StataBatchWriter, read_cohort_batches, stata_layout
+
+SUFFIX = re.compile(r"^registered_(\d{4})(\d\d)(\d\d)$")
+PER_DATE_COLUMNS = ["registered", "gout_adm_date", "pre_registration", "adm_registration"]
+OUTPUT_COLUMNS = [
+    "registered",
+    "age",
+    "sex",
+    "prevalent_gout",
+    "gout_admission",
+    "gout_adm_date",
+    "pre_registration",
+    "adm_registration",
+    "patient_id",
+]
+
+
+def index_dates(cohort):
+    return [
+        "-".join(match.groups())
+        for match in map(SUFFIX.match, cohort.columns)
+        if match
+    ]
+
+
+def age_at(date_of_birth, index_date):
+    # Full years between date of birth (YYYY-MM, stored as the 1st) and the index date
+    index_date = pd.Timestamp(index_date)
+    before_birthday = index_date.month < date_of_birth.dt.month
+    return index_date.year - date_of_birth.dt.year - before_birthday.astype(int)
+
+
+def cohort_at(cohort, index_date):
+    suffix = index_date.replace("-", "")
+    at_date = cohort[["patient_id", "sex"]].assign(
+        **{column: cohort[f"{column}_{suffix}"] for column in PER_DATE_COLUMNS}
+    )
+    at_date["age"] = age_at(cohort["date_of_birth"], index_date)
+    at_date["prevalent_gout"] = (cohort["prevalent_gout_date"] <= index_date).astype(int)
+    at_date["gout_admission"] = at_date["gout_adm_date"].notna().astype(int)
+    # Population as in a single-date run: registered at index date, aged 18-110, male or female
+    population = (
+        at_date["registered"].astype(bool)
+        & at_date["age"].between(18, 110)
+        & at_date["sex"].isin(["M", "F"])
+    )
+    return at_date.loc[population, OUTPUT_COLUMNS]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--input", default="output/input_year.feather")
+    parser.add_argument("--output-dir", default="output/measures")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+    writers = {}
+    for batch in read_cohort_batches(args.input, batch_size=args.batch_size):
+        for index_date in index_dates(batch):
+            at_date = cohort_at(batch, index_date)
+            if index_date not in writers:
+                path = Path(args.output_dir) / f"input_year_{index_date}.dta"
+                writers[index_date] = StataBatchWriter(path, stata_layout(at_date))
+            writers[index_date].write(at_date)
+    for writer in writers.values():
+        writer.close()
+
+
+if __name__ == "__main__":
+    main()
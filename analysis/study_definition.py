@@ -1,12 +1,45 @@
-from cohortextractor import StudyDefinition, patients
+from cohortextractor import StudyDefinition, params, patients
 
 from cohortextractor.codelistlib import filter_codes_by_category
 
-from codelists import *
+from codelists import (
+    allopurinol_codes,
+    chronic_cardiac_disease_codes,
+    chronic_liver_disease_codes,
+    chronic_respiratory_disease_codes,
+    ckd_codes,
+    clear_smoking_codes,
+    copd_codes,
+    creatinine_codes,
+    diabetes_codes,
+    diuretic_codes,
+    ethnicity_codes,
+    febuxostat_codes,
+    flare_treatment,
+    gout_admission,
+    gout_codes,
+    gout_flare,
+    haem_cancer_codes,
+    hba1c_new_codes,
+    hba1c_old_codes,
+    hypertension_codes,
+    lung_cancer_codes,
+    organ_transplant_codes,
+    other_cancer_codes,
+    stroke_codes,
+    tophi_codes,
+    ult_codes,
+    urate_codes,
+)
+
+from variables import first_n_bloods_in_period
 
 year_preceding = "2014-03-01"
 start_date = "2015-03-01"
 end_date = "today"
+# Incremental refresh (analysis/incremental_refresh.py): --param refresh_patients=<csv> restricts
+# the population to the patients listed in the csv (those with events since the last extraction)
+refresh_patients = params.get("refresh_patients")
 
 
 # Date of first gout code in primary care record
@@ -86,34 +119,6 @@ def with_these_medication_events_date_X(name, codelist, index_date, n, return_ex
     return variables
 
 
-# Get dates of recurrent blood tests (up to 1 year after diagnosis)
-def with_these_bloods_date_X(name, codelist, index_date, n, return_expectations):
-    def var_signature(name, codelist, on_or_after, return_expectations):
-        return {
-            name: patients.with_these_clinical_events(
-                codelist,
-                find_first_match_in_period=True,
-                returning="numeric_value",
-                include_date_of_match=True,
-                date_format="YYYY-MM-DD",
-                between=[on_or_after, "gout_code_date + 1 year"],
-                return_expectations=return_expectations,
-            ),
-        }
-
-    variables = var_signature(f"{name}_1", codelist, index_date, return_expectations)
-    for i in range(2, n + 1):
-        variables.update(
-            var_signature(
-                f"{name}_{i}",
-                codelist,
-                f"{name}_{i-1}_date + 1 day",
-                return_expectations,
-            )
-        )
-    return variables
-
-
 # Get dates of recurrent admissions for gout flares (up to 1 year after diagnosis)
 def with_these_admitted_events_date_X(name, codelist, index_date, n, return_expectations):
     def var_signature(name, codelist, on_or_after, return_expectations):
@@ -178,10 +183,12 @@ study = StudyDefinition(
             has_follow_up AND
             (age >=18 AND age <= 110) AND
             (sex = "M" OR sex = "F")
-            """,
+            """
+        + (" AND refreshed" if refresh_patients else ""),
         has_follow_up=patients.registered_with_one_practice_between(
             "gout_code_date - 1 year", "gout_code_date"
         ),
+        **({"refreshed": patients.which_exist_in_file(refresh_patients)} if refresh_patients else {}),
     ),
     ## Has at least 6m of registration after index diagnosis
     has_6m_follow_up=patients.registered_with_one_practice_between(
@@ -350,10 +357,10 @@ study = StudyDefinition(
     ),
     # Serum urate monitoring (from 6 months before diagnosis to up to 1 year after diagnosis)
     ## Return first n serum urate levels after diagnosis
-    **with_these_bloods_date_X(
+    **first_n_bloods_in_period(
         name="urate_test",
         codelist=urate_codes,
-        index_date="gout_code_date - 6 months",
+        between=["gout_code_date - 6 months", "gout_code_date + 1 year"],
         n=7,
         return_expectations={
             "date": {"earliest": "2014-03-01", "latest": end_date},
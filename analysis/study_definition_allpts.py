@@ -1,6 +1,25 @@
 from cohortextractor import StudyDefinition, patients, codelist, codelist_from_csv, combine_codelists, filter_codes_by_category
 
-from codelists import *
+from codelists import (
+    chronic_cardiac_disease_codes,
+    chronic_liver_disease_codes,
+    chronic_respiratory_disease_codes,
+    ckd_codes,
+    clear_smoking_codes,
+    copd_codes,
+    creatinine_codes,
+    diabetes_codes,
+    diuretic_codes,
+    ethnicity_codes,
+    haem_cancer_codes,
+    hba1c_new_codes,
+    hba1c_old_codes,
+    hypertension_codes,
+    lung_cancer_codes,
+    organ_transplant_codes,
+    other_cancer_codes,
+    stroke_codes,
+)
 
 year_preceding = "2018-03-01"
 # Choosing mid-study year as reference date
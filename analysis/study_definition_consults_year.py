@@ -2,7 +2,9 @@ from cohortextractor import StudyDefinition, patients, Measure
 
 from cohortextractor.codelistlib import filter_codes_by_category
 
-from codelists import *
+from codelists import prevalent_gout_codes, ult_codes, urate_codes
+
+from variables import first_n_bloods_in_period
 
 # Date of first consultation for gout in primary care record within a 1-year period - code
 def first_consultation_in_period(dx_codelist):
@@ -65,33 +67,6 @@ def first_code_in_period(dx_codelist):
         },
     )
 
-# Get dates of recurrent blood tests (up to 6 months after consultation)
-def with_these_bloods_date_X(name, codelist, index_date, n, return_expectations):
-    def var_signature(name, codelist, on_or_after, return_expectations):
-        return {
-            name: patients.with_these_clinical_events(
-                codelist,
-                find_first_match_in_period=True,
-                returning="numeric_value",
-                include_date_of_match=True,
-                date_format="YYYY-MM-DD",
-                between=[on_or_after, "gout_code_date + 6 months"],
-                return_expectations=return_expectations,
-            ),
-        }
-
-    variables = var_signature(f"{name}_1", codelist, index_date, return_expectations)
-    for i in range(2, n + 1):
-        variables.update(
-            var_signature(
-                f"{name}_{i}",
-                codelist,
-                f"{name}_{i-1}_date + 1 day",
-                return_expectations,
-            )
-        )
-    return variables
-
 study = StudyDefinition(
     # Configure the expectations framework
     default_expectations={
@@ -235,10 +210,10 @@ study = StudyDefinition(
 
     # Serum urate monitoring (from 6 months before consultation to up to 6 months after consultation)
     ## Return first n serum urate levels after diagnosis
-    **with_these_bloods_date_X(
+    **first_n_bloods_in_period(
         name="urate_test",
         codelist=urate_codes,
-        index_date="gout_code_date - 6 months",
+        between=["gout_code_date - 6 months", "gout_code_date + 6 months"],
         n=7,
         return_expectations={
             "date": {"earliest": "index_date - 6 months", "latest": "index_date + 18 months"},
@@ -2,7 +2,14 @@ from cohortextractor import StudyDefinition, patients
 
 from cohortextractor.codelistlib import filter_codes_by_category
 
-from codelists import *
+from codelists import (
+    flare_treatment,
+    gout_admission,
+    gout_codes,
+    gout_flare,
+    urate_codes,
+    urate_codes_snomed,
+)
 
 year_preceding = "2018-03-01"
 start_date = "2019-03-01"
@@ -1,8 +1,60 @@
+import calendar
+from datetime import date
+
 from cohortextractor import StudyDefinition, patients, Measure
 
 from cohortextractor.codelistlib import filter_codes_by_category
 
-from codelists import *
+from codelists import gout_admission, prevalent_gout_codes
+
+# Mid-year estimates (March to March for purposes of these analyses, so Sept = midpoint)
+## All years are extracted together: variables that do not depend on the index date are
+## defined once, and the rest once per date with a _YYYYMMDD suffix.
+## split_index_dates.py then writes one output/measures/input_year_<date>.dta per date.
+index_dates = [f"{year}-09-01" for year in range(2015, 2024)]
+
+
+# Shift an ISO date by whole months (date expressions only support arithmetic on index_date)
+def add_months(iso_date, months):
+    d = date.fromisoformat(iso_date)
+    year, month = divmod(d.month - 1 + months, 12)
+    year, month = d.year + year, month + 1
+    day = min(d.day, calendar.monthrange(year, month)[1])
+    return date(year, month, day).isoformat()
+
+
+def variables_at(index_date):
+    suffix = index_date.replace("-", "")
+    return {
+        # Denominator for prevalence would be all patients registered at index date
+        f"registered_{suffix}": patients.registered_as_of(index_date),
+        # Returns data of first admission within that year for patient (would miss repeat admissions); Nb. for admissions, this is from April to April
+        ## gout_admission (binary flag) is derived from this in split_index_dates.py
+        f"gout_adm_date_{suffix}": patients.admitted_to_hospital(
+            with_these_primary_diagnoses=gout_admission,
+            find_first_match_in_period=True,
+            returning="date_admitted",
+            date_format="YYYY-MM-DD",
+            between=[add_months(index_date, -5), add_months(index_date, 7)],
+            return_expectations={
+                "date": {"earliest": add_months(index_date, -5), "latest": add_months(index_date, 7)},
+                "incidence": 0.05,
+            },
+        ),
+        # Denominator for incidence: patients with at least 12 months of registration with one practice before index date
+        f"pre_registration_{suffix}": patients.registered_with_one_practice_between(
+            start_date=add_months(index_date, -12),
+            end_date=index_date,
+            return_expectations={"incidence": 0.98},
+        ),
+        # Denominator for admissions could be patients with at least 6 months of registration before and after index date vs. single mid-year (as above)
+        f"adm_registration_{suffix}": patients.registered_with_one_practice_between(
+            start_date=add_months(index_date, -6),
+            end_date=add_months(index_date, 6),
+            return_expectations={"incidence": 0.98},
+        ),
+    }
+
 
 study = StudyDefinition(
 
@@ -13,24 +65,23 @@ study = StudyDefinition(
         "incidence": 0.5,
     },
 
-    # Mid-year estimate (March to March for purposes of these analyses, so Sept = midpoint)
-    index_date = "2015-09-01",
+    index_date = index_dates[-1],
  
-    # Define study population
+    # Define study population: registered at any of the index dates (age and registration at each date are applied in split_index_dates.py)
     population=patients.satisfying(
-            """
-            registered AND
-            (age >=18 AND age <= 110) AND
+            "("
+            + " OR ".join(f"registered_{d.replace('-', '')}" for d in index_dates)
+            + """) AND
             (sex = "M" OR sex = "F")
             """,
-            # Denominator for prevalence would be all patients registered at index date
-            registered=patients.registered_as_of("index_date"),
         ),        
-    age=patients.age_as_of(
-        "index_date",
+    # Age at each index date is calculated from date of birth in split_index_dates.py
+    date_of_birth=patients.date_of_birth(
+        "YYYY-MM",
         return_expectations={
-            "rate": "universal",
-            "int": {"distribution": "population_ages"},
+            "rate": "uniform",
+            "incidence": 1,
+            "date": {"earliest": "1910-01-01", "latest": "2005-12-31"},
         },
     ),
     sex=patients.sex(
@@ -39,46 +90,19 @@ study = StudyDefinition(
             "category": {"ratios": {"M": 0.49, "F": 0.51}},
         }
     ),
-    # Prevalent gout patients: i.e. registered patients with a gout diagnosis code at any point before index date
-    prevalent_gout=patients.with_these_clinical_events(
+    # Prevalent gout patients: i.e. registered patients with a gout diagnosis code at any point before index date (first code date, compared with each index date in split_index_dates.py)
+    prevalent_gout_date=patients.with_these_clinical_events(
         prevalent_gout_codes,
-        returning="binary_flag",
-        on_or_before="index_date",
-        return_expectations={
-            "incidence": 0.1,
-        },
-    ),    
-    # Incidence of admissions to hospital with primary diagnosis code of gout; Nb. for admissions, this is from April to April
-    gout_admission=patients.admitted_to_hospital(
-        with_these_primary_diagnoses=gout_admission,
-        returning="binary_flag",
-        between=["index_date - 5 months", "index_date + 7 months"],
-        return_expectations={"incidence": 0.1},
-    ),
-    # Returns data of first admission within that year for patient (would miss repeat admissions); Nb. for admissions, this is from April to April
-    gout_adm_date=patients.admitted_to_hospital(
-        with_these_primary_diagnoses=gout_admission,
+        returning="date",
         find_first_match_in_period=True,
-        returning="date_admitted",
         date_format="YYYY-MM-DD",
-        between=["index_date - 5 months", "index_date + 7 months"],
+        on_or_before=index_dates[-1],
         return_expectations={
-            "date": {"earliest": "2015-04-01", "latest": "2022-03-31"},
-            "incidence": 0.05,
+            "date": {"earliest": "1950-01-01", "latest": index_dates[-1]},
+            "incidence": 0.1,
         },
-    ),
-    # Denominator for incidence: patients with at least 12 months of registration with one practice before index date
-    pre_registration=patients.registered_with_one_practice_between(
-        start_date="index_date - 12 months",
-        end_date="index_date",   
-        return_expectations={"incidence": 0.98},  
-    ),   
-    # Denominator for admissions could be patients with at least 6 months of registration before and after index date vs. single mid-year (as above)
-    adm_registration=patients.registered_with_one_practice_between(
-        start_date="index_date - 6 months",
-        end_date="index_date + 6 months",   
-        return_expectations={"incidence": 0.98},  
-    ),   
+    ),    
+    **{name: variable for d in index_dates for name, variable in variables_at(d).items()},
 )
 measures = [
     Measure(
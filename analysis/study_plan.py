@@ -0,0 +1,148 @@
+"""
+Dependency plan for the variables of a study definition
+
+Most variables depend only on gout_code_date or first_ult_date; the _X chains
+("{name}_{i-1} + 1 day"), value_from date columns and satisfying/categorised_as expressions
+are the only real dependencies between variables. The graph is built from the processed
+covariate definitions (date expressions, expressions and source columns) and split into
+levels: every variable in a level depends only on variables in earlier levels, so a level can
+be evaluated concurrently. run_by_level evaluates a study level by level on a thread or process
+pool and reports the wall-clock time of each level.
+
+Usage (from the repository root):
+
+    python analysis/study_plan.py study_definition [--index-date YYYY-MM-DD]
+"""
+import argparse
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from cohortextractor.cohortextractor import load_study_definition
+from cohortextractor.study_definition import (
+    evaluate_date_expressions_in_covariate_definitions,
+    process_covariate_definitions,
+)
+
+from repeated_events import REPEATED_EVENTS
+
+IDENTIFIER = re.compile(r"[A-Za-z_]\w*")
+QUOTED = re.compile(r"'[^']*'|\"[^\"]*\"")
+# Arguments that never refer to other columns
+NON_REFERENCE_ARGUMENTS = {"return_expectations", "returning", "date_format", "column_type", "hidden"}
+
+
+def load_study(name, index_date=None):
+    study = load_study_definition(name)
+    if index_date is not None:
+        study.set_index_date(index_date)
+    return study
+
+
+def load_repeated_events(name, study):
+    # The repeated events of a study definition loaded with load_study (every matching event, as a
+    # long table; see repeated_events.py), processed and dated like its covariates; {} if it has none
+    definitions = REPEATED_EVENTS.get(name, {})
+    if not definitions:
+        return {}
+    # Dates are evaluated alongside the covariates, so that they can refer to them
+    evaluated = evaluate_date_expressions_in_covariate_definitions(
+        {**study.covariate_definitions, **process_covariate_definitions(definitions)}, study.index_date
+    )
+    return {name: evaluated[name] for name in definitions}
+
+
+def is_codelist(value):
+    return isinstance(value, list) and hasattr(value, "system")
+
+
+def references(value, columns):
+    # Names of the columns referred to anywhere in an argument value
+    if isinstance(value, str):
+        return set(IDENTIFIER.findall(QUOTED.sub("", value))) & columns
+    if isinstance(value, dict):
+        return set().union(*[references(item, columns) for item in value.values()])
+    if isinstance(value, (list, tuple)) and not is_codelist(value):
+        return set().union(*[references(item, columns) for item in value])
+    return set()
+
+
+def definition_references(args, columns):
+    # Names of the columns the arguments of one definition refer to
+    return set().union(
+        *[references(value, columns) for argument, value in args.items() if argument not in NON_REFERENCE_ARGUMENTS]
+    )
+
+
+def dependency_graph(covariate_definitions):
+    # {name: set of the columns its definition depends on}
+    columns = set(covariate_definitions)
+    return {
+        name: definition_references(args, columns) - {name}
+        for name, (query_type, args) in covariate_definitions.items()
+    }
+
+
+def levels(graph):
+    # Variables grouped so that each depends only on variables in earlier groups
+    remaining = dict(graph)
+    done = set()
+    grouped = []
+    while remaining:
+        level = sorted(name for name, needs in remaining.items() if needs <= done)
+        if not level:
+            raise ValueError(f"Circular dependency between: {', '.join(sorted(remaining))}")
+        grouped.append(level)
+        done.update(level)
+        for name in level:
+            del remaining[name]
+    return grouped
+
+
+def run_by_level(covariate_definitions, evaluate, jobs=None, processes=False, report=print):
+    """Evaluate every variable, running the variables of each level concurrently
+
+    evaluate(name, definition, inputs) is called with the (query_type, args) definition and
+    the results of the variables it depends on, and returns the result for that variable. With
+    processes=True, evaluate and its results must be picklable.
+    """
+    graph = dependency_graph(covariate_definitions)
+    results = {}
+    pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with pool(max_workers=jobs) as executor:
+        for i, level in enumerate(levels(graph), start=1):
+            start = time.perf_counter()
+            futures = {
+                name: executor.submit(
+                    evaluate,
+                    name,
+                    covariate_definitions[name],
+                    {dependency: results[dependency] for dependency in graph[name]},
+                )
+                for name in level
+            }
+            for name, future in futures.items():
+                results[name] = future.result()
+            report(f"level {i}: {len(level)} variables in {time.perf_counter() - start:.2f}s")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("study_definition")
+    parser.add_argument("--index-date")
+    args = parser.parse_args()
+
+    study = load_study(args.study_definition, args.index_date)
+    graph = dependency_graph(study.covariate_definitions)
+    grouped = levels(graph)
+    print(f"{args.study_definition}: {len(graph)} variables in {len(grouped)} levels")
+    for i, level in enumerate(grouped, start=1):
+        print(f"level {i} ({len(level)}):")
+        for name in level:
+            needs = ", ".join(sorted(graph[name]))
+            print(f"    {name}" + (f" <- {needs}" if needs else ""))
+
+
+if __name__ == "__main__":
+    main()
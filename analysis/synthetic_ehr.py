@@ -0,0 +1,336 @@
+"""
+Synthetic EHR database for running the study definitions offline
+
+Builds an SQLite database with the TPP tables the study definitions touch (Patient,
+RegistrationHistory/Organisation, PatientAddress, CodedEvent with numeric values,
+CodedEvent_SNOMED, MedicationIssue, APCS, EC and ONS_Deaths), populated with generated patients.
+Codes are drawn from the codelists in codelists/, with the first codes of each codelist the
+most common. A share of patients have gout: their gout codes, flares, urate tests, ULT and flare
+treatment prescriptions, admissions and ED attendances are placed around their diagnosis date,
+so the study populations and follow-up windows are non-empty. Every patient also gets
+background comorbidities, biomarkers and events with codes outside any codelist, so that
+queries scan realistically sized tables. analysis/local_backend.py runs a study definition
+against the database.
+
+Usage (from the repository root):
+
+    python analysis/synthetic_ehr.py output/synthetic_ehr.sqlite --patients 1000000
+"""
+import argparse
+import sqlite3
+from datetime import date
+from pathlib import Path
+
+import numpy as np
+
+import codelists
+from dummy_data import AGE_PROBABILITIES, to_days
+
+PATIENTS = 100_000
+SEED = 2023
+BATCH_SIZE = 100_000
+GOUT_PREVALENCE = 0.05
+PRACTICES = 2000
+REGIONS = [
+    "East",
+    "East Midlands",
+    "London",
+    "North East",
+    "North West",
+    "South East",
+    "South West",
+    "West Midlands",
+    "Yorkshire and The Humber",
+]
+STPS = [f"E540000{i:02d}" for i in range(5, 49)]
+FIRST_RECORD = to_days("1990-01-01")
+CURRENT = "9999-12-31"
+BMI_CODE = "22K.."
+
+SCHEMA = """
+CREATE TABLE Patient (Patient_ID INTEGER PRIMARY KEY, DateOfBirth TEXT, Sex TEXT);
+CREATE TABLE Organisation (Organisation_ID INTEGER PRIMARY KEY, STPCode TEXT, Region TEXT);
+CREATE TABLE RegistrationHistory (
+    Registration_ID INTEGER PRIMARY KEY, Patient_ID INTEGER, Organisation_ID INTEGER,
+    StartDate TEXT, EndDate TEXT
+);
+CREATE TABLE PatientAddress (
+    PatientAddress_ID INTEGER PRIMARY KEY, Patient_ID INTEGER, StartDate TEXT, EndDate TEXT,
+    ImdRankRounded INTEGER
+);
+CREATE TABLE CodedEvent (
+    CodedEvent_ID INTEGER PRIMARY KEY, Patient_ID INTEGER, CTV3Code TEXT, NumericValue REAL,
+    ConsultationDate TEXT
+);
+CREATE TABLE CodedEvent_SNOMED (
+    CodedEvent_ID INTEGER PRIMARY KEY, Patient_ID INTEGER, ConceptID TEXT, NumericValue REAL,
+    ConsultationDate TEXT
+);
+CREATE TABLE MedicationIssue (
+    MedicationIssue_ID INTEGER PRIMARY KEY, Patient_ID INTEGER, DMD_ID TEXT, ConsultationDate TEXT
+);
+CREATE TABLE APCS (
+    APCS_Ident INTEGER PRIMARY KEY, Patient_ID INTEGER, Admission_Date TEXT,
+    Spell_Primary_Diagnosis TEXT
+);
+CREATE TABLE EC (
+    EC_Ident INTEGER PRIMARY KEY, Patient_ID INTEGER, Arrival_Date TEXT, EC_Diagnosis_01 TEXT
+);
+CREATE TABLE ONS_Deaths (Patient_ID INTEGER, dod TEXT, icd10u TEXT);
+"""
+
+INDEXES = """
+CREATE INDEX RegistrationHistory_Patient ON RegistrationHistory (Patient_ID);
+CREATE INDEX PatientAddress_Patient ON PatientAddress (Patient_ID);
+CREATE INDEX CodedEvent_Code ON CodedEvent (CTV3Code, ConsultationDate);
+CREATE INDEX CodedEvent_SNOMED_Code ON CodedEvent_SNOMED (ConceptID, ConsultationDate);
+CREATE INDEX MedicationIssue_Code ON MedicationIssue (DMD_ID, ConsultationDate);
+CREATE INDEX APCS_Diagnosis ON APCS (Spell_Primary_Diagnosis, Admission_Date);
+CREATE INDEX EC_Diagnosis ON EC (EC_Diagnosis_01, Arrival_Date);
+"""
+
+# Table and code column of each kind of event
+EVENT_TABLES = {
+    "ctv3": ("CodedEvent", "CTV3Code"),
+    "snomed": ("CodedEvent_SNOMED", "ConceptID"),
+    "dmd": ("MedicationIssue", "DMD_ID"),
+    "icd10": ("APCS", "Spell_Primary_Diagnosis"),
+    "ecds": ("EC", "EC_Diagnosis_01"),
+}
+
+# (kind, codelist, patients, share of them with events, mean events per patient, window, value)
+## Gout patients' events fall within window (days) of their diagnosis; other patients' events
+## fall anywhere in their record. value is the (mean, sd) of the numeric value, if any.
+EVENT_PROFILES = [
+    ("snomed", "gout_codes", "gout", 1.0, 2.0, (14, 1095), None),
+    ("snomed", "gout_flare", "gout", 0.3, 2.0, (14, 730), None),
+    ("snomed", "tophi_codes", "gout", 0.05, 1.0, (-365, 1095), None),
+    ("ctv3", "urate_codes", "gout", 0.5, 3.0, (-180, 730), (420, 90)),
+    ("snomed", "urate_codes_snomed", "gout", 0.3, 2.0, (-180, 730), (420, 90)),
+    ("dmd", "allopurinol_codes", "gout", 0.45, 10.0, (0, 730), None),
+    ("dmd", "febuxostat_codes", "gout", 0.05, 6.0, (0, 730), None),
+    ("dmd", "colchicine", "gout", 0.5, 2.0, (0, 730), None),
+    ("icd10", "gout_admission", "gout", 0.03, 1.2, (-30, 730), None),
+    ("ecds", "gout_codes", "gout", 0.05, 1.2, (-30, 730), None),
+    ("ctv3", "ethnicity_codes", "all", 0.8, 1.0, None, None),
+    ("ctv3", "clear_smoking_codes", "all", 0.7, 2.0, None, None),
+    ("ctv3", "chronic_cardiac_disease_codes", "all", 0.08, 1.5, None, None),
+    ("ctv3", "diabetes_codes", "all", 0.08, 1.5, None, None),
+    ("ctv3", "hypertension_codes", "all", 0.2, 1.5, None, None),
+    ("ctv3", "chronic_respiratory_disease_codes", "all", 0.05, 1.5, None, None),
+    ("ctv3", "copd_codes", "all", 0.03, 1.5, None, None),
+    ("ctv3", "chronic_liver_disease_codes", "all", 0.01, 1.5, None, None),
+    ("ctv3", "stroke_codes", "all", 0.02, 1.5, None, None),
+    ("ctv3", "lung_cancer_codes", "all", 0.005, 1.5, None, None),
+    ("ctv3", "haem_cancer_codes", "all", 0.005, 1.5, None, None),
+    ("ctv3", "other_cancer_codes", "all", 0.03, 1.5, None, None),
+    ("ctv3", "ckd_codes", "all", 0.05, 1.5, None, None),
+    ("ctv3", "organ_transplant_codes", "all", 0.002, 1.0, None, None),
+    ("ctv3", "hba1c_new_codes", "all", 0.3, 2.0, None, (45, 12)),
+    ("ctv3", "hba1c_old_codes", "all", 0.05, 2.0, None, (6.5, 1.2)),
+    ("ctv3", "creatinine_codes", "all", 0.5, 3.0, None, (85, 25)),
+    ("ctv3", [BMI_CODE], "all", 0.6, 2.0, None, (28, 5)),
+    ("dmd", "nsaids", "all", 0.15, 2.0, None, None),
+    ("dmd", "oral_steroids", "all", 0.08, 2.0, None, None),
+    ("dmd", "diuretic_codes", "all", 0.1, 6.0, None, None),
+]
+
+# Mean number of events per patient with codes outside every codelist
+BACKGROUND_EVENTS = {"ctv3": 15.0, "snomed": 10.0, "dmd": 10.0, "icd10": 0.2, "ecds": 0.2}
+BACKGROUND_CODES = 10_000
+DEATH_RATE = 0.02
+
+
+# ISO strings of every day from 1900 to 2100, looked up rather than formatted per row
+FIRST_DAY = to_days("1900-01-01")
+DAY_STRINGS = np.datetime_as_string(
+    np.arange(FIRST_DAY, to_days("2100-01-01")).astype("int64").astype("datetime64[D]")
+).astype(object)
+
+
+def iso(days):
+    return DAY_STRINGS[days.astype("int64") - int(FIRST_DAY)].tolist()
+
+
+def code_weights(size):
+    # Earlier codes in a codelist are more common (Zipf-like)
+    weights = 1 / np.arange(1, size + 1)
+    return weights / weights.sum()
+
+
+def profile_codes(codes):
+    if isinstance(codes, str):
+        codes = codelists.codelist_named(codes)
+    return np.array([code[0] if isinstance(code, tuple) else code for code in codes])
+
+
+class PatientBatch:
+    """Generate the rows of every table for the patients first_id to first_id + size - 1"""
+
+    def __init__(self, first_id, size, rng, today):
+        self.rng = rng
+        self.size = size
+        self.today = today
+        self.patient_id = np.arange(first_id, first_id + size)
+        age = rng.choice(len(AGE_PROBABILITIES), size=size, p=AGE_PROBABILITIES)
+        self.date_of_birth = today - age * 365.25 - rng.integers(0, 365, size=size)
+        self.record_start = np.maximum(self.date_of_birth, FIRST_RECORD)
+        self.sex = rng.choice(["M", "F", "U"], size=size, p=[0.4995, 0.4995, 0.001])
+        self.gout = rng.random(size) < GOUT_PREVALENCE
+        self.diagnosis = self.uniform_dates(self.record_start, today)
+
+    def uniform_dates(self, low, high):
+        return np.floor(low + self.rng.random(np.shape(low)) * np.maximum(high - low, 0))
+
+    def registrations(self):
+        # One registration per patient; one in six has moved practice, and one in twenty left
+        start = self.uniform_dates(self.record_start, self.today - 30)
+        practice = self.rng.integers(1, PRACTICES + 1, size=self.size)
+        moved = self.rng.random(self.size) < 1 / 6
+        left = ~moved & (self.rng.random(self.size) < 1 / 20)
+        change = self.uniform_dates(start, self.today)
+        end = np.where(moved | left, change, np.nan)
+        rows = [(self.patient_id, practice, start, end)]
+        new_practice = practice % PRACTICES + 1
+        rows.append((self.patient_id[moved], new_practice[moved], change[moved] + 1, np.full(moved.sum(), np.nan)))
+        return [np.concatenate(column) for column in zip(*rows)]
+
+    def events(self, codes, patients, share, mean, window, value):
+        # (patient_id, code, date, value) of the events of one codelist
+        eligible = np.flatnonzero(self.gout if patients == "gout" else np.ones(self.size, bool))
+        eligible = eligible[self.rng.random(len(eligible)) < share]
+        counts = 1 + self.rng.poisson(max(mean - 1, 0), size=len(eligible))
+        patient = np.repeat(eligible, counts)
+        if window is None:
+            dates = self.uniform_dates(self.record_start[patient], self.today)
+        else:
+            anchor = self.diagnosis[patient]
+            dates = self.uniform_dates(anchor + window[0], anchor + window[1])
+            dates = np.clip(dates, self.date_of_birth[patient], self.today)
+        code = codes[self.rng.choice(len(codes), size=len(patient), p=code_weights(len(codes)))]
+        if value is None:
+            values = np.full(len(patient), np.nan)
+        else:
+            values = np.round(np.abs(self.rng.normal(value[0], value[1], size=len(patient))), 1)
+        return self.patient_id[patient], code, dates, values
+
+    def background_events(self, kind, mean):
+        patient = np.repeat(np.arange(self.size), self.rng.poisson(mean, size=self.size))
+        dates = self.uniform_dates(self.record_start[patient], self.today)
+        codes = np.array([f"Z{kind[0].upper()}{i}" for i in range(BACKGROUND_CODES)], dtype=object)
+        code = codes[self.rng.integers(0, BACKGROUND_CODES, size=len(patient))]
+        return self.patient_id[patient], code, dates, np.full(len(patient), np.nan)
+
+    def gout_diagnoses(self):
+        # Every gout patient has a gout code on their diagnosis date
+        gout = np.flatnonzero(self.gout)
+        codes = profile_codes("gout_codes")
+        code = codes[self.rng.choice(len(codes), size=len(gout), p=code_weights(len(codes)))]
+        return self.patient_id[gout], code, self.diagnosis[gout], np.full(len(gout), np.nan)
+
+
+def insert(connection, table, columns, rows):
+    placeholders = ", ".join("?" for _ in columns)
+    connection.executemany(
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})", zip(*rows)
+    )
+
+
+def nullable_iso(days, missing):
+    return np.where(np.isnan(days), missing, np.array(iso(np.nan_to_num(days)), dtype=object)).tolist()
+
+
+def write_batch(connection, batch, profiles):
+    insert(
+        connection,
+        "Patient",
+        ["Patient_ID", "DateOfBirth", "Sex"],
+        [batch.patient_id.tolist(), iso(batch.date_of_birth), batch.sex.tolist()],
+    )
+    patient_id, practice, start, end = batch.registrations()
+    insert(
+        connection,
+        "RegistrationHistory",
+        ["Patient_ID", "Organisation_ID", "StartDate", "EndDate"],
+        [patient_id.tolist(), practice.tolist(), iso(start), nullable_iso(end, CURRENT)],
+    )
+    # One address per patient, from their first registration; IMD is -1 without a postcode
+    imd = np.round(batch.rng.integers(1, 32845, size=batch.size), -2)
+    imd[batch.rng.random(batch.size) < 0.02] = -1
+    insert(
+        connection,
+        "PatientAddress",
+        ["Patient_ID", "StartDate", "EndDate", "ImdRankRounded"],
+        [batch.patient_id.tolist(), iso(start[: batch.size]), [CURRENT] * batch.size, imd.tolist()],
+    )
+
+    events = {kind: [batch.background_events(kind, mean)] for kind, mean in BACKGROUND_EVENTS.items()}
+    events["snomed"].append(batch.gout_diagnoses())
+    for kind, codes, patients, share, mean, window, value in profiles:
+        events[kind].append(batch.events(codes, patients, share, mean, window, value))
+    for kind, parts in events.items():
+        patient_id, code, dates, values = [np.concatenate(column) for column in zip(*parts)]
+        # Rows are inserted in date order, as they would be recorded
+        order = np.lexsort((patient_id, dates))
+        table, code_column = EVENT_TABLES[kind]
+        date_column = {"APCS": "Admission_Date", "EC": "Arrival_Date"}.get(table, "ConsultationDate")
+        columns = [patient_id[order].tolist(), code[order].tolist(), iso(dates[order])]
+        names = ["Patient_ID", code_column, date_column]
+        if table.startswith("CodedEvent"):
+            names.append("NumericValue")
+            values = values[order]
+            columns.append(np.where(np.isnan(values), None, values).tolist())
+        insert(connection, table, names, columns)
+
+    died = np.flatnonzero(batch.rng.random(batch.size) < DEATH_RATE)
+    dod = batch.uniform_dates(batch.diagnosis[died], batch.today)
+    insert(
+        connection,
+        "ONS_Deaths",
+        ["Patient_ID", "dod", "icd10u"],
+        [batch.patient_id[died].tolist(), iso(dod), ["I219"] * len(died)],
+    )
+
+
+def generate(path, patients=PATIENTS, seed=SEED, batch_size=BATCH_SIZE):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.unlink(missing_ok=True)
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode = OFF")
+    connection.execute("PRAGMA synchronous = OFF")
+    connection.executescript(SCHEMA)
+    organisation = np.arange(1, PRACTICES + 1)
+    stp = organisation % len(STPS)
+    insert(
+        connection,
+        "Organisation",
+        ["Organisation_ID", "STPCode", "Region"],
+        [organisation.tolist(), [STPS[i] for i in stp], [REGIONS[i % len(REGIONS)] for i in stp]],
+    )
+    profiles = [
+        (kind, profile_codes(codes), *profile) for kind, codes, *profile in EVENT_PROFILES
+    ]
+    rng = np.random.default_rng(seed)
+    today = to_days(date.today().isoformat())
+    for first_id in range(1, patients + 1, batch_size):
+        size = min(batch_size, patients + 1 - first_id)
+        write_batch(connection, PatientBatch(first_id, size, rng, today), profiles)
+        connection.commit()
+    connection.executescript(INDEXES)
+    connection.execute("ANALYZE")
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("database")
+    parser.add_argument("--patients", type=int, default=PATIENTS)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+    generate(args.database, args.patients, args.seed, args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+Serum urate monitoring for the gout cohorts (output/input.feather, input_consults_year_*.feather)
+
+Derives the urate variables that 000_define_covariates.do, 004_define_covariates_consults.do and
+004_define_covariates_consults_year.do used to compute after `reshape long` of urate_test_1..7:
+    baseline_urate, had_baseline_urate, baseline_urate_below360: test closest to the index date
+        within the baseline window (in the main cohort, also not after ULT initiation);
+    count_urate_*, had_test_*, lowest_urate_*, urate_below360_*: tests within 6 (and 12) months
+        of the index date, and of ULT initiation;
+    two_urate_ult_*: at least two tests within 6 (and 12) months of ULT initiation.
+Values are cleaned as in the do-files first: values outside 0.05-2 (mmol/L) and 50-2000
+(micromol/L) are dropped, with their dates, and mmol/L are converted to micromol/L. Tests on the
+same day are counted once, keeping the lowest value. Where two baseline tests are equally close
+to the index date, the earlier one is used (the do-files left this to Stata's sort order).
+
+The tests are held as a (patient, order) array: a single sort finds same-day duplicates, and
+every variable is then a reduction along the order axis, so no reshape is needed. Patients are
+processed in batches (--batch-size). Writes output/data/urate_monitoring_<input>.dta (patient_id
+and the variables above), which is merged into the cohort by the do-file; the follow-up (_fup)
+flags are still derived there.
+
+Usage: python analysis/urate_monitoring.py --rules consults_year output/measures/input_consults_year_*.feather
+"""
+import argparse
+import glob
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from cohort_io import BATCH_SIZE, read_cohort_batches, write_stata_batches
+from flare_timeline import DATE_COLUMNS as INDEX_DATE_COLUMNS
+from flare_timeline import index_date
+
+# Number of urate tests extracted (first_n_bloods_in_period(n=7))
+URATE_TESTS = 7
+URATE_COLUMNS = [f"urate_test_{i}" for i in range(1, URATE_TESTS + 1)]
+URATE_DATE_COLUMNS = [f"{column}_date" for column in URATE_COLUMNS]
+# Plausible ranges, inclusive: mmol/L values are converted to micromol/L
+MMOL_RANGE = (0.05, 2)
+MICROMOL_RANGE = (50, 2000)
+TARGET_URATE = 360
+
+# Windows are in days from the index date (baseline: inclusive at both ends) or after it
+# (tests: exclusive start, inclusive end), as in each do-file
+RULES = {
+    # 000_define_covariates.do: index date is the (recoded) diagnosis date
+    "cohort": {
+        "ult_date": "first_ult_date",
+        "recode_index_date": True,
+        "baseline": (-180, 180),
+        "baseline_before_ult": True,
+        "diagnosis_windows": {"6m": (0, 180), "12m": (0, 365)},
+        "ult_windows": {"6m": (0, 180), "12m": (0, 365)},
+        "ult_start_within": None,
+    },
+    # 004_define_covariates_consults.do: index date is the consultation
+    "consults": {
+        "ult_date": "recent_ult_date",
+        "recode_index_date": False,
+        "baseline": (-186, 186),
+        "baseline_before_ult": False,
+        "diagnosis_windows": {"6m": (7, 186)},
+        "ult_windows": {"6m": (7, 186)},
+        "ult_start_within": 186,
+    },
+    # 004_define_covariates_consults_year.do
+    "consults_year": {
+        "ult_date": "recent_ult_date",
+        "recode_index_date": False,
+        "baseline": (-182, 14),
+        "baseline_before_ult": False,
+        "diagnosis_windows": {"6m": (7, 182)},
+        "ult_windows": {"6m": (7, 182)},
+        "ult_start_within": 182,
+    },
+}
+
+
+def input_columns(rules):
+    index_columns = INDEX_DATE_COLUMNS if rules["recode_index_date"] else ["gout_code_date"]
+    columns = ["patient_id"] + index_columns + [rules["ult_date"]] + URATE_COLUMNS + URATE_DATE_COLUMNS
+    return list(dict.fromkeys(columns))
+
+
+def to_days(dates):
+    # Days since 1970-01-01 as floats, NaN where missing
+    return (pd.to_datetime(dates) - pd.Timestamp("1970-01-01")).dt.days.to_numpy(float)
+
+
+def clean_values(values):
+    # Implausible values (including 0, returned when there is no test) become NaN
+    mmol = (values >= MMOL_RANGE[0]) & (values <= MMOL_RANGE[1])
+    micromol = (values >= MICROMOL_RANGE[0]) & (values <= MICROMOL_RANGE[1])
+    return np.where(mmol, values * 1000, np.where(micromol, values, np.nan))
+
+
+def urate_tests(cohort):
+    # (patient, order) arrays of test days and cleaned values, NaN where there is no test
+    values = clean_values(cohort[URATE_COLUMNS].to_numpy(float))
+    days = np.column_stack([to_days(cohort[column]) for column in URATE_DATE_COLUMNS])
+    missing = np.isnan(values) | np.isnan(days)
+    values[missing], days[missing] = np.nan, np.nan
+    # One sort by (patient, day, value): later tests on the same day as the previous are dropped
+    patients = np.repeat(np.arange(len(cohort)), URATE_TESTS)
+    order = np.lexsort((values.ravel(), days.ravel(), patients))
+    sorted_days = days.ravel()[order]
+    repeat = np.zeros(len(order), dtype=bool)
+    repeat[1:] = (patients[order][1:] == patients[order][:-1]) & (sorted_days[1:] == sorted_days[:-1])
+    values.ravel()[order[repeat]] = np.nan
+    days.ravel()[order[repeat]] = np.nan
+    return days, values
+
+
+def lowest(values, mask):
+    lowest = np.where(mask, values, np.inf).min(axis=1, initial=np.inf)
+    return np.where(np.isinf(lowest), np.nan, lowest)
+
+
+def window_variables(values, mask, suffix):
+    count = mask.sum(axis=1)
+    lowest_urate = lowest(values, mask)
+    return {
+        f"count_urate_{suffix}": count,
+        f"had_test_{suffix}": count > 0,
+        f"lowest_urate_{suffix}": lowest_urate,
+        f"urate_below360_{suffix}": lowest_urate <= TARGET_URATE,
+    }
+
+
+def urate_monitoring(cohort, rules):
+    index = index_date(cohort) if rules["recode_index_date"] else cohort["gout_code_date"]
+    index, ult = to_days(index)[:, None], to_days(cohort[rules["ult_date"]])[:, None]
+    days, values = urate_tests(cohort)
+    has_test = ~np.isnan(values)
+    with np.errstate(invalid="ignore"):
+        time_to_test = days - index
+        time_to_test_ult = days - ult
+        after_ult = time_to_test_ult > 0
+
+        start, end = rules["baseline"]
+        baseline = has_test & (time_to_test >= start) & (time_to_test <= end)
+        if rules["baseline_before_ult"]:
+            baseline &= ~after_ult
+        # Closest to the index date, the earlier of two equally close tests
+        closeness = np.where(baseline, np.abs(time_to_test) * 2 + (time_to_test > 0), np.inf)
+        closest = np.take_along_axis(values, closeness.argmin(axis=1)[:, None], axis=1)[:, 0]
+        had_baseline_urate = baseline.any(axis=1)
+        baseline_urate = np.where(had_baseline_urate, closest, np.nan)
+        variables = {
+            "baseline_urate": baseline_urate,
+            "had_baseline_urate": had_baseline_urate,
+            "baseline_urate_below360": np.where(had_baseline_urate, baseline_urate <= TARGET_URATE, np.nan),
+        }
+
+        for suffix, (start, end) in rules["diagnosis_windows"].items():
+            mask = has_test & (time_to_test > start) & (time_to_test <= end)
+            variables.update(window_variables(values, mask, suffix))
+
+        ult_started = ~np.isnan(ult)
+        if rules["ult_start_within"] is not None:
+            ult_started &= (ult >= index) & (ult < index + rules["ult_start_within"])
+        for suffix, (start, end) in rules["ult_windows"].items():
+            mask = has_test & ult_started & after_ult & (time_to_test_ult > start) & (time_to_test_ult <= end)
+            variables.update(window_variables(values, mask, f"ult_{suffix}"))
+            variables[f"two_urate_ult_{suffix}"] = variables[f"count_urate_ult_{suffix}"] >= 2
+    return pd.DataFrame({"patient_id": cohort["patient_id"].to_numpy(), **variables})
+
+
+def output_path(input_path, output_dir):
+    return Path(output_dir) / f"urate_monitoring_{Path(input_path).stem}.dta"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("inputs", nargs="+", help="feather files or glob patterns")
+    parser.add_argument("--rules", choices=RULES, default="cohort", help="windows of the do-file the output is for")
+    parser.add_argument("--output-dir", default="output/data")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    rules = RULES[args.rules]
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+    for pattern in args.inputs:
+        for path in sorted(glob.glob(pattern)):
+            batches = read_cohort_batches(path, columns=input_columns(rules), batch_size=args.batch_size)
+            write_stata_batches(
+                (urate_monitoring(batch, rules) for batch in batches), output_path(path, args.output_dir)
+            )
+
+
+if __name__ == "__main__":
+    main()
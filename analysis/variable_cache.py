@@ -0,0 +1,130 @@
+"""
+On-disk cache of per-variable results shared between study definitions
+
+gout_code_date, age, sex, the follow-up flags, region, stp, imd and the comorbidities are
+defined (almost) identically in study_definition, study_definition_count and
+study_definition_allpts. Each variable is keyed on its full definition: query type, arguments
+with resolved dates (index date and "today" included), hashes of its codelists, and the keys of
+the variables it depends on. A variable that is defined identically in another study therefore
+gets the same key and its result is reused. Expectations and the hidden flag do not change the
+result, so they are left out of the key.
+
+Results (one value per patient) are stored as output/variable_cache/<key>.feather. When the
+cache grows beyond max_bytes the least recently used entries are removed.
+
+Usage (from the repository root): report the variables shared between study definitions
+
+    python analysis/variable_cache.py study_definition study_definition_count study_definition_allpts
+"""
+import argparse
+import functools
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import pandas as pd
+
+from study_plan import dependency_graph, is_codelist, levels, load_study
+
+CACHE_DIR = Path("output/variable_cache")
+MAX_BYTES = 5 * 1024**3
+# Arguments that do not change a variable's result
+NON_KEY_ARGUMENTS = {"return_expectations", "hidden"}
+
+
+def canonical(value):
+    # JSON-serialisable form of an argument value; codelists are replaced by their hash
+    if is_codelist(value):
+        codes = sorted(json.dumps(code) for code in value)
+        digest = hashlib.sha1("\n".join(codes).encode()).hexdigest()
+        return {"codelist": value.system, "sha1": digest}
+    if isinstance(value, dict):
+        return {str(key): canonical(item) for key, item in sorted(value.items(), key=str)}
+    if isinstance(value, (list, tuple)):
+        return [canonical(item) for item in value]
+    return value
+
+
+def definition_keys(covariate_definitions):
+    # {name: key} for every variable; dependencies are keyed before the variables that use them
+    graph = dependency_graph(covariate_definitions)
+    keys = {}
+    for level in levels(graph):
+        for name in level:
+            query_type, args = covariate_definitions[name]
+            definition = {
+                "query_type": query_type,
+                "args": canonical(
+                    {argument: value for argument, value in args.items() if argument not in NON_KEY_ARGUMENTS}
+                ),
+                "dependencies": {dependency: keys[dependency] for dependency in sorted(graph[name])},
+            }
+            keys[name] = hashlib.sha256(json.dumps(definition, sort_keys=True).encode()).hexdigest()
+    return keys
+
+
+class VariableCache:
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path(self, key):
+        return self.directory / f"{key}.feather"
+
+    def get(self, key):
+        # Result as a Series indexed by patient_id, or None if it is not cached
+        path = self.path(key)
+        try:
+            result = pd.read_feather(path)
+        except OSError:
+            return None
+        # The modification time records when an entry was last used
+        os.utime(path)
+        return result.set_index("patient_id")["value"]
+
+    def put(self, key, result):
+        tmp = self.path(key).with_suffix(".tmp")
+        result.rename("value").rename_axis("patient_id").reset_index().to_feather(tmp)
+        os.replace(tmp, self.path(key))
+        self.evict()
+
+    def evict(self):
+        entries = sorted(self.directory.glob("*.feather"), key=lambda path: path.stat().st_mtime)
+        total = sum(path.stat().st_size for path in entries)
+        for path in entries:
+            if total <= self.max_bytes:
+                break
+            total -= path.stat().st_size
+            path.unlink(missing_ok=True)
+
+    def wrap(self, evaluate, keys):
+        # An evaluate function for study_plan.run_by_level that reuses cached results
+        return functools.partial(self._evaluate, evaluate, keys)
+
+    def _evaluate(self, evaluate, keys, name, definition, inputs):
+        result = self.get(keys[name])
+        if result is None:
+            result = evaluate(name, definition, inputs)
+            self.put(keys[name], result)
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("study_definitions", nargs="+")
+    args = parser.parse_args()
+
+    owners = {}
+    for study_definition in args.study_definitions:
+        for name, key in definition_keys(load_study(study_definition).covariate_definitions).items():
+            owners.setdefault(key, []).append(f"{study_definition}.{name}")
+    shared = [names for names in owners.values() if len(names) > 1]
+    print(f"{len(owners)} distinct variables, {len(shared)} defined in more than one study")
+    for names in shared:
+        print("    " + ", ".join(names))
+
+
+if __name__ == "__main__":
+    main()
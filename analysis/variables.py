@@ -0,0 +1,25 @@
+from cohortextractor import patients
+
+
+# Get the first n blood test values (and dates) within a single window, in date order
+## Returns {name}_1..{name}_n with matching {name}_i_date columns. Every test is
+## bounded by the same window (between), so the window is defined once rather
+## than being repeated in each study definition.
+def first_n_bloods_in_period(name, codelist, between, n, return_expectations):
+    window_start, window_end = between
+    variables = {}
+    on_or_after = window_start
+    for i in range(1, n + 1):
+        variables[f"{name}_{i}"] = patients.with_these_clinical_events(
+            codelist,
+            find_first_match_in_period=True,
+            returning="numeric_value",
+            include_date_of_match=True,
+            date_format="YYYY-MM-DD",
+            between=[on_or_after, window_end],
+            return_expectations=return_expectations,
+        )
+        # Next test must be after the date of the previous test
+        on_or_after = f"{name}_{i}_date + 1 day"
+    return variables
+
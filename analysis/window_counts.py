@@ -0,0 +1,56 @@
+"""
+Counting each patient's events in several windows at once
+
+Variables such as ult_count_6m and ult_count_12m (prescriptions within 6 and 12 months of
+first_ult_date) count the same events in nested windows. Their events are fetched once and
+sorted by (patient, day); each patient's events then form one increasing run of keys, and the
+number in a window is the difference of two binary searches for its bounds. Every window of
+every patient is counted with one np.searchsorted per bound, without a pass over the events per
+window.
+"""
+import numpy as np
+
+
+def patient_keys(positions, days, size):
+    """Events as one increasing key, and the keys of a day bound of every patient
+
+    positions and days (without missing days) must be sorted by position, then day. The patients
+    are far enough apart that a bound clipped to the range of days never reaches another patient's
+    events, so a binary search for a bound only finds the patient's own events.
+    """
+    first_day = days.min()
+    span = days.max() - first_day + 2
+    keys = positions * span + (days - first_day)
+    offsets = np.arange(size) * span
+
+    def bound_keys(days):
+        # days is one day per patient (NaN keys are not found)
+        return offsets + np.clip(days - first_day, -0.5, span - 1.5)
+
+    return keys, bound_keys
+
+
+def count_in_windows(positions, days, windows, size):
+    """Number of events of each patient within each window
+
+    positions (0 to size - 1) and days must be sorted by position, then day. windows is a list of
+    (low, high) inclusive bounds, each None (unbounded), a single day or one day per patient; a
+    patient whose bound is missing (NaN) has no events in the window. Events without a day are
+    not counted. Returns a list of counts of every patient, one per window.
+    """
+    positions, days = np.asarray(positions), np.asarray(days, dtype=float)
+    dated = ~np.isnan(days)
+    positions, days = positions[dated], days[dated]
+    if len(days) == 0:
+        return [np.zeros(size, dtype=np.int64) for _ in windows]
+    keys, bound_keys = patient_keys(positions, days, size)
+    counts = []
+    for low, high in windows:
+        low = np.broadcast_to(-np.inf if low is None else low, (size,))
+        high = np.broadcast_to(np.inf if high is None else high, (size,))
+        start = np.searchsorted(keys, bound_keys(low), side="left")
+        end = np.searchsorted(keys, bound_keys(high), side="right")
+        with np.errstate(invalid="ignore"):
+            count = np.where(np.isnan(low) | np.isnan(high), 0, np.maximum(end - start, 0))
+        counts.append(count)
+    return counts
@@ -0,0 +1,32 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+# The analysis scripts import each other as top-level modules, as when run from the repository root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "analysis"))
+
+# Patients of the random events of as_of.py and window_counts.py tests
+PATIENTS = 40
+
+
+@pytest.fixture
+def patients():
+    return PATIENTS
+
+
+@pytest.fixture(params=range(5))
+def rng(request):
+    return np.random.default_rng(request.param)
+
+
+@pytest.fixture
+def events(rng):
+    # 600 events of patients 0 to PATIENTS - 1 (some with none), 5% without a day, sorted by patient
+    # and day, with several on the same day kept in the order they were generated
+    positions = rng.integers(0, PATIENTS, 600)
+    days = rng.integers(-50, 300, 600).astype(float)
+    days[rng.random(600) < 0.05] = np.nan
+    order = np.lexsort((days, positions))
+    return positions[order], days[order]
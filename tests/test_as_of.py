@@ -0,0 +1,45 @@
+import numpy as np
+
+from as_of import last_on_or_before
+
+def brute_force(positions, days, low, high, size):
+    # Reference: for each patient, the first event of the latest day within [low, high]
+    low = np.broadcast_to(-np.inf if low is None else low, (size,))
+    high = np.broadcast_to(np.inf if high is None else high, (size,))
+    chosen = np.full(size, -1)
+    for patient in range(size):
+        best = None
+        for i in np.flatnonzero(positions == patient):
+            if low[patient] <= days[i] <= high[patient] and (best is None or days[i] > days[best]):
+                best = i
+        if best is not None:
+            chosen[patient] = best
+    return chosen
+
+
+def test_windows_of_every_kind(events, rng, patients):
+    positions, days = events
+    index = rng.integers(-60, 320, patients).astype(float)
+    index[rng.random(patients) < 0.2] = np.nan
+    for low, high in [(None, None), (None, 100), (None, index), (index - 3650, index), (index - 10, index), (index, None)]:
+        expected = brute_force(positions, days, low, high, patients)
+        np.testing.assert_array_equal(last_on_or_before(positions, days, low, high, patients), expected)
+
+
+def test_first_of_the_latest_day():
+    positions = np.array([0, 0, 0, 0, 1, 1, 1])
+    days = np.array([1.0, 4.0, 4.0, 4.0, 2.0, 2.0, 7.0])
+    np.testing.assert_array_equal(last_on_or_before(positions, days, None, 5, 2), [1, 4])
+    np.testing.assert_array_equal(last_on_or_before(positions, days, None, 7, 2), [1, 6])
+    np.testing.assert_array_equal(last_on_or_before(positions, days, 3, 6, 2), [1, -1])
+
+
+def test_missing_bounds_and_days():
+    # A missing bound means no event; events without a day are never chosen, and the index
+    # returned is into the arrays given, missing days included
+    positions = np.array([0, 0, 1, 1, 2, 2])
+    days = np.array([1.0, np.nan, 2.0, 3.0, 4.0, np.nan])
+    low = np.array([0.0, np.nan, 0.0])
+    high = np.array([10.0, 10.0, np.nan])
+    np.testing.assert_array_equal(last_on_or_before(positions, days, low, high, 3), [0, -1, -1])
+    np.testing.assert_array_equal(last_on_or_before(positions, days, None, None, 3), [0, 3, 4])
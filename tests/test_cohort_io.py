@@ -0,0 +1,152 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc
+import pytest
+
+from cohort_io import (
+    STATA_BYTE,
+    STATA_DOUBLE,
+    STATA_INT,
+    STATA_LONG,
+    STATA_MAX_STR,
+    STATA_STRL,
+    column_extents,
+    read_cohort_batches,
+    stata_layout,
+    write_stata_batches,
+)
+
+
+def cohort(rows, start=0):
+    ids = np.arange(start, start + rows)
+    return pd.DataFrame(
+        {
+            "patient_id": ids,
+            "flag": ids % 2 == 0,
+            "count": ids.astype("int64"),
+            "value": np.where(ids % 3 == 0, np.nan, ids / 10),
+            "date": pd.to_datetime("2020-01-01") + pd.to_timedelta(ids, "D").where(ids % 4 != 0),
+            "sex": pd.Categorical(np.where(ids % 5 == 0, None, np.where(ids % 2, "M", "F")), categories=["F", "M"]),
+            "imd": pd.Categorical(np.where(ids % 2, "1", "5"), categories=["1", "5"]),
+            "code": pd.Series(np.where(ids % 3 == 1, None, [f"X{i:03d}" for i in ids]), dtype=object),
+        }
+    )
+
+
+def expected(batch):
+    # Values as Stata holds them: flags as 0/1, numeric categories as numbers, missing strings ""
+    return pd.DataFrame(
+        {
+            "patient_id": batch["patient_id"].astype(float),
+            "flag": batch["flag"].astype("int8"),
+            "count": batch["count"].astype(float),
+            "value": batch["value"],
+            "date": batch["date"],
+            "sex": batch["sex"].astype(object).fillna(""),
+            "imd": pd.to_numeric(batch["imd"].astype(object)).astype(float),
+            "code": batch["code"].fillna(""),
+        }
+    )
+
+
+def round_trip(batches, path, widths=None, ranges=None):
+    write_stata_batches(batches, path, widths, ranges)
+    return pd.read_stata(path)
+
+
+def feather(path, batches):
+    # A feather file with one record batch per DataFrame, as cohortextractor writes large cohorts
+    schema = pa.Schema.from_pandas(batches[0], preserve_index=False)
+    with pa.OSFile(str(path), "wb") as sink, pa.ipc.new_file(sink, schema) as writer:
+        for batch in batches:
+            writer.write_table(pa.Table.from_pandas(batch, schema=schema, preserve_index=False))
+    return path
+
+
+def test_round_trip_in_batches(tmp_path):
+    batches = [cohort(7), cohort(0), cohort(5, start=7)]
+    result = round_trip(batches, tmp_path / "cohort.dta")
+    pd.testing.assert_frame_equal(result, expected(pd.concat(batches, ignore_index=True)), check_dtype=False)
+
+
+def test_empty_cohort(tmp_path):
+    result = round_trip([cohort(0)], tmp_path / "empty.dta")
+    assert list(result.columns) == list(cohort(0).columns)
+    assert len(result) == 0
+
+
+def test_all_missing_columns(tmp_path):
+    batch = pd.DataFrame(
+        {
+            "value": [np.nan, np.nan],
+            "date": pd.to_datetime([None, None]),
+            "code": pd.Series([None, np.nan], dtype=object),
+            "category": pd.Categorical([None, None], categories=["a"]),
+        }
+    )
+    result = round_trip([batch, batch], tmp_path / "missing.dta")
+    assert result["value"].isna().all()
+    assert result["date"].isna().all()
+    assert (result["code"] == "").all()
+    assert (result["category"] == "").all()
+
+
+@pytest.mark.parametrize("values", [[], [None], [np.nan, None]])
+def test_layout_of_empty_and_missing_strings(tmp_path, values):
+    batch = pd.DataFrame({"code": pd.Series(values, dtype=object)})
+    widths, ranges = column_extents(feather(tmp_path / "strings.feather", [batch.astype({"code": "string"})]))
+    assert widths == {"code": 0}
+    assert stata_layout(batch, widths, ranges) == [("code", 1, "%1s")]
+
+
+def test_later_batches_with_longer_strings(tmp_path):
+    # The width comes from the whole file, not from the first batch
+    path = feather(tmp_path / "cohort.feather", [cohort(3), cohort(0), cohort(4, start=1000)])
+    widths, ranges = column_extents(path)
+    assert widths == {"code": 5}
+    assert stata_layout(cohort(3), widths, ranges)[-1] == ("code", 5, "%5s")
+    result = round_trip(read_cohort_batches(path, batch_size=2), tmp_path / "cohort.dta", widths, ranges)
+    batches = [cohort(3), cohort(4, start=1000)]
+    pd.testing.assert_frame_equal(result, expected(pd.concat(batches, ignore_index=True)), check_dtype=False)
+    # Without the widths of the whole file, strings that are not categoricals are strLs
+    assert stata_layout(cohort(3))[-1] == ("code", STATA_STRL, "%9s")
+    result = round_trip(read_cohort_batches(path, batch_size=2), tmp_path / "strls.dta")
+    assert result["code"].tolist() == expected(pd.concat(batches, ignore_index=True))["code"].tolist()
+
+
+def test_integer_types(tmp_path):
+    batch = pd.DataFrame(
+        {
+            "patient_id": np.array([1, 3_000_000_000]),
+            "age": np.array([18, 100]),
+            "count": np.array([0, 1000]),
+            "large": np.array([-1, 100_000]),
+            "value": np.array([0.5, np.nan]),
+            "date": pd.to_datetime(["2020-01-01", None]),
+            "imd": pd.Categorical(["1", None], categories=["1", "5"]),
+        }
+    )
+    widths, ranges = column_extents(feather(tmp_path / "numbers.feather", [batch]))
+    assert ranges == {
+        "patient_id": (1, 3_000_000_000),
+        "age": (18, 100),
+        "count": (0, 1000),
+        "large": (-1, 100_000),
+    }
+    layout = stata_layout(batch, widths, ranges)
+    codes = [STATA_DOUBLE, STATA_BYTE, STATA_INT, STATA_LONG, STATA_DOUBLE, STATA_LONG, STATA_BYTE]
+    assert [code for _, code, _ in layout] == codes
+    result = round_trip([batch], tmp_path / "numbers.dta", widths, ranges)
+    assert result["patient_id"].tolist() == [1, 3_000_000_000]
+    assert result["large"].tolist() == [-1, 100_000]
+    assert result["date"].isna().tolist() == [False, True]
+    assert result["imd"].isna().tolist() == [False, True]
+
+
+def test_long_strings_are_strls(tmp_path):
+    long = "é" + "x" * STATA_MAX_STR
+    first = pd.DataFrame({"patient_id": [1, 2, 3], "text": [long, None, ""]})
+    second = pd.DataFrame({"patient_id": [4, 5], "text": ["short", long + "y"]})
+    result = round_trip([first, second], tmp_path / "strl.dta")
+    assert result["text"].tolist() == [long, "", "", "short", long + "y"]
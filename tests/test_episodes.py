@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from episodes import count_episodes, episode_starts
+
+
+def brute_force_starts(patients, days, gap):
+    # One event at a time: an event starts an episode if it is the patient's first, or at least
+    # gap days after the start of the patient's current episode
+    starts = np.zeros(len(days), dtype=bool)
+    start = None
+    for i, (patient, day) in enumerate(zip(patients, days)):
+        if i == 0 or patient != patients[i - 1] or day - start >= gap:
+            starts[i], start = True, day
+    return starts
+
+
+def sorted_events(rng, size, patients, max_day):
+    patients, days = rng.integers(0, patients, size), rng.integers(0, max_day, size)
+    order = np.lexsort((days, patients))
+    return patients[order], days[order]
+
+
+@pytest.mark.parametrize("gap", [1, 14, 30])
+@pytest.mark.parametrize("seed", range(5))
+def test_random_events(seed, gap):
+    rng = np.random.default_rng(seed)
+    patients, days = sorted_events(rng, 2000, 50, 400)
+    np.testing.assert_array_equal(episode_starts(patients, days, gap), brute_force_starts(patients, days, gap))
+
+
+def test_chains_of_close_events():
+    # Two chains of events each less than 14 days after the one before: within a chain, each
+    # event 14 days or more after the start of the current episode starts the next one
+    days = np.array([0, 10, 20, 30, 40, 50, 55, 60, 67, 100, 101, 113, 114, 127, 128])
+    patients = np.zeros(len(days), dtype=int)
+    starts = episode_starts(patients, days, 14)
+    np.testing.assert_array_equal(days[starts], [0, 20, 40, 55, 100, 114, 128])
+    np.testing.assert_array_equal(starts, brute_force_starts(patients, days, 14))
+
+
+def test_patients_with_long_chains_and_one_event():
+    # Long chains alongside patients with a single event, so the episodes are followed for
+    # many more passes for some patients than for others
+    patients = np.r_[np.zeros(40, dtype=int), 1, np.full(6, 2), 3]
+    days = np.r_[np.arange(40) * 7, 0, np.arange(6) * 13, 1000]
+    starts = episode_starts(patients, days, 14)
+    np.testing.assert_array_equal(starts, brute_force_starts(patients, days, 14))
+    np.testing.assert_array_equal(count_episodes(patients, days, 14), ([0, 1, 2, 3], [20, 1, 3, 1]))
+
+
+def test_same_day_events():
+    # Only the first of several events on the day an episode starts starts it
+    patients = np.array([0, 0, 0, 0, 0, 1, 1])
+    days = np.array([5, 5, 19, 19, 19, 0, 0])
+    starts = episode_starts(patients, days, 14)
+    np.testing.assert_array_equal(starts, [True, False, True, False, False, True, False])
+    np.testing.assert_array_equal(starts, brute_force_starts(patients, days, 14))
+
+
+def test_next_patient_is_not_reached():
+    # The next patient's first event is never taken as the start of an episode after this one's
+    patients = np.array([0, 0, 1, 1])
+    days = np.array([0, 3, 10, 30])
+    np.testing.assert_array_equal(episode_starts(patients, days, 14), [True, False, True, True])
+
+
+def test_no_events():
+    assert episode_starts([], [], 14).tolist() == []
+    patients, counts = count_episodes([], [], 14)
+    assert len(patients) == len(counts) == 0
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_count_episodes(seed):
+    rng = np.random.default_rng(seed)
+    patients, days = sorted_events(rng, 500, 30, 200)
+    starts = brute_force_starts(patients, days, 14)
+    expected = np.unique(patients[starts], return_counts=True)
+    np.testing.assert_array_equal(count_episodes(patients, days, 14), expected)
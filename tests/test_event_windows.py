@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from as_of import last_on_or_before
+from window_counts import count_in_windows
+
+
+def as_of_found(positions, days, low, high, size):
+    return last_on_or_before(positions, days, low, high, size) >= 0
+
+
+def counted(positions, days, low, high, size):
+    return count_in_windows(positions, days, [(low, high)], size)[0] > 0
+
+
+# Whether each patient has an event within [low, high], from either lookup over the same events
+HAS_EVENT = {"as_of": as_of_found, "window_counts": counted}
+
+
+@pytest.mark.parametrize("has_event", HAS_EVENT.values(), ids=HAS_EVENT)
+def test_bounds_beyond_every_event_stay_with_the_patient(has_event):
+    # Bounds far outside the range of days are clipped without reaching other patients' events
+    positions = np.array([0, 1, 1, 2])
+    days = np.array([10.0, 10.0, 11.0, 12.0])
+    low, high = np.array([-1e6, 1e6, 11.0]), np.array([1e6, 2e6, 1e6])
+    np.testing.assert_array_equal(has_event(positions, days, low, high, 3), [True, False, True])
+    high = np.array([-1e6, 1e6, 1e6])
+    np.testing.assert_array_equal(has_event(positions, days, None, high, 3), [False, True, True])
+
+
+@pytest.mark.parametrize("has_event", HAS_EVENT.values(), ids=HAS_EVENT)
+def test_no_dated_events(has_event):
+    positions, days = np.array([0, 1]), np.array([np.nan, np.nan])
+    np.testing.assert_array_equal(has_event(positions, days, None, None, 3), [False] * 3)
+    np.testing.assert_array_equal(has_event(positions, days, 0, 1, 3), [False] * 3)
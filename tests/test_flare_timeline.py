@@ -0,0 +1,137 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from flare_timeline import (
+    ADMISSION_COLUMNS,
+    EMERG_COLUMNS,
+    FLARE_CODE_COLUMNS,
+    GOUT_CODE_COLUMNS,
+    TREATMENT_COLUMNS,
+    flare_timeline,
+    index_date,
+)
+
+PATIENTS = 300
+START = pd.Timestamp("2020-01-01")
+# The 12 events of a patient that can be flares
+SOURCE_COLUMNS = FLARE_CODE_COLUMNS + GOUT_CODE_COLUMNS + EMERG_COLUMNS + ADMISSION_COLUMNS
+
+
+def days(dates):
+    return ((pd.Series(dates) - START) / pd.Timedelta(days=1)).to_numpy(float)
+
+
+def cohort(seed):
+    # Events of every source around each patient's gout code, half the gout codes with a flare
+    # treatment on the same day
+    rng = np.random.default_rng(seed)
+
+    def dates(low, high, missing):
+        dates = START + pd.to_timedelta(rng.integers(low, high, PATIENTS), "D")
+        return pd.Series(dates).mask(rng.random(PATIENTS) < missing)
+
+    frame = {"patient_id": np.arange(1, PATIENTS + 1), "gout_code_date": dates(-5, 5, 0.02)}
+    frame["first_ult_date"] = dates(-30, 200, 0.5)
+    for column in SOURCE_COLUMNS + TREATMENT_COLUMNS:
+        frame[column] = dates(-20, 200, 0.3)
+    frame = pd.DataFrame(frame)
+    for code, treatment in zip(GOUT_CODE_COLUMNS, TREATMENT_COLUMNS):
+        same_day = rng.random(PATIENTS) < 0.5
+        frame.loc[same_day, treatment] = frame.loc[same_day, code]
+    return frame
+
+
+def blank(patients):
+    # Patients diagnosed on START, without ULT or any other event
+    frame = pd.DataFrame({"patient_id": np.arange(1, patients + 1), "gout_code_date": START})
+    for column in ["first_ult_date"] + SOURCE_COLUMNS + TREATMENT_COLUMNS:
+        frame[column] = pd.NaT
+    return frame
+
+
+def after(*offsets):
+    return [START + pd.Timedelta(days=offset) for offset in offsets]
+
+
+def set_dates(frame, patient, columns, dates):
+    for column, date in zip(columns, dates):
+        frame.loc[patient, column] = date
+
+
+def do_file_flare_count(cohort, passes=4, within_patient=False, after_last_flare=False):
+    # flare_count as 000_define_covariates.do derived it before flare_timeline.py: the dates of the
+    # flare codes, code/treatment pairs, ED attendances and admissions appended in that order (12
+    # rows per patient, missing outside the window), then four times: sort by patient and date
+    # (missing last) and, one row at a time as Stata's replace does, set a date missing if it is
+    # less than 14 days after the date of the row before, as already replaced, whichever patient
+    # that row is of. within_patient and after_last_flare undo the two ways flare_timeline differs.
+    code_and_tx = [
+        cohort[code].where(cohort[TREATMENT_COLUMNS].eq(cohort[code], axis=0).any(axis=1))
+        for code in GOUT_CODE_COLUMNS
+    ]
+    sources = (
+        [cohort[column] for column in FLARE_CODE_COLUMNS]
+        + code_and_tx
+        + [cohort[column] for column in EMERG_COLUMNS + ADMISSION_COLUMNS]
+    )
+    patients = np.tile(np.arange(len(cohort)), len(sources))
+    dates = np.concatenate([days(source) for source in sources])
+    index = np.tile(days(index_date(cohort)), len(sources))
+    with np.errstate(invalid="ignore"):
+        dates = np.where((dates > index + 14) & (dates < index + 180), dates, np.nan)
+    for _ in range(passes):
+        order = np.lexsort((dates, patients))
+        patients, dates = patients[order], dates[order]
+        previous = np.nan
+        for i in range(len(dates)):
+            if within_patient and i > 0 and patients[i] != patients[i - 1]:
+                previous = np.nan
+            if dates[i] - 14 < previous:
+                dates[i] = np.nan
+            if not (after_last_flare and np.isnan(dates[i])):
+                previous = dates[i]
+    return np.bincount(patients[~np.isnan(dates)], minlength=len(cohort))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_the_do_file_with_its_divergences_undone(seed):
+    frame = cohort(seed)
+    expected = do_file_flare_count(frame, within_patient=True, after_last_flare=True)
+    np.testing.assert_array_equal(flare_timeline(frame)["flare_count"], expected)
+
+
+def test_events_after_a_dropped_event():
+    # Divergence: events 20, 25, 30 and 35 days after diagnosis. The do-file dropped 25 (after
+    # 20), kept 30 (the row before was dropped), dropped 35 (after 30) and, on the next pass, 30
+    # (after 20). 35 is 15 days after the flare at 20, so it is a new flare.
+    frame = blank(1)
+    set_dates(frame, 0, FLARE_CODE_COLUMNS + ["gout_admission_1"], after(20, 25, 30, 35))
+    assert do_file_flare_count(frame).tolist() == [1]
+    timeline = flare_timeline(frame).iloc[0]
+    assert timeline["flare_count"] == 2
+    assert [timeline["flare_date_1"], timeline["flare_date_2"]] == after(20, 35)
+
+
+def test_events_after_another_patients_last_event():
+    # Divergence: the do-file compared a patient's first event with the last row of the patient
+    # before. When that patient had all 12 events within the window, the last of them (day 169)
+    # dropped the next patient's event on day 100.
+    frame = blank(2)
+    set_dates(frame, 0, SOURCE_COLUMNS, after(*range(15, 180, 14)))
+    set_dates(frame, 0, TREATMENT_COLUMNS, frame.loc[0, GOUT_CODE_COLUMNS])
+    set_dates(frame, 1, ["gout_flare_1"], after(100))
+    assert do_file_flare_count(frame).tolist() == [12, 0]
+    assert do_file_flare_count(frame, within_patient=True).tolist() == [12, 1]
+    assert flare_timeline(frame)["flare_count"].tolist() == [12, 1]
+
+
+def test_four_passes_are_enough():
+    # Not a divergence: each pass drops every other event of a run of close events, so the 12
+    # events of a patient (here one a day) need at most four passes
+    frame = blank(1)
+    set_dates(frame, 0, SOURCE_COLUMNS, after(*range(20, 32)))
+    set_dates(frame, 0, TREATMENT_COLUMNS, frame.loc[0, GOUT_CODE_COLUMNS])
+    assert do_file_flare_count(frame, passes=3).tolist() == [2]
+    assert do_file_flare_count(frame).tolist() == do_file_flare_count(frame, passes=12).tolist() == [1]
+    assert flare_timeline(frame)["flare_count"].tolist() == [1]
@@ -0,0 +1,85 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from benchmark import Measurements
+from extraction_trace import Tracer, read_trace
+from local_backend import LocalBackend
+from study_plan import load_study
+from synthetic_ehr import generate
+
+
+@pytest.fixture(scope="module")
+def run(request, tmp_path_factory):
+    # study_definition run against a small synthetic database, measured and traced
+    directory = tmp_path_factory.mktemp("group_fetches")
+    generate(directory / "ehr.sqlite", 300)
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        # The study definitions read codelists/ relative to the repository root
+        monkeypatch.chdir(request.config.rootpath)
+        study = load_study("study_definition")
+    backend = LocalBackend(directory / "ehr.sqlite", study.covariate_definitions)
+    measurements = Measurements(backend)
+    tracer = Tracer(directory / "trace.jsonl", backend)
+    tracemalloc.start()
+    try:
+        backend.run(jobs=1, report=lambda message: None, monitors=[measurements, tracer])
+    finally:
+        tracemalloc.stop()
+        tracer.close()
+    return backend, measurements.variables, {record["variable"]: record for record in read_trace(tracer.file.name)}
+
+
+def group_names(backend):
+    return {
+        f"group: {', '.join(names)}": names
+        for groups in (backend.as_of_groups, backend.window_count_groups, backend.first_n_groups)
+        for names in groups.values()
+    }
+
+
+def test_every_group_fetch_is_recorded_once(run):
+    backend, variables, records = run
+    groups = group_names(backend)
+    assert groups
+    assert {name for name in variables if name.startswith("group: ")} == set(groups)
+    assert {name for name in records if name.startswith("group: ")} == set(groups)
+    for name, names in groups.items():
+        assert records[name]["query_type"] == "group"
+        assert records[name]["variables"] == list(names)
+
+
+def test_members_are_not_charged_with_the_group_fetch(run):
+    backend, variables, records = run
+    # The as_of group fetches its events itself (its codes are read by no other variable)
+    fetch = next(name for name, names in group_names(backend).items() if names[0] in backend.as_of_groups)
+    assert variables[fetch]["rows_read"] > 0
+    assert records[fetch]["rows_read"] == variables[fetch]["rows_read"]
+    assert sum(query["rows"] for query in records[fetch]["queries"]) == records[fetch]["rows_read"]
+    for names in group_names(backend).values():
+        for name in names:
+            assert variables[name]["rows_read"] == 0
+            assert records[name]["rows_read"] == 0
+            assert records[name]["queries"] == []
+
+
+def test_rows_read_are_counted_once(run):
+    backend, variables, records = run
+    # The rows of each record are those of its own queries
+    queries = [query for record in records.values() for query in record["queries"]]
+    for record in records.values():
+        assert record["rows_read"] == sum(query["rows"] for query in record["queries"])
+    assert sum(measurement["rows_read"] for measurement in variables.values()) == sum(query["rows"] for query in queries)
+
+
+def test_first_n_chains_match_their_members_evaluated_alone(run):
+    backend, variables, records = run
+    chains = {tuple(names) for names in backend.first_n_groups.values()}
+    assert ("urate_test_1", "urate_test_2", "urate_test_3", "urate_test_4", "urate_test_5", "urate_test_6", "urate_test_7") in chains
+    for names in chains:
+        for name in names:
+            query_type, args = backend.covariate_definitions[name]
+            columns = {dependency: backend.results[dependency] for dependency in backend.graph[name]}
+            values, dates = backend.query(query_type, args, columns)
+            np.testing.assert_array_equal(backend.results[name], values)
@@ -0,0 +1,37 @@
+import json
+
+import pytest
+
+from incremental_refresh import as_of, changed_definitions, masked_definitions, record, watermark_path
+
+
+@pytest.fixture(autouse=True)
+def repository_root(request, monkeypatch):
+    # The study definitions read codelists/ relative to the repository root
+    monkeypatch.chdir(request.config.rootpath)
+
+
+def test_today_is_the_extraction_date():
+    args = {"between": ["1900-01-01", "today"], "on_or_before": "today - 1 year", "returning": "today"}
+    assert as_of(args, "2024-05-01") == {
+        "between": ["1900-01-01", "2024-05-01"],
+        "on_or_before": "2023-05-01",
+        "returning": "2024-05-01",
+    }
+
+
+def test_definitions_do_not_depend_on_the_day_they_are_checked():
+    masked = masked_definitions("study_definition", "2024-05-01")
+    assert masked == masked_definitions("study_definition", "2025-02-28")
+    assert "2024-05-01" not in json.dumps(masked)
+    assert masked["first_ult_date"][1]["between"][1] == "<end_date>"
+
+
+def test_only_edited_definitions_are_changed(tmp_path):
+    cohort = tmp_path / "input.feather"
+    record(cohort, "2024-05-01")
+    assert changed_definitions(cohort)[1] == []
+    recorded = json.loads(watermark_path(cohort).read_text())
+    recorded["definitions"]["age"][1]["reference_date"] = "2020-01-01"
+    watermark_path(cohort).write_text(json.dumps(recorded))
+    assert changed_definitions(cohort)[1] == ["age"]
@@ -0,0 +1,142 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from flare_timeline import index_date
+from urate_monitoring import RULES, URATE_TESTS, urate_monitoring
+
+PATIENTS = 300
+START = pd.Timestamp("2020-01-01")
+
+
+def cohort(seed):
+    # Urate tests around each patient's index date, with implausible and missing values, tests
+    # without dates and several tests on the same day
+    rng = np.random.default_rng(seed)
+
+    def dates(spread, missing):
+        dates = START + pd.to_timedelta(rng.integers(-spread, spread, PATIENTS), "D")
+        return pd.Series(dates).mask(rng.random(PATIENTS) < missing)
+
+    frame = {"patient_id": np.arange(1, PATIENTS + 1), "gout_code_date": dates(30, 0.05)}
+    frame["first_ult_date"] = dates(200, 0.3)
+    frame["recent_ult_date"] = dates(200, 0.3)
+    frame["gout_admission_1"] = dates(60, 0.8)
+    frame["gout_emerg_1"] = dates(60, 0.8)
+    for i in range(1, URATE_TESTS + 1):
+        kind = rng.integers(0, 5, PATIENTS)
+        frame[f"urate_test_{i}"] = np.select(
+            [kind == 0, kind == 1, kind == 2, kind == 3],
+            [rng.uniform(0.1, 0.7, PATIENTS), rng.uniform(150, 700, PATIENTS), np.zeros(PATIENTS), np.nan],
+            rng.choice([0.01, 3.0, 20.0, 2500.0, 360.0, 0.36], PATIENTS),
+        )
+        # Few distinct days, so that several tests fall on the same day
+        offsets = rng.choice([-200, -186, -182, -30, -7, 0, 7, 8, 14, 30, 180, 182, 186, 187, 365, 366], PATIENTS)
+        dates = pd.Series(START + pd.to_timedelta(offsets, "D"))
+        frame[f"urate_test_{i}_date"] = dates.mask(rng.random(PATIENTS) < 0.1)
+    return pd.DataFrame(frame)
+
+
+def days(dates):
+    return ((pd.Series(dates) - START) / pd.Timedelta(days=1)).to_numpy(float)
+
+
+def long_format_reference(cohort, rules):
+    # One row per test, as after `reshape long` in the do-files, then one patient at a time
+    index = days(index_date(cohort) if rules["recode_index_date"] else cohort["gout_code_date"])
+    ult = days(cohort[rules["ult_date"]])
+    tests = pd.concat(
+        [
+            pd.DataFrame(
+                {
+                    "patient": np.arange(len(cohort)),
+                    "value": cohort[f"urate_test_{i}"].to_numpy(float),
+                    "date": days(cohort[f"urate_test_{i}_date"]),
+                }
+            )
+            for i in range(1, URATE_TESTS + 1)
+        ]
+    )
+    # Values in mmol/L are converted to micromol/L, implausible values dropped
+    value = tests["value"]
+    tests["value"] = np.select(
+        [(value >= 0.05) & (value <= 2), (value >= 50) & (value <= 2000)], [value * 1000, value], np.nan
+    )
+    tests = tests.dropna()
+    # Tests on the same day are counted once, with the lowest value
+    tests = tests.groupby(["patient", "date"], as_index=False)["value"].min()
+
+    rows = []
+    for patient in range(len(cohort)):
+        own = tests[tests["patient"] == patient]
+        row = {"patient_id": cohort["patient_id"].iloc[patient]}
+        to_index = own["date"].to_numpy() - index[patient]
+        to_ult = own["date"].to_numpy() - ult[patient]
+        values = own["value"].to_numpy()
+
+        start, end = rules["baseline"]
+        candidates = [
+            (abs(t), t > 0, value)
+            for t, u, value in zip(to_index, to_ult, values)
+            if start <= t <= end and not (rules["baseline_before_ult"] and u > 0)
+        ]
+        if candidates:
+            baseline = min(candidates)[2]
+            row.update(baseline_urate=baseline, had_baseline_urate=True, baseline_urate_below360=float(baseline <= 360))
+        else:
+            row.update(baseline_urate=np.nan, had_baseline_urate=False, baseline_urate_below360=np.nan)
+
+        def window(selected, suffix):
+            selected = [value for value, keep in zip(values, selected) if keep]
+            row[f"count_urate_{suffix}"] = len(selected)
+            row[f"had_test_{suffix}"] = len(selected) > 0
+            row[f"lowest_urate_{suffix}"] = min(selected, default=np.nan)
+            row[f"urate_below360_{suffix}"] = bool(selected) and min(selected) <= 360
+
+        for suffix, (start, end) in rules["diagnosis_windows"].items():
+            window([start < t <= end for t in to_index], suffix)
+        started = not np.isnan(ult[patient])
+        if rules["ult_start_within"] is not None:
+            started = started and index[patient] <= ult[patient] < index[patient] + rules["ult_start_within"]
+        for suffix, (start, end) in rules["ult_windows"].items():
+            window([started and u > 0 and start < u <= end for u in to_ult], f"ult_{suffix}")
+            row[f"two_urate_ult_{suffix}"] = row[f"count_urate_ult_{suffix}"] >= 2
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+@pytest.mark.parametrize("rules", RULES)
+@pytest.mark.parametrize("seed", range(3))
+def test_long_format_reference(rules, seed):
+    frame = cohort(seed)
+    result = urate_monitoring(frame, RULES[rules])
+    expected = long_format_reference(frame, RULES[rules])
+    assert list(result.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(result.astype(float), expected.astype(float))
+
+
+def test_same_day_tests_keep_the_lowest():
+    frame = cohort(0).iloc[:1].copy()
+    frame["gout_code_date"] = START
+    frame["recent_ult_date"] = pd.NaT
+    for i in range(1, URATE_TESTS + 1):
+        frame[f"urate_test_{i}"] = np.nan
+        frame[f"urate_test_{i}_date"] = pd.NaT
+    day = START + pd.Timedelta(days=30)
+    frame[["urate_test_1", "urate_test_2", "urate_test_3"]] = [[0.5, 300.0, 0.4]]
+    frame[["urate_test_1_date", "urate_test_2_date", "urate_test_3_date"]] = [[day, day, day + pd.Timedelta(days=1)]]
+    result = urate_monitoring(frame, RULES["consults"]).iloc[0]
+    assert result["count_urate_6m"] == 2
+    assert result["lowest_urate_6m"] == 300
+    assert result["baseline_urate"] == 300
+
+
+def test_equally_close_baseline_tests_use_the_earlier():
+    frame = cohort(0).iloc[:1].copy()
+    frame["gout_code_date"] = START
+    for i in range(1, URATE_TESTS + 1):
+        frame[f"urate_test_{i}"] = np.nan
+        frame[f"urate_test_{i}_date"] = pd.NaT
+    frame[["urate_test_1", "urate_test_2"]] = [[500.0, 300.0]]
+    frame[["urate_test_1_date", "urate_test_2_date"]] = [[START + pd.Timedelta(days=10), START - pd.Timedelta(days=10)]]
+    assert urate_monitoring(frame, RULES["consults"]).iloc[0]["baseline_urate"] == 300
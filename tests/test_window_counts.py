@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+
+from window_counts import count_in_windows
+
+def long_format_counts(positions, days, windows, size):
+    # Reference: one row per (event, window), kept if the event is within the patient's window
+    frame = pd.DataFrame({"position": positions, "day": days}).dropna()
+    counts = []
+    for low, high in windows:
+        bounds = pd.DataFrame(
+            {
+                "position": np.arange(size),
+                "low": np.broadcast_to(-np.inf if low is None else low, (size,)),
+                "high": np.broadcast_to(np.inf if high is None else high, (size,)),
+            }
+        )
+        merged = frame.merge(bounds, on="position")
+        within = merged[(merged["day"] >= merged["low"]) & (merged["day"] <= merged["high"])]
+        counts.append(within.groupby("position").size().reindex(range(size), fill_value=0).to_numpy())
+    return counts
+
+
+def test_windows_of_every_kind(events, rng, patients):
+    positions, days = events
+    low = rng.integers(-60, 250, patients).astype(float)
+    low[rng.random(patients) < 0.2] = np.nan
+    windows = [
+        (None, None),
+        (0, 100),
+        (low, low + 30),
+        (low, low + 365),
+        (low, None),
+        (None, low),
+        (-1000, 1000),
+        (low + 40, low),
+    ]
+    counts = count_in_windows(positions, days, windows, patients)
+    for count, expected in zip(counts, long_format_counts(positions, days, windows, patients)):
+        np.testing.assert_array_equal(count, expected)
+
+
+def test_missing_bounds_count_nothing():
+    positions = np.array([0, 0, 1, 1, 2])
+    days = np.array([1.0, 2.0, 1.0, 5.0, 3.0])
+    low = np.array([np.nan, 0.0, 0.0])
+    high = np.array([10.0, np.nan, 10.0])
+    counts = count_in_windows(positions, days, [(low, high), (low, None), (None, high)], 3)
+    np.testing.assert_array_equal(counts[0], [0, 0, 1])
+    np.testing.assert_array_equal(counts[1], [0, 2, 1])
+    np.testing.assert_array_equal(counts[2], [2, 0, 1])
+
+
+def test_same_day_events_and_inclusive_bounds():
+    # Every event on a bound day is counted, however many there are
+    positions = np.array([0, 0, 0, 0, 1, 1, 1])
+    days = np.array([5.0, 5.0, 5.0, 9.0, 5.0, 9.0, 9.0])
+    counts = count_in_windows(positions, days, [(5, 9), (5, 5), (9, 9), (6, 8)], 2)
+    np.testing.assert_array_equal(counts, [[4, 3], [3, 1], [1, 2], [0, 0]])